@@ -1,25 +1,56 @@
 import streamlit as st
 import pandas as pd
+from datetime import datetime, timedelta
+
+import logging
 
 from backend import (
     ingestion,
+    llm_cache,
+    telemetry,
 )
 from backend.gmail_loader import (
     generate_oauth_url,
     handle_oauth_callback,
-    fetch_inbox_with_token,
-    create_gmail_draft,
+    ensure_bodies,
 )
 from backend.prompts import (
+    diff_prompt_versions,
+    get_prompt_version,
+    list_prompt_versions,
     load_prompts,
     reset_prompts,
     save_prompts,
 )
-from backend.mongo_db import get_db
-from backend.agent import run_agent_on_email
-from backend.drafts import save_draft_to_db
+from backend.mongo_db import get_db, pool_stats
+from backend.agent import GEMINI_API_KEY, ask_inbox, stream_agent_on_email
+from backend.drafts import FAILED, GENERATING, UNCONFIRMED, save_draft_to_db
+from backend.storage import ensure_indexes
+from backend.jobs import (
+    ACTIVE,
+    CANCELLED,
+    DONE,
+    cancel_job,
+    enqueue,
+    get_job,
+    start_inline_workers,
+)
+from backend.inbox import DEFAULT_PAGE_SIZE, get_email, get_thread, list_inbox_page
+from backend.threads import get_summary, summarize_thread
+from backend.search import search_inbox
+from backend.retrieval import get_user_index
+from backend.services import services
+
+
+
+def _startup():
+    """Once per process: the managed indexes and the in-process job workers."""
+    ensure_indexes(get_db())
+    return start_inline_workers()
+
 
-db = get_db()
+services.register("app_startup", _startup)
+services.get("app_startup")
 
 st.set_page_config(page_title="Prompt-Driven Email Agent", layout="wide")
 
@@ -27,213 +58,639 @@ st.set_page_config(page_title="Prompt-Driven Email Agent", layout="wide")
 st.sidebar.title("Email Agent")
 page = st.sidebar.radio(
     "Go to",
-    ["Inbox Loader", "Prompt Brain", "Email Agent", "Draft Manager", "About"],
+    [
+        "Inbox Loader",
+        "Prompt Brain",
+        "Email Agent",
+        "Search",
+        "Draft Manager",
+        "About",
+    ],
 )
+# every Gmail/Gemini/Mongo span of this run is attributed to the user and page
+render_span = telemetry.begin_render(page, st.session_state.get("user_email"))
 
 
 def refresh():
     st.rerun()
 
 
-# --- Page: Inbox Loader ---
-if page == "Inbox Loader":
-    st.title("Inbox Loader")
-    st.markdown("---")
-    st.subheader("Sign in with Google (Gmail)")
-
-    # Show user's inbox from Mongo
-    if "user_email" in st.session_state:
-        db = get_db()
-        inbox_coll = db.inboxes
-        user_email = st.session_state["user_email"]
-        # optionally apply processed tags from processed.json or from processed collection if you add one
-        cursor = (
-            inbox_coll.find({"user_email": user_email})
-            .sort("fetched_at", -1)
-            .limit(200)
-        )
-        emails = list(cursor)
+def inbox_pager(key, user_email, page_size=DEFAULT_PAGE_SIZE, container=st):
+    """Cursor-paginated inbox listing with Newer/Older controls; returns one page."""
+    cursors = st.session_state.setdefault(f"{key}_cursors", [None])
+    items, next_cursor = list_inbox_page(user_email, page_size, cursors[-1])
+    newer, older = container.columns(2)
+    if newer.button("‹ Newer", key=f"{key}_newer", disabled=len(cursors) == 1):
+        cursors.pop()
+        refresh()
+    if older.button("Older ›", key=f"{key}_older", disabled=next_cursor is None):
+        cursors.append(next_cursor)
+        refresh()
+    return items
 
-        prompts = load_prompts()
 
-        # display as dataframe
-        df = pd.DataFrame(
-            [
-                {
-                    "email_id": e["email_id"],
-                    "sender": e["sender"],
-                    "subject": e["subject"],
-                    "timestamp": e["timestamp"],
-                }
-                for e in emails
-            ]
+@st.fragment(run_every=1.0)
+def job_panel(key, render_result):
+    """
+    Status of the background job whose id is in session key `key`, polled
+    every second. Shows progress and a Cancel button while it runs, then
+    `render_result(result)`; the page reruns once when the job finishes.
+    """
+    job_id = st.session_state.get(key)
+    job = get_job(job_id) if job_id else None
+    if job is None:
+        return
+    progress = job.get("progress", {})
+    if job["status"] in ACTIVE:
+        done, total = progress.get("done", 0), progress.get("total", 0)
+        st.progress(
+            done / total if total else 0.0,
+            text=progress.get("message") or job["status"].capitalize() + "...",
         )
-        st.dataframe(df)
-    else:
-        st.info("Please sign in with Google to view your inbox.")
-
-    # OAuth link and callback handling
-    query_params = st.query_params
-    if "code" in query_params:
-        # handle code exchange (callback)
-        try:
-            handle_oauth_callback(query_params)
-            st.success("Authenticated successfully. You can now fetch emails.")
-            st.query_params.clear()
-        except Exception as e:
-            print(e)
-            st.error(f"Authentication failed: {e}")
-
-    # handle authentication
-    if "oauth_state" not in st.session_state:
-        oauth_url = generate_oauth_url()
-        st.markdown(f"[Sign in with Google]({oauth_url})")
+        if job.get("cancel_requested"):
+            st.caption("Cancelling...")
+        elif st.button("Cancel", key=f"{key}_cancel"):
+            cancel_job(job_id)
+        return
+
+    if st.session_state.get(f"{key}_finished") != job_id:
+        # let the rest of the page pick up what the job wrote
+        st.session_state[f"{key}_finished"] = job_id
+        st.rerun()
+    if job["status"] == DONE:
+        render_result(job.get("result") or {})
+    elif job["status"] == CANCELLED:
+        st.warning("Cancelled.")
+        if job.get("result"):
+            render_result(job["result"])
     else:
-        st.success("Connected to Gmail (session active).")
-        n = st.number_input(
-            "Number of latest emails to load", min_value=1, max_value=100, value=20
-        )
-        if st.button("Load latest emails from Gmail"):
+        st.error(f"Job failed: {job.get('error')}")
+
+
+try:
+    # --- Page: Inbox Loader ---
+    if page == "Inbox Loader":
+        st.title("Inbox Loader")
+        st.markdown("---")
+        st.subheader("Sign in with Google (Gmail)")
+
+        # Show user's inbox from Mongo
+        page_items = []
+        if "user_email" in st.session_state:
+            user_email = st.session_state["user_email"]
+            # list fields only; bodies are loaded when ingestion needs them
+            page_items = inbox_pager("loader", user_email)
+
+            prompts = load_prompts()
+
+            # display as dataframe
+            df = pd.DataFrame(
+                [
+                    {
+                        "email_id": e["email_id"],
+                        "sender": e["sender"],
+                        "subject": e["subject"],
+                        "timestamp": e["timestamp"],
+                    }
+                    for e in page_items
+                ]
+            )
+            st.dataframe(df)
+        else:
+            st.info("Please sign in with Google to view your inbox.")
+
+        # OAuth link and callback handling
+        query_params = st.query_params
+        if "code" in query_params:
+            # handle code exchange (callback)
             try:
-                emails = fetch_inbox_with_token(n)
-                st.success(f"Loaded {len(emails)} emails into the database")
+                handle_oauth_callback(query_params)
+                st.success("Authenticated successfully. You can now fetch emails.")
+                st.query_params.clear()
             except Exception as e:
-                st.error(f"Error fetching emails: {e}")
-
-    st.markdown("---")
-    st.info(
-        "You can also run ingestion after loading emails to categorize and extract action items."
-    )
-    if st.button("Run ingestion (categorize & extract)"):
-        categories = ingestion.run_ingestion(inbox=emails, prompts=prompts)
-        st.success("Ingestion complete.")
-        processed_df = pd.DataFrame(
-            [
+                logging.getLogger(__name__).exception("OAuth callback failed")
+                st.error(f"Authentication failed: {e}")
+
+        # handle authentication
+        if "oauth_state" not in st.session_state:
+            oauth_url = generate_oauth_url()
+            st.markdown(f"[Sign in with Google]({oauth_url})")
+        else:
+            st.success("Connected to Gmail (session active).")
+            n = st.number_input(
+                "Number of latest emails to load", min_value=1, max_value=100, value=20
+            )
+            incremental = st.checkbox(
+                "Only sync changes since last load",
+                value=True,
+                help="Uses Gmail history to fetch new mail and drop deleted mail. "
+                "Falls back to loading the latest N when no sync point is stored.",
+            )
+            with_bodies = st.checkbox(
+                "Download message bodies now",
+                value=True,
+                help="Unchecked fetches sender and subject only; each body is "
+                "downloaded when it is first opened or ingested.",
+            )
+            if st.button("Load latest emails from Gmail"):
+                st.session_state["sync_job"] = enqueue(
+                    "sync",
+                    st.session_state["user_email"],
+                    {"n": int(n), "incremental": incremental, "with_bodies": with_bodies},
+                )
+                st.session_state["loader_cursors"] = [None]
+
+            def _show_sync(result):
+                st.success(
+                    f"{result['mode'].capitalize()} sync: "
+                    f"{result['added']} loaded, {result['removed']} removed"
+                )
+                if result.get("batches"):
+                    st.caption(
+                        f"Fetched in {result['batches']} batch(es), "
+                        f"{result['seconds']:.2f}s"
+                    )
+
+            job_panel("sync_job", _show_sync)
+
+        st.markdown("---")
+        st.info(
+            "You can also run ingestion after loading emails to categorize and extract action items."
+        )
+        use_llm = st.checkbox(
+            "Use Gemini with my Prompt Brain prompts",
+            value=bool(GEMINI_API_KEY),
+            disabled=not GEMINI_API_KEY,
+            help="Keyword rules settle the clear-cut emails; the rest are "
+            "categorized by Gemini within the configured rate budget. Unchecked "
+            "uses keyword rules only.",
+        )
+        threshold = st.slider(
+            "Rule confidence needed to skip Gemini",
+            min_value=0.0,
+            max_value=1.0,
+            value=ingestion.DEFAULT_THRESHOLDS["default"],
+            step=0.05,
+            disabled=not use_llm,
+            help="Emails the keyword rules categorize with at least this "
+            "confidence are not sent to Gemini. Newsletters and To-Do emails, "
+            "whose rules are precise, have their own thresholds; 1.0 sends "
+            "every other email.",
+        )
+        # precision is measured on the signed-in user's processed mail
+        if "user_email" in st.session_state and st.toggle(
+            "Check rule precision against Gemini's labels", disabled=not use_llm
+        ):
+            precision = ingestion.rule_precision(user_email, {"default": threshold})
+            if precision:
+                st.dataframe(
+                    pd.DataFrame(
+                        [{"category": c, **v} for c, v in sorted(precision.items())]
+                    )
+                )
+            else:
+                st.caption("No Gemini-labelled emails the rules would settle yet.")
+        force = st.checkbox(
+            "Reprocess unchanged emails",
+            value=False,
+            help="By default emails whose content and prompts are unchanged "
+            "since the last run reuse their stored result.",
+        )
+        if st.button("Run ingestion (categorize & extract)") and page_items:
+            st.session_state["ingest_job"] = enqueue(
+                "ingest",
+                user_email,
                 {
+                    "email_ids": [e["email_id"] for e in page_items],
+                    "prompts": prompts,
+                    "use_llm": use_llm,
+                    "force": force,
+                    "thresholds": {"default": threshold},
+                },
+            )
+
+        def _show_ingestion(result):
+            st.success(
+                f"Ingestion complete: {result['processed']} processed, "
+                f"{result['reused']} unchanged and skipped."
+            )
+            counts = result.get("usage")
+            if counts:
+                st.caption(
+                    f"{counts['rules_tier']} settled by rules, {counts['llm_tier']} "
+                    f"sent to Gemini: {counts['requests']} Gemini requests "
+                    f"({counts['batched_requests']} batched, "
+                    f"{counts['fallback_requests']} re-asked individually), "
+                    f"~{counts['prompt_tokens']} prompt tokens. Rules saved "
+                    f"~{counts['saved_requests']} requests and "
+                    f"~{counts['saved_prompt_tokens']} prompt tokens."
+                )
+            stored = {
+                d["email_id"]: d
+                for d in ingestion.get_processed(
+                    [e["email_id"] for e in page_items],
+                    user_email,
+                    {"_id": 0, "email_id": 1, "category": 1, "tier": 1, "confidence": 1},
+                )
+            }
+
+            def _row(e):
+                doc = stored.get(e["email_id"])
+                return {
                     "email_id": e["email_id"],
                     "sender": e["sender"],
                     "subject": e["subject"],
                     "timestamp": e["timestamp"],
-                    "category": categories[e["email_id"]]["category"],
+                    "category": doc.get("category", "error") if doc else "not processed",
+                    "tier": (doc or {}).get("tier", ""),
+                    "confidence": (doc or {}).get("confidence"),
                 }
-                for e in emails
-            ]
-        )
-        st.dataframe(processed_df)
 
-# Prompt Brain
-elif page == "Prompt Brain":
-    if "user_email" not in st.session_state:
-        st.info("Please sign in.")
-    else:
-        st.title("Prompt Brain — Edit templates")
-        prompts = load_prompts()
+            processed_df = pd.DataFrame([_row(e) for e in page_items])
+            st.dataframe(processed_df)
 
-        with st.form("prompts_form"):
-            cat = st.text_area(
-                "Categorization Prompt", value=prompts["categorization"], height=120
-            )
-            action = st.text_area(
-                "Action-item Extraction Prompt",
-                value=prompts["action_item"],
-                height=120,
-            )
-            reply = st.text_area(
-                "Auto-Reply Draft Prompt", value=prompts["auto_reply"], height=120
-            )
-            tone = st.text_area(
-                "Optional Tone Prompt",
-                value=prompts.get("tone_instructions", ""),
-                height=80,
-            )
-            submitted = st.form_submit_button("Save prompts")
-            if submitted:
-                new = {
-                    "categorization": cat,
-                    "action_item": action,
-                    "auto_reply": reply,
-                    "tone_instructions": tone,
-                }
-                save_prompts(new)
-                st.success("Prompts saved.")
+        if page_items:
+            job_panel("ingest_job", _show_ingestion)
+
+    # Prompt Brain
+    elif page == "Prompt Brain":
+        if "user_email" not in st.session_state:
+            st.info("Please sign in.")
+        else:
+            st.title("Prompt Brain — Edit templates")
+            prompts = load_prompts()
+
+            with st.form("prompts_form"):
+                cat = st.text_area(
+                    "Categorization Prompt", value=prompts["categorization"], height=120
+                )
+                action = st.text_area(
+                    "Action-item Extraction Prompt",
+                    value=prompts["action_item"],
+                    height=120,
+                )
+                reply = st.text_area(
+                    "Auto-Reply Draft Prompt", value=prompts["auto_reply"], height=120
+                )
+                tone = st.text_area(
+                    "Optional Tone Prompt",
+                    value=prompts.get("tone_instructions", ""),
+                    height=80,
+                )
+                submitted = st.form_submit_button("Save prompts")
+                if submitted:
+                    new = {
+                        "categorization": cat,
+                        "action_item": action,
+                        "auto_reply": reply,
+                        "tone_instructions": tone,
+                    }
+                    save_prompts(new)
+                    st.success("Prompts saved.")
+                    refresh()
+
+            if st.button("Reset to defaults"):
+                reset_prompts()
+                st.success("Prompts reset.")
                 refresh()
 
-        if st.button("Reset to defaults"):
-            reset_prompts()
-            st.success("Prompts reset.")
-            refresh()
+            st.caption(f"Current version: v{get_prompt_version()}")
+            with st.expander("Version history"):
+                versions = [
+                    v["version"] for v in list_prompt_versions() if v.get("version")
+                ]
+                if len(versions) < 2:
+                    st.write("No earlier versions yet.")
+                else:
+                    col_old, col_new = st.columns(2)
+                    old_v = col_old.selectbox("Compare", versions[1:], key="diff_old")
+                    new_v = col_new.selectbox("with", versions, key="diff_new")
+                    diffs = diff_prompt_versions(old_v, new_v)
+                    if not diffs:
+                        st.write("No differences.")
+                    for key, diff in diffs.items():
+                        st.markdown(f"**{key}**")
+                        st.code(diff, language="diff")
 
-# Email Agent
-elif page == "Email Agent":
-    if "user_email" not in st.session_state:
-        st.info("Please sign in.")
-    else:
-        st.title("Email Agent")
-        inbox = list(db.inboxes.find({"user_email": st.session_state["user_email"]}))
-        prompts = load_prompts()
-        if not inbox:
-            st.info("No emails loaded. Use Inbox Loader to upload or connect Gmail.")
+    # Email Agent
+    elif page == "Email Agent":
+        if "user_email" not in st.session_state:
+            st.info("Please sign in.")
         else:
-            subjects = [e["subject"] for e in inbox]
-            selected = st.sidebar.selectbox("Select email", options=subjects)
-            email = next(e for e in inbox if e["subject"] == selected)
-            st.subheader(
-                f"From: {email.get('sender')}  |  Subject: {email.get('subject')}"
-            )
-            st.write("**Timestamp:**", email.get("timestamp"))
-            st.markdown("---")
-            st.write(email.get("body"))
-
-            st.markdown("---")
-            st.subheader("Ask the Agent")
-            question = st.text_input(
-                "Instruction (e.g. 'Summarize this email', 'What tasks do I need to do?', 'Draft a reply in tone: friendly')",
-                value="",
-            )
-            if st.button("Run Agent"):
-                with st.spinner("Running agent..."):
-                    response = run_agent_on_email(email, question, prompts)
-                    if isinstance(response, dict) and response.get("structured"):
-                        st.json(response)
-                    else:
+            st.title("Email Agent")
+            user_email = st.session_state["user_email"]
+            mode = st.sidebar.radio("Mode", ["Selected email", "Ask across inbox"])
+            if mode == "Ask across inbox":
+                question = st.text_input(
+                    "Question about your inbox "
+                    "(e.g. 'What did finance ask me for this month?')",
+                    value="",
+                )
+                if st.button("Ask") and question.strip():
+                    # the first question embeds the whole mailbox
+                    indexing = st.empty()
+
+                    def _indexed(done, total):
+                        indexing.progress(
+                            done / total, text=f"Indexing your inbox: {done}/{total}"
+                        )
+
+                    index = get_user_index(user_email, on_progress=_indexed)
+                    indexing.empty()
+                    with st.spinner("Searching your inbox..."):
+                        answer = ask_inbox(question, index, user_email=user_email)
+                    st.markdown("**Agent response:**")
+                    st.write(answer["text"])
+                    if answer["sources"]:
+                        st.markdown("**Sources**")
+                        st.dataframe(
+                            pd.DataFrame(
+                                [
+                                    {
+                                        "#": n,
+                                        "subject": src["subject"],
+                                        "sender": src["sender"],
+                                        "score": round(src["score"], 3),
+                                    }
+                                    for n, src in enumerate(answer["sources"], start=1)
+                                ]
+                            )
+                        )
+            else:
+                page_items = inbox_pager("agent", user_email, container=st.sidebar)
+                prompts = load_prompts()
+                if not page_items:
+                    st.info("No emails loaded. Use Inbox Loader to upload or connect Gmail.")
+                else:
+                    labels = {
+                        e["email_id"]: (
+                            f"{e.get('subject') or '(no subject)'} — {e.get('sender', '')}"
+                        )
+                        for e in page_items
+                    }
+                    selected_id = st.sidebar.selectbox(
+                        "Select email",
+                        options=list(labels),
+                        format_func=labels.get,
+                        key="selected_email_id",
+                    )
+                    # only the selected message's body is loaded
+                    email = get_email(user_email, selected_id)
+                    if email is None:
+                        # deleted by a sync since the list was rendered
+                        st.warning("That email is no longer in your inbox.")
+                        st.stop()
+                    ensure_bodies(user_email, [email])
+                    st.subheader(
+                        f"From: {email.get('sender')}  |  Subject: {email.get('subject')}"
+                    )
+                    st.write("**Timestamp:**", email.get("timestamp"))
+                    st.markdown("---")
+                    st.write(email.get("body"))
+
+                    thread_id = email.get("thread_id")
+                    thread = (
+                        get_thread(
+                            user_email,
+                            thread_id,
+                            {"_id": 0, "sender": 1, "subject": 1, "timestamp": 1},
+                        )
+                        if thread_id
+                        else []
+                    )
+                    if len(thread) > 1:
+                        st.markdown("---")
+                        st.subheader(f"Thread ({len(thread)} messages)")
+                        st.dataframe(
+                            pd.DataFrame(thread)[["timestamp", "sender", "subject"]]
+                        )
+                        stored = get_summary(user_email, thread_id)
+                        covered = stored.get("message_count", 0) if stored else 0
+                        if covered < len(thread) and st.button(
+                            "Update thread summary" if stored else "Summarize thread"
+                        ):
+                            with st.spinner("Summarizing new messages..."):
+                                summary = summarize_thread(user_email, thread_id)
+                            st.caption(
+                                f"Folded in {summary['new_messages']} new message(s) "
+                                f"with {summary['calls']} Gemini call(s)."
+                            )
+                            if summary["covered"] < summary["messages"]:
+                                st.warning(
+                                    "Gemini's reply for some messages was empty or "
+                                    "cut off; they are folded in on the next update."
+                                )
+                            stored = {
+                                "summary": summary["summary"],
+                                "message_count": summary["covered"],
+                            }
+                        if stored:
+                            st.markdown(stored["summary"])
+                            st.caption(
+                                f"Summary covers {stored['message_count']} of "
+                                f"{len(thread)} messages."
+                            )
+
+                    st.markdown("---")
+                    st.subheader("Ask the Agent")
+                    question = st.text_input(
+                        "Instruction (e.g. 'Summarize this email', 'What tasks do I need to do?', 'Draft a reply in tone: friendly')",
+                        value="",
+                    )
+                    if st.button("Run Agent"):
                         st.markdown("**Agent response:**")
-                        st.write(
-                            response.get("text")
-                            if isinstance(response, dict)
-                            else response
+                        output = st.empty()
+                        stream = stream_agent_on_email(
+                            email, question, prompts, user_email
+                        )
+                        with output.container():
+                            st.write_stream(stream)
+                        response = stream.result
+                        # kept for the rerun that a click on "Save draft" starts
+                        st.session_state["agent_response"] = (selected_id, response)
+                        if isinstance(response, dict) and response.get("structured"):
+                            output.json(response)
+                        if stream.timings:
+                            st.caption(
+                                f"First token {stream.timings.get('first_token_s', 0):.2f}s"
+                                f" · total {stream.timings.get('total_s', 0):.2f}s"
+                            )
+                        tokens = stream.plan["input_tokens"]
+                        st.caption(
+                            f"Input ~{tokens['after']} tokens "
+                            f"(~{tokens['before']} before cleaning)"
                         )
+                    elif st.session_state.get("agent_response", (None,))[0] == selected_id:
+                        # a rerun (e.g. from "Save draft") shows the last response
+                        response = st.session_state["agent_response"][1] or {}
+                        st.markdown("**Agent response:**")
+                        if response.get("structured"):
+                            st.json(response)
+                        else:
+                            st.write(response.get("text", ""))
 
+                    last = st.session_state.get("agent_response")
+                    response = last[1] if last and last[0] == selected_id else None
                     if isinstance(response, dict) and response.get("draft"):
                         if st.button("Save draft"):
-                            save_draft_to_db(response["draft"], True)
+                            meta = {
+                                "to": email.get("sender"),
+                                "thread_id": email.get("thread_id"),
+                                "in_reply_to": email.get("message_id") or None,
+                            }
+                            save_draft_to_db({**response["draft"], "meta": meta}, True)
                             st.success("Draft saved.")
 
-# Draft Manager
-elif page == "Draft Manager":
+    # Search
+    elif page == "Search":
+        if "user_email" not in st.session_state:
+            st.info("Please sign in.")
+        else:
+            st.title("Search inbox")
+            user_email = st.session_state["user_email"]
+            query = st.text_input("Search sender, subject and body", value="")
+            col_sender, col_subject, col_category = st.columns(3)
+            sender = col_sender.text_input("From contains", value="")
+            subject = col_subject.text_input("Subject contains", value="")
+            category = col_category.selectbox(
+                "Category", ["Any", "Important", "Newsletter", "Spam", "To-Do"]
+            )
+            dates = st.date_input("Received between", value=(), format="YYYY-MM-DD")
 
-    if "user_email" not in st.session_state:
-        st.info("Please sign in.")
-    else:
-        db = get_db()
-        drafts_coll = db.drafts
-        user = st.session_state["user_email"]
-        docs = list(drafts_coll.find({"user_email": user}).sort("created_at", -1))
-
-        for d in docs:
-            st.write(f"### Email: {d["user_email"]}")
-            st.text(f"Subject: {d["subject"]}")
-            st.text(d["body"])
+            date_from = date_to = None
+            if len(dates) == 2:
+                start, end = (datetime.combine(d, datetime.min.time()) for d in dates)
+                date_from = int(start.timestamp() * 1000)
+                date_to = int((end + timedelta(days=1)).timestamp() * 1000) - 1
+
+            # a new search starts again from the first page
+            search_key = (query, sender, subject, category, date_from, date_to)
+            if st.session_state.get("search_key") != search_key:
+                st.session_state["search_key"] = search_key
+                st.session_state["search_page"] = 0
+            page_no = st.session_state["search_page"]
+            found = search_inbox(
+                user_email,
+                query=query,
+                sender=sender or None,
+                subject=subject or None,
+                date_from=date_from,
+                date_to=date_to,
+                category=None if category == "Any" else category,
+                page=page_no,
+            )
+            st.dataframe(pd.DataFrame(found["results"]))
+            prev_col, next_col = st.columns(2)
+            if prev_col.button("‹ Previous", disabled=page_no == 0):
+                st.session_state["search_page"] = page_no - 1
+                refresh()
+            if next_col.button("Next ›", disabled=not found["has_more"]):
+                st.session_state["search_page"] = page_no + 1
+                refresh()
+
+    # Draft Manager
+    elif page == "Draft Manager":
+
+        if "user_email" not in st.session_state:
+            st.info("Please sign in.")
+        else:
+            db = get_db()
+            drafts_coll = db.drafts
+            user = st.session_state["user_email"]
+
+            st.subheader("Auto-draft To-Do emails")
+            push = st.checkbox(
+                "Also create the drafts in Gmail",
+                value=True,
+                help="Drafts are only created, never sent. Emails that already "
+                "have a draft are skipped.",
+            )
+            if st.button("Draft replies to all To-Do emails"):
+                st.session_state["drafts_job"] = enqueue(
+                    "drafts", user, {"prompts": load_prompts(), "push": push}
+                )
+
+            def _show_drafts(result):
+                st.success(
+                    f"{result['generated']} replies drafted, {result['skipped']} of "
+                    f"{result['todo']} To-Do emails already had one."
+                )
+                st.caption(
+                    f"{result['pushed']} created in Gmail · "
+                    f"{result['failed']} failed to generate · "
+                    f"{result['push_failed']} failed to upload · "
+                    f"{result['requests']} Gemini requests"
+                )
+
+            job_panel("drafts_job", _show_drafts)
             st.divider()
 
+            docs = list(
+                drafts_coll.find(
+                    {"user_email": user, "status": {"$nin": [GENERATING, FAILED]}}
+                ).sort("created_at", -1)
+            )
+
+            for d in docs:
+                st.write(f"### To: {d.get('meta', {}).get('to') or d['user_email']}")
+                st.text(f"Subject: {d['subject']}")
+                if d.get("gmail_draft_id"):
+                    st.caption("In Gmail drafts")
+                elif d.get("status") == UNCONFIRMED:
+                    st.caption(
+                        f"Upload to Gmail unconfirmed ({d.get('push_error')}); the "
+                        "next run checks Gmail before trying again"
+                    )
+                elif d.get("push_error"):
+                    st.caption(f"Not in Gmail: {d['push_error']}")
+                st.text(d["body"])
+                st.divider()
+
 
-# About
-elif page == "About":
-    st.title("About & Assignment")
-    st.markdown("- Built with Streamlit frontend.")
-    st.markdown("- Prompts are stored in `data/prompts.json` and editable.")
-    st.markdown(
-        "- LLM integration uses Google Gemini via `google-generativeai` when `GEMINI_API_KEY` is set."
-    )
-    st.markdown(
-        "- OAuth-based Gmail sign-in lets any user connect their inbox (read-only)."
-    )
+    # About
+    elif page == "About":
+        st.title("About & Assignment")
+        st.markdown("- Built with Streamlit frontend.")
+        st.markdown("- Prompts are stored in `data/prompts.json` and editable.")
+        st.markdown(
+            "- LLM integration uses Google Gemini via `google-generativeai` when `GEMINI_API_KEY` is set."
+        )
+        st.markdown(
+            "- OAuth-based Gmail sign-in lets any user connect their inbox (read-only)."
+        )
+
+        with st.expander("Diagnostics"):
+            st.write("**Mongo connection pool**")
+            st.json(pool_stats())
+            st.write("**LLM response cache**")
+            st.json(llm_cache.stats())
+
+            user_email = st.session_state.get("user_email")
+            st.write("**Latency by page** (this process, since start)")
+            rows = telemetry.metrics.snapshot(user_email=user_email or "-")
+            if rows:
+                st.dataframe(pd.DataFrame(rows).drop(columns=["user", "buckets"]))
+                st.json(telemetry.metrics.counters(user_email or "-"))
+            breakdown_page = st.selectbox(
+                "Last render breakdown for",
+                ["Inbox Loader", "Prompt Brain", "Email Agent", "Search", "Draft Manager"],
+            )
+            spans = telemetry.metrics.last_render(user_email or "-", breakdown_page)
+            if spans:
+                breakdown = (
+                    pd.DataFrame(
+                        [{"span": s["name"], "ms": s["duration_ms"]} for s in spans]
+                    )
+                    .groupby("span")["ms"]
+                    .agg(["count", "sum", "max"])
+                    .sort_values("sum", ascending=False)
+                )
+                st.dataframe(breakdown)
+            else:
+                st.caption("No render of that page recorded yet.")
+except Exception:
+    render_span.end(error=True)
+    raise
+finally:
+    # st.rerun()/st.stop() unwind the script too; the span ends either way
+    render_span.end()
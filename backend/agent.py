@@ -1,116 +1,432 @@
 import os
-import json
-from typing import Dict, Any
-from google import genai
+import time
+from typing import Dict, Any, Iterator, Optional
+
+from . import llm_cache, telemetry
+from .generation import (
+    ACTIONS,
+    ASK_INBOX,
+    CATEGORIZE,
+    DRAFT,
+    GENERAL,
+    SUMMARY,
+    TaskConfig,
+    finish_reason,
+    parse_reply,
+)
+from .prompt_assembly import prepare_body, token_counts
+from .rules import get_rules
+from .services import services
 
 # Try to import google-generativeai; operate in fallback mode if not present
 GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
+GEMINI_MODEL = "gemini-2.5-flash"
+CATEGORIES = ["Important", "Newsletter", "Spam", "To-Do"]
+
+
+def _create_gemini_client():
+    # google.genai takes about a second to import; pay it on the first call
+    from google import genai
+
+    return genai.Client()
+
 
-if GEMINI_API_KEY:
-    client = genai.Client()
+services.register("gemini", _create_gemini_client)
 
 
-def call_gemini(prompt: str, max_output_tokens: int = 300) -> str:
-    """Wrapper to call Google Gemini."""
+class TruncatedReply(Exception):
+    """A reply cut off at the output cap, where call_gemini may not return one."""
+
+
+def _count_tokens(span, response) -> None:
+    """Add the prompt/response token counts Gemini reported to `span`."""
+    usage = getattr(response, "usage_metadata", None)
+    if usage is None:
+        return
+    span.count(
+        prompt_tokens=getattr(usage, "prompt_token_count", None),
+        response_tokens=getattr(usage, "candidates_token_count", None),
+    )
+
+
+def _finish(span, config: TaskConfig, response) -> bool:
+    """
+    Record the response's token usage on `span`; returns True (and counts a
+    "gemini.overruns" event) if the reply was cut off at the output cap.
+    """
+    _count_tokens(span, response)
+    if finish_reason(response) != "MAX_TOKENS":
+        return False
+    span.set(overrun=True)
+    telemetry.incr("gemini.overruns", task=config.name)
+    return True
+
+
+def call_gemini(
+    prompt: str,
+    config: TaskConfig = GENERAL,
+    use_cache: bool = True,
+    user_email: Optional[str] = None,
+    allow_truncated: bool = True,
+) -> str:
+    """
+    Call Gemini with the generation settings of `config`, served from the
+    response cache when possible. Replies cut off at the output cap are
+    not cached, and returned only if `allow_truncated`; otherwise
+    TruncatedReply is raised.
+    """
     if not GEMINI_API_KEY:
         raise RuntimeError("No GEMINI_API_KEY found. Provide one to enable LLM mode.")
 
-    response = client.models.generate_content(
-        model="gemini-2.5-flash",
-        contents=prompt,
-    )
+    key = llm_cache.cache_key(GEMINI_MODEL, prompt, config.cache_params())
+    if use_cache:
+        cached = llm_cache.lookup(key, user_email)
+        if cached is not None:
+            telemetry.record("gemini.cache_hit", time.time(), 0.0)
+            return cached
 
-    print(response.text)
+    client = services.get("gemini")
+    with telemetry.span("gemini.generate", model=GEMINI_MODEL, task=config.name) as span:
+        response = client.models.generate_content(
+            model=GEMINI_MODEL,
+            contents=prompt,
+            config=config.to_genai(),
+        )
+        truncated = _finish(span, config, response)
+
+    if truncated and not allow_truncated:
+        raise TruncatedReply(f"{config.name} reply hit max_output_tokens")
+    if response.text is not None and not truncated:
+        llm_cache.store(key, response.text, GEMINI_MODEL)
     return response.text
 
 
+def call_gemini_stream(
+    prompt: str,
+    config: TaskConfig = GENERAL,
+    use_cache: bool = True,
+    user_email: Optional[str] = None,
+    timings: Optional[Dict[str, float]] = None,
+) -> Iterator[str]:
+    """
+    Like call_gemini, but yields text chunks as they are generated. If given,
+    `timings` receives "first_token_s" and "total_s".
+    """
+    if not GEMINI_API_KEY:
+        raise RuntimeError("No GEMINI_API_KEY found. Provide one to enable LLM mode.")
+    timings = timings if timings is not None else {}
+    started = time.perf_counter()
+
+    key = llm_cache.cache_key(GEMINI_MODEL, prompt, config.cache_params())
+    if use_cache:
+        cached = llm_cache.lookup(key, user_email)
+        if cached is not None:
+            elapsed = time.perf_counter() - started
+            timings["first_token_s"] = timings["total_s"] = elapsed
+            telemetry.record("gemini.cache_hit", time.time(), elapsed * 1000)
+            yield cached
+            return
+
+    client = services.get("gemini")
+    chunks = []
+    with telemetry.span("gemini.stream", model=GEMINI_MODEL, task=config.name) as span:
+        last = None
+        for chunk in client.models.generate_content_stream(
+            model=GEMINI_MODEL,
+            contents=prompt,
+            config=config.to_genai(),
+        ):
+            last = chunk
+            if not chunk.text:
+                continue
+            if not chunks:
+                timings["first_token_s"] = time.perf_counter() - started
+                span.set(first_token_ms=round(timings["first_token_s"] * 1000, 1))
+            chunks.append(chunk.text)
+            yield chunk.text
+        # usage_metadata and finish_reason arrive with the final chunk
+        truncated = _finish(span, config, last)
+    timings["total_s"] = time.perf_counter() - started
+
+    if chunks and not truncated:
+        llm_cache.store(key, "".join(chunks), GEMINI_MODEL)
+
+
 def simple_categorize(email: Dict[str, Any], categorization_prompt: str) -> str:
-    subj = (email.get("subject") or "").lower()
-    body = (email.get("body") or "").lower()
-    if "unsubscribe" in body or "newsletter" in subj:
-        return "Newsletter"
-    if "sale" in body or "free" in body:
-        return "Spam"
-    if any(w in body for w in ["please", "could you", "kindly", "deadline", "due"]):
-        return "To-Do"
-    return "Important"
+    return get_rules().categorize(email)["category"]
 
 
 def simple_extract_actions(email: Dict[str, Any], action_prompt: str):
-    body = email.get("body", "")
-    tasks = []
-    for line in body.splitlines():
-        l = line.strip().lower()
-        if l.startswith(("please", "could you", "kindly", "review", "update", "send")):
-            tasks.append({"task": line.strip(), "deadline": "", "assignee": ""})
-    return tasks
+    return get_rules().extract_actions(email)
+
+
+# ---------------- LLM CATEGORIZER / EXTRACTOR ----------------
+def format_email_block(email: Dict[str, Any], task: str = "categorize") -> str:
+    return (
+        f"From: {email.get('sender', '')}\n"
+        f"Subject: {email.get('subject', '')}\n\n"
+        f"Body:\n{prepare_body(email.get('body', ''), task)}"
+    )
+
+
+def match_category(txt: str, categories=CATEGORIES) -> str:
+    """Map a free-text model reply onto one of `categories`."""
+    reply = (txt or "").strip().strip(".").lower()
+    for cat in categories:
+        if reply == cat.lower():
+            return cat
+    for cat in categories:
+        if cat.lower() in reply:
+            return cat
+    return (txt or "").strip() or "Important"
+
+
+def build_categorization_prompt(
+    email: Dict[str, Any], categorization_prompt: str
+) -> str:
+    return (
+        categorization_prompt
+        + "\nRespond with the category name only.\n\n"
+        + format_email_block(email)
+    )
+
+
+def build_action_prompt(email: Dict[str, Any], action_prompt: str) -> str:
+    return (
+        action_prompt
+        + "\nRespond with JSON only.\n\n"
+        + format_email_block(email, "actions")
+    )
+
+
+def llm_categorize(email: Dict[str, Any], categorization_prompt: str, llm) -> str:
+    """
+    Categorize with the user's prompt; `llm` is any callable(prompt, config)
+    -> str, where config is the request's generation.TaskConfig.
+    """
+    reply = llm(build_categorization_prompt(email, categorization_prompt), CATEGORIZE)
+    return match_category(reply)
+
+
+def llm_extract_actions(email: Dict[str, Any], action_prompt: str, llm):
+    txt = llm(build_action_prompt(email, action_prompt), ACTIONS)
+    try:
+        return parse_reply(ACTIONS, txt)
+    except ValueError:
+        return [{"task": txt.strip(), "deadline": "", "assignee": ""}] if txt else []
 
 
 # ---------------- HIGH-LEVEL AGENT ----------------
-def run_agent_on_email(email: Dict[str, Any], user_query: str, prompts: Dict[str, str]):
-    body = email.get("body", "")
+def _plan(config: TaskConfig, prompt: str, raw_body: str, body: str):
+    return {
+        "task": config.name,
+        "prompt": prompt,
+        "config": config,
+        "input_tokens": token_counts(prompt, raw_body, body),
+    }
+
+
+def plan_agent_task(
+    email: Dict[str, Any], user_query: str, prompts: Dict[str, str]
+) -> Dict[str, Any]:
+    """
+    Work out which task a query asks for and the Gemini prompt for it. The
+    prompt carries only that task's template and the cleaned, budgeted
+    body; `input_tokens` estimates its size before and after cleaning.
+    """
+    raw_body = email.get("body", "")
     subject = email.get("subject", "")
+    query = (user_query or "").lower().strip()
 
     # --- Summaries ---
-    if not user_query or user_query.lower().strip() == "summarize this email":
-        if GEMINI_API_KEY:
-            txt = call_gemini(
-                f"Summarize the following email:\n\nSubject: {subject}\n\nBody:\n{body}"
-            )
-            return {"text": txt}
-        else:
-            return {"text": " ".join(body.split()[:50]) + "..."}
+    if not query or query == "summarize this email":
+        body = prepare_body(raw_body, "summary")
+        return _plan(
+            SUMMARY,
+            f"Summarize the following email:\n\nSubject: {subject}\n\nBody:\n{body}",
+            raw_body,
+            body,
+        )
 
     # --- Task Extraction ---
-    if "task" in user_query.lower() or "todo" in user_query.lower():
-        if GEMINI_API_KEY:
-            txt = call_gemini(prompts["action_item"] + "\n\nEmail:\n" + body)
-            try:
-                parsed = json.loads(txt)
-            except:
-                parsed = {"raw": txt}
-            return {"structured": True, "actions": parsed}
-        else:
-            return {
-                "structured": True,
-                "actions": simple_extract_actions(
-                    email, prompts.get("action_item", "")
-                ),
-            }
+    if "task" in query or "todo" in query:
+        body = prepare_body(raw_body, "actions")
+        return _plan(
+            ACTIONS,
+            prompts["action_item"] + "\n\nEmail:\n" + body,
+            raw_body,
+            body,
+        )
 
     # --- Draft Reply ---
-    if "reply" in user_query.lower() or "draft" in user_query.lower():
+    if "reply" in query or "draft" in query:
+        body = prepare_body(raw_body, "draft")
         tone = ""
-        if "tone:" in user_query.lower():
+        if "tone:" in query:
             tone = user_query.split("tone:")[-1].strip()
-
-        if GEMINI_API_KEY:
-            prompt = (
-                prompts.get("auto_reply", "")
-                + f"\nTone: {tone}\n\nEmail Subject: {subject}\nEmail Body:\n{body}"
-            )
-            txt = call_gemini(prompt, max_output_tokens=400)
-
-            # Expect JSON
-            try:
-                draft = json.loads(txt)
-            except:
-                draft = {"subject": "Re: " + subject, "body": txt}
-            return {"draft": draft, "text": "Draft created", "structured": True}
-        else:
-            draft = {
-                "subject": "Re: " + subject,
-                "body": "Thanks for reaching out — I’ll get back to you soon.",
-            }
-            return {"draft": draft, "structured": True}
+        instructions = prompts.get("auto_reply", "")
+        if tone and prompts.get("tone_instructions"):
+            instructions += "\n" + prompts["tone_instructions"]
+        return _plan(
+            DRAFT,
+            instructions
+            + f"\nTone: {tone}\n\nEmail Subject: {subject}\nEmail Body:\n{body}",
+            raw_body,
+            body,
+        )
 
     # --- General Query ---
-    if GEMINI_API_KEY:
-        prompt = (
-            f"User query: {user_query}\n\n"
-            f"Email:\nSubject: {subject}\n{body}\n\n"
-            f"Use these prompts:\n{prompts}"
-        )
-        txt = call_gemini(prompt)
-        return {"text": txt}
+    body = prepare_body(raw_body, "general")
+    return _plan(
+        GENERAL,
+        f"User query: {user_query}\n\nEmail:\nSubject: {subject}\n{body}",
+        raw_body,
+        body,
+    )
+
+
+def build_agent_result(plan: Dict[str, Any], txt: str, email: Dict[str, Any]):
+    """Turn the model's reply for `plan` into the agent response dict."""
+    if plan["task"] == "actions":
+        try:
+            parsed = parse_reply(ACTIONS, txt)
+        except ValueError:
+            parsed = {"raw": txt}
+        return {"structured": True, "actions": parsed}
+
+    if plan["task"] == "draft":
+        try:
+            draft = parse_reply(DRAFT, txt)
+        except ValueError:
+            draft = {"subject": "Re: " + email.get("subject", ""), "body": txt}
+        return {"draft": draft, "text": "Draft created", "structured": True}
+
+    return {"text": txt}
+
+
+def offline_agent_result(
+    plan: Dict[str, Any], email: Dict[str, Any], prompts: Dict[str, str]
+):
+    """What the agent can answer without Gemini."""
+    if plan["task"] == "summary":
+        return {"text": " ".join(email.get("body", "").split()[:50]) + "..."}
+    if plan["task"] == "actions":
+        return {
+            "structured": True,
+            "actions": simple_extract_actions(email, prompts.get("action_item", "")),
+        }
+    if plan["task"] == "draft":
+        draft = {
+            "subject": "Re: " + email.get("subject", ""),
+            "body": "Thanks for reaching out — I’ll get back to you soon.",
+        }
+        return {"draft": draft, "structured": True}
     return {"text": "Gemini not configured; offline mode is limited."}
+
+
+def run_agent_on_email(
+    email: Dict[str, Any],
+    user_query: str,
+    prompts: Dict[str, str],
+    user_email: Optional[str] = None,
+):
+    plan = plan_agent_task(email, user_query, prompts)
+    if not GEMINI_API_KEY:
+        return offline_agent_result(plan, email, prompts)
+    txt = call_gemini(plan["prompt"], plan["config"], user_email=user_email)
+    return build_agent_result(plan, txt, email)
+
+
+class AgentStream:
+    """
+    Streaming counterpart of run_agent_on_email. Iterating yields text
+    chunks as Gemini produces them; once exhausted, `result` holds the same
+    dict run_agent_on_email would return and `timings` holds
+    time-to-first-token and total latency in seconds.
+    """
+
+    def __init__(
+        self,
+        email: Dict[str, Any],
+        user_query: str,
+        prompts: Dict[str, str],
+        user_email: Optional[str] = None,
+    ):
+        self.email = email
+        self.prompts = prompts
+        self.user_email = user_email
+        self.plan = plan_agent_task(email, user_query, prompts)
+        self.result: Optional[Dict[str, Any]] = None
+        self.timings: Dict[str, float] = {}
+
+    def __iter__(self) -> Iterator[str]:
+        if not GEMINI_API_KEY:
+            self.result = offline_agent_result(self.plan, self.email, self.prompts)
+            if self.result.get("text"):
+                yield self.result["text"]
+            return
+        chunks = []
+        for chunk in call_gemini_stream(
+            self.plan["prompt"],
+            self.plan["config"],
+            user_email=self.user_email,
+            timings=self.timings,
+        ):
+            chunks.append(chunk)
+            yield chunk
+        self.result = build_agent_result(self.plan, "".join(chunks), self.email)
+
+
+def stream_agent_on_email(
+    email: Dict[str, Any],
+    user_query: str,
+    prompts: Dict[str, str],
+    user_email: Optional[str] = None,
+) -> AgentStream:
+    return AgentStream(email, user_query, prompts, user_email)
+
+
+# ---------------- ASK ACROSS INBOX ----------------
+def ask_inbox(
+    question: str,
+    index,
+    k: int = 8,
+    max_context_chars: int = 6000,
+    user_email: Optional[str] = None,
+) -> Dict[str, Any]:
+    """
+    Answer a question about the whole mailbox from its top-k retrieved
+    chunks. Only those chunks reach Gemini, so the prompt stays within
+    `max_context_chars` however large the inbox is.
+
+    The index is process-local: forget_emails() only drops deleted mail from
+    the index of the process that ran the sync, so an index held by another
+    process (e.g. a job worker) may still return it until rebuilt.
+    """
+    hits = index.query(question, k=k)
+    context, used = [], 0
+    for n, hit in enumerate(hits, start=1):
+        block = f"[{n}] {hit['text']}"
+        if used + len(block) > max_context_chars:
+            break
+        context.append(block)
+        used += len(block)
+    sources = hits[: len(context)]
+
+    if not GEMINI_API_KEY:
+        return {
+            "text": "Gemini not configured; showing the most relevant emails.",
+            "sources": sources,
+        }
+    if not context:
+        return {"text": "No matching emails found.", "sources": []}
+
+    prompt = (
+        "Answer the question using only the email excerpts below. Cite excerpts "
+        "by their [number]. If they do not contain the answer, say so.\n\n"
+        f"Question: {question}\n\nExcerpts:\n" + "\n\n".join(context)
+    )
+    return {
+        "text": call_gemini(prompt, ASK_INBOX, user_email=user_email),
+        "sources": sources,
+    }
@@ -0,0 +1,175 @@
+import logging
+from typing import Any, Callable, Dict, List, Optional
+
+from .agent import (
+    CATEGORIES,
+    format_email_block,
+    llm_categorize,
+    llm_extract_actions,
+    match_category,
+)
+from .generation import BATCH_ACTIONS, BATCH_CATEGORIZE, TaskConfig, parse_reply
+from .rate_limit import LLMUsage, estimate_tokens
+
+log = logging.getLogger(__name__)
+
+# Prompt tokens allowed per batched request; K adapts to fit it.
+DEFAULT_TOKEN_BUDGET = 8000
+MAX_BATCH_SIZE = 20
+# id marker, separators and the JSON entry each email adds to the reply
+PER_EMAIL_OVERHEAD_TOKENS = 12
+BATCH_FRAME_TOKENS = 80
+
+
+def plan_batches(
+    emails: List[Dict[str, Any]],
+    instruction: str,
+    token_budget: int = DEFAULT_TOKEN_BUDGET,
+    max_batch_size: int = MAX_BATCH_SIZE,
+    task: str = "categorize",
+) -> List[List[Dict[str, Any]]]:
+    """
+    Greedily pack emails into batches that fit `token_budget` prompt tokens,
+    with bodies cut to `task`'s budget as build_batch_prompt() sends them.
+    """
+    frame = estimate_tokens(instruction) + BATCH_FRAME_TOKENS
+    batches, current, used = [], [], frame
+    for email in emails:
+        cost = (
+            estimate_tokens(format_email_block(email, task))
+            + PER_EMAIL_OVERHEAD_TOKENS
+        )
+        if current and (used + cost > token_budget or len(current) >= max_batch_size):
+            batches.append(current)
+            current, used = [], frame
+        current.append(email)
+        used += cost
+    if current:
+        batches.append(current)
+    return batches
+
+
+def build_batch_prompt(
+    instruction: str,
+    emails: List[Dict[str, Any]],
+    result_shape: str,
+    task: str = "categorize",
+) -> str:
+    """One prompt covering every email; emails are tagged E1..EK."""
+    parts = [
+        instruction,
+        "",
+        f"Below are {len(emails)} emails, each starting with its id line.",
+        "Apply the instructions to each email separately. Respond with ONLY a "
+        "JSON array holding exactly one object per email, shaped like "
+        f"{result_shape}.",
+    ]
+    for i, email in enumerate(emails, start=1):
+        parts.append(f"\n=== id: E{i} ===\n{format_email_block(email, task)}")
+    return "\n".join(parts)
+
+
+def parse_batch_reply(config, txt: str, n: int) -> Dict[int, Dict[str, Any]]:
+    """
+    Map a batched JSON reply, validated against `config`'s schema, to
+    {email index: entry}; unknown ids are dropped.
+    """
+    try:
+        parsed = parse_reply(config, txt)
+    except ValueError:
+        return {}
+    out = {}
+    for entry in parsed:
+        ident = str(entry.get("id", "")).strip().upper().lstrip("E")
+        if ident.isdigit() and 1 <= int(ident) <= n:
+            out[int(ident) - 1] = entry
+    return out
+
+
+def _single(fn):
+    try:
+        return fn()
+    except Exception as e:
+        log.warning("Individual LLM request failed: %s", e)
+        return None
+
+
+def _fallback(fn, usage: LLMUsage):
+    usage.add(fallback_requests=1)
+    return _single(fn)
+
+
+def categorize_batch(
+    emails: List[Dict[str, Any]],
+    categorization_prompt: str,
+    llm: Callable[[str, TaskConfig], str],
+    usage: LLMUsage,
+    categories: List[str] = CATEGORIES,
+) -> List[Optional[str]]:
+    """Categories from one request; missing entries are re-asked one by one."""
+    if len(emails) == 1:
+        email = emails[0]
+        return [_single(lambda: llm_categorize(email, categorization_prompt, llm))]
+
+    usage.add(batched_requests=1)
+    config = BATCH_CATEGORIZE.scaled(len(emails))
+    reply = llm(
+        build_batch_prompt(
+            categorization_prompt,
+            emails,
+            '{"id": "E1", "category": "<category>"}',
+            "categorize",
+        ),
+        config,
+    )
+    entries = parse_batch_reply(config, reply, len(emails))
+    results = []
+    for i, email in enumerate(emails):
+        value = entries.get(i, {}).get("category")
+        if isinstance(value, str) and value.strip():
+            results.append(match_category(value, categories))
+        else:
+            results.append(
+                _fallback(
+                    lambda: llm_categorize(email, categorization_prompt, llm), usage
+                )
+            )
+    return results
+
+
+def extract_actions_batch(
+    emails: List[Dict[str, Any]],
+    action_prompt: str,
+    llm: Callable[[str, TaskConfig], str],
+    usage: LLMUsage,
+) -> List[Optional[List[Dict[str, Any]]]]:
+    """Action items from one request; missing entries are re-asked one by one."""
+    if len(emails) == 1:
+        email = emails[0]
+        return [_single(lambda: llm_extract_actions(email, action_prompt, llm))]
+
+    usage.add(batched_requests=1)
+    config = BATCH_ACTIONS.scaled(len(emails))
+    reply = llm(
+        build_batch_prompt(
+            action_prompt,
+            emails,
+            '{"id": "E1", "actions": '
+            '[{"task": "...", "deadline": "...", "assignee": "..."}]}',
+            "actions",
+        ),
+        config,
+    )
+    entries = parse_batch_reply(config, reply, len(emails))
+    results = []
+    for i, email in enumerate(emails):
+        value = entries.get(i, {}).get("actions")
+        if isinstance(value, list):
+            results.append(value)
+        else:
+            results.append(
+                _fallback(
+                    lambda: llm_extract_actions(email, action_prompt, llm), usage
+                )
+            )
+    return results
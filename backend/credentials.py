@@ -0,0 +1,230 @@
+"""
+Per-user Google credentials and cached Gmail clients.
+
+Sign-in stores each user's refresh token and current access token,
+encrypted with Fernet, in their `users` document. gmail_service() hands
+out one Gmail client per user from a bounded LRU, built once from the
+static discovery document, and refreshes the access token shortly before
+it expires, so sessions and background jobs outlive the access token's
+hour.
+
+The encryption key is TOKEN_ENCRYPTION_KEY (Streamlit secrets or the
+environment), a Fernet key as printed by
+`python -c "from cryptography.fernet import Fernet; print(Fernet.generate_key().decode())"`.
+"""
+
+import logging
+import threading
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Optional
+
+import google_auth_httplib2
+import httplib2
+from cachetools import LRUCache
+from cryptography.fernet import Fernet, InvalidToken
+from google.auth.exceptions import RefreshError
+from google.auth.transport.requests import Request
+from google.oauth2.credentials import Credentials
+from googleapiclient.discovery import build
+from googleapiclient.http import HttpRequest
+
+from . import telemetry
+from .mongo_db import get_db
+from .services import services, setting
+
+log = logging.getLogger(__name__)
+
+TOKEN_URL = "https://oauth2.googleapis.com/token"
+# Access tokens with less than this long left are refreshed before use.
+REFRESH_AHEAD_SECONDS = 300
+# Gmail clients kept, one per user, least recently used dropped first.
+SERVICE_CACHE_SIZE = 64
+
+
+def client_config() -> Dict[str, str]:
+    """The app's Google OAuth client: client_id, client_secret, redirect_uri."""
+    # These should be stored securely; Streamlit secrets is recommended (st.secrets)
+    config = {
+        "client_id": setting("GOOGLE_CLIENT_ID"),
+        "client_secret": setting("GOOGLE_CLIENT_SECRET"),
+        "redirect_uri": setting("REDIRECT_URI"),
+    }
+    if not all(config.values()):
+        raise RuntimeError(
+            "GOOGLE_CLIENT_ID, GOOGLE_CLIENT_SECRET and REDIRECT_URI not found "
+            "in Streamlit secrets or environment."
+        )
+    return config
+
+
+def _create_fernet() -> Fernet:
+    key = setting("TOKEN_ENCRYPTION_KEY")
+    if not key:
+        raise RuntimeError(
+            "TOKEN_ENCRYPTION_KEY not found in Streamlit secrets or environment."
+        )
+    return Fernet(key)
+
+
+services.register("token_fernet", _create_fernet)
+
+
+def _encrypt(value: Optional[str]) -> Optional[str]:
+    if not value:
+        return None
+    return services.get("token_fernet").encrypt(value.encode("utf-8")).decode("ascii")
+
+
+def _decrypt(value: Optional[str]) -> Optional[str]:
+    if not value:
+        return None
+    try:
+        return services.get("token_fernet").decrypt(value.encode("ascii")).decode()
+    except InvalidToken:
+        raise RuntimeError(
+            "Stored Gmail credentials cannot be decrypted (was "
+            "TOKEN_ENCRYPTION_KEY changed?). Please sign in again."
+        ) from None
+
+
+def _utcnow() -> datetime:
+    # google-auth keeps expiry as a naive UTC datetime
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+# ---------------- STORE ----------------
+def save_credentials(user_email: str, creds: Credentials, db=None) -> None:
+    """
+    Store `creds` encrypted. A refresh without a new refresh token keeps
+    the stored one.
+    """
+    db = db if db is not None else get_db()
+    fields: Dict[str, Any] = {
+        "credentials.access_token": _encrypt(creds.token),
+        "credentials.expiry": creds.expiry,
+        "credentials.scopes": list(creds.scopes or []),
+        "credentials.updated_at": _utcnow(),
+    }
+    if creds.refresh_token:
+        fields["credentials.refresh_token"] = _encrypt(creds.refresh_token)
+    db.users.update_one(
+        {"email": user_email},
+        # plaintext tokens of earlier sign-ins are dropped
+        {"$set": fields, "$unset": {"access_token": ""}},
+        upsert=True,
+    )
+
+
+def load_credentials(user_email: str, db=None) -> Credentials:
+    """The user's stored credentials; RuntimeError if they have none."""
+    db = db if db is not None else get_db()
+    user = db.users.find_one(
+        {"email": user_email}, {"credentials": 1, "access_token": 1}
+    )
+    stored = (user or {}).get("credentials")
+    if not stored:
+        if user and user.get("access_token"):
+            # signed in before refresh tokens were kept: works until it expires
+            return Credentials(token=user["access_token"])
+        raise RuntimeError(f"No stored Gmail token for {user_email}.")
+    config = client_config()
+    return Credentials(
+        token=_decrypt(stored.get("access_token")),
+        refresh_token=_decrypt(stored.get("refresh_token")),
+        token_uri=TOKEN_URL,
+        client_id=config["client_id"],
+        client_secret=config["client_secret"],
+        scopes=stored.get("scopes") or None,
+        expiry=stored.get("expiry"),
+    )
+
+
+def needs_refresh(
+    creds: Credentials, ahead_seconds: int = REFRESH_AHEAD_SECONDS
+) -> bool:
+    """Whether the access token is missing or expires within `ahead_seconds`."""
+    if not creds.refresh_token:
+        return False  # nothing to refresh with
+    if not creds.token or creds.expiry is None:
+        return True
+    return creds.expiry - _utcnow() < timedelta(seconds=ahead_seconds)
+
+
+# ---------------- GMAIL CLIENTS ----------------
+_http_local = threading.local()
+
+
+def _thread_http() -> httplib2.Http:
+    # httplib2.Http is not thread-safe: one per thread, reused for keep-alive
+    http = getattr(_http_local, "http", None)
+    if http is None:
+        http = _http_local.http = httplib2.Http()
+    return http
+
+
+def _build_gmail(creds: Credentials):
+    """
+    Gmail client from the discovery document bundled with the client
+    library (no discovery request). Each request gets the calling thread's
+    connection, so one client can be shared by job worker threads.
+    """
+
+    def _request(http, *args, **kwargs):
+        authorized = google_auth_httplib2.AuthorizedHttp(creds, http=_thread_http())
+        return HttpRequest(authorized, *args, **kwargs)
+
+    return build(
+        "gmail",
+        "v1",
+        http=google_auth_httplib2.AuthorizedHttp(creds, http=_thread_http()),
+        requestBuilder=_request,
+        static_discovery=True,
+        cache_discovery=False,
+    )
+
+
+class _Client:
+    def __init__(self, creds: Credentials):
+        self.creds = creds
+        self.service = _build_gmail(creds)
+        self.lock = threading.Lock()
+
+
+_clients: "LRUCache[str, _Client]" = LRUCache(maxsize=SERVICE_CACHE_SIZE)
+_clients_lock = threading.Lock()
+
+
+def _refresh(user_email: str, client: _Client, db=None) -> None:
+    # one refresh per user at a time; the others reuse its token
+    with client.lock:
+        if not needs_refresh(client.creds):
+            return
+        try:
+            with telemetry.span("google.refresh_token"):
+                client.creds.refresh(Request())
+        except RefreshError as e:
+            forget_gmail_service(user_email)
+            raise RuntimeError(
+                f"Gmail access for {user_email} was revoked or expired. "
+                "Please sign in again."
+            ) from e
+        save_credentials(user_email, client.creds, db)
+
+
+def gmail_service(user_email: str, db=None):
+    """The user's Gmail client, with an access token valid for a while yet."""
+    with _clients_lock:
+        client = _clients.get(user_email)
+    if client is None:
+        fresh = _Client(load_credentials(user_email, db))
+        with _clients_lock:
+            client = _clients.setdefault(user_email, fresh)
+    if needs_refresh(client.creds):
+        _refresh(user_email, client, db)
+    return client.service
+
+
+def forget_gmail_service(user_email: str) -> None:
+    """Drop the cached client, e.g. after the user signed in again."""
+    with _clients_lock:
+        _clients.pop(user_email, None)
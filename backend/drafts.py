@@ -1,7 +1,45 @@
-from .mongo_db import get_db
+"""
+Drafts saved by the agent, and the bulk auto-draft pipeline for To-Do mail.
+
+Every auto draft is one `drafts` document keyed on (user_email,
+source_email_id) and guarded by a unique index, so a source email gets at
+most one draft however often (or concurrently) the pipeline runs. The
+document moves through GENERATING -> GENERATED -> PUSHING -> PUSHED, each step
+claimed by one run; a rerun only redoes what an earlier run did not finish.
+drafts.create is not idempotent, so a push that failed or never reported
+back is UNCONFIRMED: Gmail may have the draft all the same, and the next
+push looks for it there before creating another.
+"""
+
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Callable, Dict, List, Optional
+
 import streamlit as st
-from typing import Dict, Any
-from .gmail_loader import create_gmail_draft
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from . import agent, telemetry
+from .gmail_fetch import execute_batched
+from .gmail_loader import create_gmail_draft, draft_payload, ensure_bodies
+from .inbox import get_emails
+from .ingestion import get_processed, rate_limited
+from .mongo_db import get_db
+from .rate_limit import LLMUsage, RateLimiter, get_gemini_limiter
+from .storage import bulk_upsert
+
+GENERATING = "generating"
+GENERATED = "generated"
+PUSHING = "pushing"
+PUSHED = "pushed"
+UNCONFIRMED = "unconfirmed"
+FAILED = "failed"
+# A GENERATING or PUSHING claim not finished within this long (a crashed or
+# killed run) may be taken over by the next run.
+CLAIM_TIMEOUT_SECONDS = 600
+DEFAULT_MAX_WORKERS = 4
+DRAFT_QUERY = "Draft a reply"
 
 
 def save_draft_to_db(draft: Dict[str, Any], push_to_gmail: bool = False):
@@ -20,7 +58,7 @@ def save_draft_to_db(draft: Dict[str, Any], push_to_gmail: bool = False):
         "subject": draft.get("subject"),
         "body": draft.get("body"),
         "meta": draft.get("meta", {}),
-        "created_at": int(__import__("time").time()),
+        "created_at": int(time.time()),
     }
 
     # Insert to Mongo
@@ -30,7 +68,11 @@ def save_draft_to_db(draft: Dict[str, Any], push_to_gmail: bool = False):
     # Optionally create a Gmail draft and record the gmail_draft_id
     if push_to_gmail:
         res2 = create_gmail_draft(
-            doc["subject"], doc["body"], to_addr=doc["meta"].get("to")
+            doc["subject"],
+            doc["body"],
+            to_addr=doc["meta"].get("to"),
+            thread_id=doc["meta"].get("thread_id"),
+            in_reply_to=doc["meta"].get("in_reply_to"),
         )
         # update doc with gmail_draft_id
         db.drafts.update_one(
@@ -40,3 +82,343 @@ def save_draft_to_db(draft: Dict[str, Any], push_to_gmail: bool = False):
         doc["gmail_draft_id"] = res2["gmail_draft_id"]
 
     return doc
+
+
+# ---------------- AUTO DRAFTS ----------------
+def todo_email_ids(user_email: str) -> List[str]:
+    """Ids of the user's emails that ingestion categorized as To-Do."""
+    return [
+        d["email_id"]
+        for d in get_processed(
+            None, user_email, {"_id": 0, "email_id": 1, "category": 1}
+        )
+        if d.get("category") == "To-Do"
+    ]
+
+
+def claim_sources(
+    user_email: str, email_ids: List[str], db=None, now: Optional[float] = None
+) -> List[str]:
+    """
+    Claim the source emails that have no draft yet (or only a failed or
+    abandoned attempt) for this run. Returns the claimed ids; the rest
+    already have a draft or are being drafted by another run.
+    """
+    db = db if db is not None else get_db()
+    now = now if now is not None else time.time()
+    token = uuid.uuid4().hex
+    claim = {"status": GENERATING, "claim": token, "claimed_at": now}
+    if email_ids:
+        ops = [
+            UpdateOne(
+                {"user_email": user_email, "source_email_id": email_id},
+                {"$setOnInsert": {**claim, "created_at": int(now)}},
+                upsert=True,
+            )
+            for email_id in email_ids
+        ]
+        try:
+            db.drafts.bulk_write(ops, ordered=False)
+        except BulkWriteError as e:
+            # a racing run inserted some of the same keys first; those are its
+            if any(err.get("code") != 11000 for err in e.details["writeErrors"]):
+                raise
+        db.drafts.update_many(
+            {
+                "user_email": user_email,
+                "source_email_id": {"$in": list(email_ids)},
+                "$or": [
+                    {"status": FAILED},
+                    {
+                        "status": GENERATING,
+                        "claimed_at": {"$lt": now - CLAIM_TIMEOUT_SECONDS},
+                    },
+                ],
+            },
+            {"$set": claim},
+        )
+    return [
+        d["source_email_id"]
+        for d in db.drafts.find(
+            {"user_email": user_email, "claim": token, "status": GENERATING},
+            {"_id": 0, "source_email_id": 1},
+        )
+    ]
+
+
+def generate_replies(
+    emails: List[Dict[str, Any]],
+    prompts: Dict[str, str],
+    llm: Optional[Callable[[str, Any], str]] = None,
+    max_workers: int = DEFAULT_MAX_WORKERS,
+    limiter: Optional[RateLimiter] = None,
+    usage: Optional[LLMUsage] = None,
+    on_done: Optional[Callable[[str, Dict[str, Any]], None]] = None,
+    should_stop: Optional[Callable[[], bool]] = None,
+    user_email: Optional[str] = None,
+) -> Dict[str, Dict[str, Any]]:
+    """
+    Draft a reply to each email, `max_workers` Gemini calls at a time within
+    the shared rate budget. Returns {email_id: {"subject", "body"}} or
+    {email_id: {"error"}}; offline (no `llm`, no GEMINI_API_KEY) uses the
+    agent's canned reply. Gemini's cache counters go to `user_email`.
+    """
+    plans = {
+        e["email_id"]: agent.plan_agent_task(e, DRAFT_QUERY, prompts) for e in emails
+    }
+    by_id = {e["email_id"]: e for e in emails}
+    results: Dict[str, Dict[str, Any]] = {}
+
+    def _finish(email_id, result):
+        results[email_id] = result
+        if on_done:
+            on_done(email_id, result)
+
+    if llm is None and not agent.GEMINI_API_KEY:
+        for email_id, plan in plans.items():
+            result = agent.offline_agent_result(plan, by_id[email_id], prompts)
+            _finish(email_id, result["draft"])
+        return results
+    if llm is None:
+        # resolve the user here: worker threads have no Streamlit session
+        user_email = user_email or st.session_state.get("user_email")
+
+        def llm(prompt, config):
+            return agent.call_gemini(prompt, config, user_email=user_email)
+
+    call = rate_limited(llm, limiter or get_gemini_limiter(), usage or LLMUsage())
+
+    def _draft(email_id):
+        if should_stop and should_stop():
+            return None
+        plan = plans[email_id]
+        txt = call(plan["prompt"], plan["config"])
+        return agent.build_agent_result(plan, txt, by_id[email_id])["draft"]
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {pool.submit(telemetry.propagate(_draft), i): i for i in plans}
+        for future in as_completed(futures):
+            email_id = futures[future]
+            try:
+                draft = future.result()
+            except Exception as e:
+                _finish(email_id, {"error": str(e)})
+                continue
+            if draft is not None:
+                _finish(email_id, draft)
+    return results
+
+
+def find_gmail_drafts(
+    service, docs: List[Dict[str, Any]], **kwargs
+) -> Dict[Any, Optional[str]]:
+    """
+    Look in Gmail for drafts that earlier pushes of `docs` may have created:
+    {doc _id: Gmail draft id, or None if there is none}, without the docs
+    whose lookup failed. A draft counts if it has the doc's subject and is
+    in its thread. Extra kwargs go to execute_batched.
+    """
+
+    def _make(doc):
+        subject = (doc.get("subject") or "").replace('"', "")
+        return (
+            service.users()
+            .drafts()
+            .list(userId="me", q=f'subject:"{subject}"' if subject else None)
+        )
+
+    batch = execute_batched(service, docs, _make, **kwargs)
+    found: Dict[Any, Optional[str]] = {}
+    for doc, response in zip(docs, batch.results):
+        if response is None:
+            continue
+        thread_id = doc.get("meta", {}).get("thread_id")
+        found[doc["_id"]] = next(
+            (
+                d["id"]
+                for d in response.get("drafts", [])
+                if not thread_id or d.get("message", {}).get("threadId") == thread_id
+            ),
+            None,
+        )
+    return found
+
+
+def push_drafts(
+    service, user_email: str, email_ids: Optional[List[str]] = None, db=None, **kwargs
+) -> Dict[str, int]:
+    """
+    Create Gmail drafts, in batched requests, for the generated drafts that
+    do not have one yet (all of the user's, or those of `email_ids`), and
+    record their Gmail ids. Drafts are claimed as PUSHING first so that two
+    runs never create the same one twice. Creates are not retried: a failed
+    one may still have made the draft, so it is marked UNCONFIRMED and the
+    next push first looks for it in Gmail. Extra kwargs go to
+    execute_batched.
+    """
+    db = db if db is not None else get_db()
+    now = time.time()
+    token = uuid.uuid4().hex
+    query: Dict[str, Any] = {
+        "user_email": user_email,
+        "$or": [
+            {"status": {"$in": [GENERATED, UNCONFIRMED]}},
+            {"status": PUSHING, "claimed_at": {"$lt": now - CLAIM_TIMEOUT_SECONDS}},
+        ],
+    }
+    if email_ids is not None:
+        query["source_email_id"] = {"$in": list(email_ids)}
+    db.drafts.update_many(
+        query,
+        {
+            "$set": {"status": PUSHING, "claim": token, "claimed_at": now},
+            "$inc": {"push_attempts": 1},
+        },
+    )
+    docs = list(
+        db.drafts.find({"user_email": user_email, "claim": token, "status": PUSHING})
+    )
+    if not docs:
+        return {"pushed": 0, "push_failed": 0}
+
+    # an earlier attempt (failed, or its run died while PUSHING) may have
+    # created the draft: only create it if Gmail has none
+    retries = [d for d in docs if d.get("push_attempts", 1) > 1]
+    found = find_gmail_drafts(service, retries, **kwargs) if retries else {}
+    pushed_at = int(time.time())
+
+    def _pushed(doc, gmail_draft_id):
+        update = {
+            "$set": {
+                "status": PUSHED,
+                "gmail_draft_id": gmail_draft_id,
+                "pushed_at": pushed_at,
+            },
+            "$unset": {"push_error": ""},
+        }
+        return UpdateOne({"_id": doc["_id"]}, update)
+
+    ops = []
+    create = []
+    pushed = 0
+    for doc in docs:
+        if found.get(doc["_id"]):
+            ops.append(_pushed(doc, found[doc["_id"]]))
+            pushed += 1
+        elif doc["_id"] in found or doc.get("push_attempts", 1) == 1:
+            create.append(doc)
+        else:
+            # Gmail could not be asked; the next push asks again
+            unconfirmed = {"$set": {"status": UNCONFIRMED}}
+            ops.append(UpdateOne({"_id": doc["_id"]}, unconfirmed))
+
+    def _make(doc):
+        meta = doc.get("meta", {})
+        payload = draft_payload(
+            user_email,
+            meta.get("to"),
+            doc["subject"],
+            doc["body"],
+            meta.get("thread_id"),
+            meta.get("in_reply_to"),
+        )
+        return service.users().drafts().create(userId="me", body=payload)
+
+    batch = execute_batched(service, create, _make, **{**kwargs, "max_retries": 0})
+    for index, (doc, response) in enumerate(zip(create, batch.results)):
+        if response is not None:
+            ops.append(_pushed(doc, response.get("id")))
+        else:
+            error = batch.errors.get(index, "no response")
+            update = {"$set": {"status": UNCONFIRMED, "push_error": str(error)}}
+            ops.append(UpdateOne({"_id": doc["_id"]}, update))
+    db.drafts.bulk_write(ops, ordered=False)
+    pushed += len(batch.ok)
+    return {"pushed": pushed, "push_failed": len(docs) - pushed}
+
+
+def auto_draft_todos(
+    user_email: str,
+    prompts: Dict[str, str],
+    service=None,
+    email_ids: Optional[List[str]] = None,
+    push: bool = True,
+    llm: Optional[Callable[[str, Any], str]] = None,
+    max_workers: int = DEFAULT_MAX_WORKERS,
+    usage: Optional[LLMUsage] = None,
+    on_progress: Optional[Callable[[int, int, str], None]] = None,
+    should_stop: Optional[Callable[[], bool]] = None,
+    db=None,
+) -> Dict[str, int]:
+    """
+    Draft replies to the user's To-Do emails (or to `email_ids`) that have
+    no draft yet, store them in one bulk write and, with `push`, create the
+    Gmail drafts through `service` in batched requests. Safe to rerun: each
+    source email is drafted and pushed at most once.
+    """
+    db = db if db is not None else get_db()
+    sources = list(email_ids) if email_ids is not None else todo_email_ids(user_email)
+    claimed = claim_sources(user_email, sources, db)
+    emails = get_emails(user_email, claimed, db)
+    ensure_bodies(user_email, emails, service)
+    total = len(emails)
+    done = []
+
+    def _on_done(email_id, result):
+        done.append(email_id)
+        if on_progress:
+            on_progress(len(done), total, f"{len(done)}/{total} replies drafted")
+
+    replies = generate_replies(
+        emails,
+        prompts,
+        llm=llm,
+        max_workers=max_workers,
+        usage=usage,
+        on_done=_on_done,
+        should_stop=should_stop,
+        user_email=user_email,
+    )
+    now = int(time.time())
+    docs = []
+    for email in emails:
+        reply = replies.get(email["email_id"])
+        doc = {"user_email": user_email, "source_email_id": email["email_id"]}
+        if reply is None:
+            # stopped before its turn; the next run picks it up again
+            doc.update(status=FAILED, error="cancelled")
+        elif "error" in reply:
+            doc.update(status=FAILED, error=reply["error"])
+        else:
+            doc.update(
+                status=GENERATED,
+                subject=reply["subject"],
+                body=reply["body"],
+                followups=reply.get("followups", []),
+                meta={
+                    "to": email.get("sender"),
+                    "thread_id": email.get("thread_id"),
+                    "in_reply_to": email.get("message_id") or None,
+                },
+                generated_at=now,
+                error=None,
+            )
+        docs.append(doc)
+    bulk_upsert(db.drafts, docs, ("user_email", "source_email_id"))
+    generated = sum(1 for d in docs if d["status"] == GENERATED)
+    telemetry.incr("drafts.generated", generated)
+
+    result = {
+        "todo": len(sources),
+        "skipped": len(sources) - len(claimed),
+        "generated": generated,
+        "failed": len(docs) - generated,
+        "pushed": 0,
+        "push_failed": 0,
+    }
+    if push and service is not None and not (should_stop and should_stop()):
+        if on_progress:
+            on_progress(total, total, "Creating Gmail drafts")
+        # also retries drafts an earlier run generated but could not push
+        result.update(push_drafts(service, user_email, sources, db))
+    return result
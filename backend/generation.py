@@ -0,0 +1,172 @@
+"""
+Per-task Gemini generation settings and the schemas of the JSON tasks.
+
+Every request the app makes uses one of the TaskConfigs below, so output
+is capped (and billed) per task. JSON tasks also send a response schema:
+Gemini then returns JSON of exactly that shape and parse_reply() validates
+it with the same pydantic model instead of guessing at free text.
+"""
+
+import functools
+from dataclasses import dataclass, replace
+from typing import TYPE_CHECKING, Any, List, Optional
+
+from pydantic import BaseModel, TypeAdapter
+
+from . import telemetry
+
+if TYPE_CHECKING:
+    from google.genai import types
+
+
+# ---------------- SCHEMAS ----------------
+class ActionItem(BaseModel):
+    task: str
+    deadline: str = ""
+    assignee: str = ""
+
+
+class DraftReply(BaseModel):
+    subject: str
+    body: str
+    followups: List[str] = []
+
+
+class BatchCategory(BaseModel):
+    id: str
+    category: str
+
+
+class BatchActions(BaseModel):
+    id: str
+    actions: List[ActionItem]
+
+
+# ---------------- CONFIGS ----------------
+@dataclass(frozen=True)
+class TaskConfig:
+    """
+    Generation settings for one kind of request. `response_schema` (a
+    pydantic model, or list[...] of one; google-genai rejects typing.List)
+    makes the task a JSON task. Batch tasks are capped per email, see
+    scaled().
+    """
+
+    name: str
+    max_output_tokens: int
+    temperature: float
+    response_schema: Any = None
+    # Gemini 2.5 counts thinking against max_output_tokens; 0 turns it off
+    # so the cap is spent on the answer.
+    thinking_budget: Optional[int] = 0
+
+    @property
+    def is_json(self) -> bool:
+        return self.response_schema is not None
+
+    def scaled(self, items: int) -> "TaskConfig":
+        """This config with the output cap multiplied for `items` emails."""
+        return replace(self, max_output_tokens=self.max_output_tokens * max(items, 1))
+
+    def cache_params(self) -> dict:
+        """What distinguishes this config's responses in the LLM cache."""
+        return {
+            "task": self.name,
+            "max_output_tokens": self.max_output_tokens,
+            "temperature": self.temperature,
+        }
+
+    def to_genai(self) -> "types.GenerateContentConfig":
+        # imported here: google.genai is slow to import and only needed to call
+        from google.genai import types
+
+        options = {
+            "max_output_tokens": self.max_output_tokens,
+            "temperature": self.temperature,
+        }
+        if self.thinking_budget is not None:
+            options["thinking_config"] = types.ThinkingConfig(
+                thinking_budget=self.thinking_budget
+            )
+        if self.is_json:
+            options["response_mime_type"] = "application/json"
+            options["response_schema"] = self.response_schema
+        return types.GenerateContentConfig(**options)
+
+
+# Categories are user-editable, so categorization stays a short free-text
+# answer mapped with match_category().
+CATEGORIZE = TaskConfig("categorize", max_output_tokens=16, temperature=0.0)
+ACTIONS = TaskConfig(
+    "actions", max_output_tokens=400, temperature=0.1, response_schema=list[ActionItem]
+)
+BATCH_CATEGORIZE = TaskConfig(
+    "batch_categorize",
+    max_output_tokens=24,
+    temperature=0.0,
+    response_schema=list[BatchCategory],
+)
+BATCH_ACTIONS = TaskConfig(
+    "batch_actions",
+    max_output_tokens=200,
+    temperature=0.1,
+    response_schema=list[BatchActions],
+)
+SUMMARY = TaskConfig("summary", max_output_tokens=300, temperature=0.3)
+DRAFT = TaskConfig(
+    "draft", max_output_tokens=500, temperature=0.7, response_schema=DraftReply
+)
+GENERAL = TaskConfig("general", max_output_tokens=400, temperature=0.4)
+ASK_INBOX = TaskConfig("ask_inbox", max_output_tokens=500, temperature=0.2)
+THREAD_SUMMARY = TaskConfig("thread_summary", max_output_tokens=400, temperature=0.2)
+
+TASK_CONFIGS = {
+    c.name: c
+    for c in (
+        CATEGORIZE,
+        ACTIONS,
+        BATCH_CATEGORIZE,
+        BATCH_ACTIONS,
+        SUMMARY,
+        DRAFT,
+        GENERAL,
+        ASK_INBOX,
+        THREAD_SUMMARY,
+    )
+}
+
+
+# ---------------- PARSING ----------------
+def _strip_fences(txt: str) -> str:
+    cleaned = (txt or "").strip()
+    if cleaned.startswith("```"):
+        cleaned = cleaned.split("\n", 1)[-1] if "\n" in cleaned else ""
+        cleaned = cleaned.rsplit("```", 1)[0]
+    return cleaned
+
+
+@functools.lru_cache(maxsize=None)
+def _adapter(schema) -> TypeAdapter:
+    return TypeAdapter(schema)
+
+
+def parse_reply(config: TaskConfig, txt: str) -> Any:
+    """
+    Validate a JSON task's reply against its schema; returns plain dicts and
+    lists. Raises ValueError (after counting a "gemini.parse_failures"
+    event) when the reply does not fit.
+    """
+    adapter = _adapter(config.response_schema)
+    try:
+        value = adapter.validate_json(_strip_fences(txt))
+    except ValueError as e:  # pydantic's ValidationError included
+        telemetry.incr("gemini.parse_failures", task=config.name)
+        raise ValueError(f"{config.name} reply does not match its schema") from e
+    return adapter.dump_python(value, mode="json")
+
+
+def finish_reason(response) -> str:
+    """Name of the first candidate's finish reason ("" if unknown)."""
+    candidates = getattr(response, "candidates", None) or []
+    reason = getattr(candidates[0], "finish_reason", None) if candidates else None
+    return getattr(reason, "name", None) or str(reason or "")
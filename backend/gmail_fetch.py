@@ -0,0 +1,195 @@
+import random
+import socket
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional
+
+from . import telemetry
+
+# Gmail accepts up to 100 calls per batch but throttles large batches; 50 is
+# the documented sweet spot.
+DEFAULT_BATCH_SIZE = 50
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_BASE_DELAY = 0.5
+DEFAULT_MAX_DELAY = 16.0
+
+# Partial-response masks: only what parse_message reads comes over the wire.
+METADATA_FIELDS = "id,threadId,internalDate,payload/headers"
+FULL_FIELDS = (
+    "id,threadId,internalDate,"
+    "payload(mimeType,filename,headers,body/data,parts)"
+)
+
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+RETRYABLE_403_REASONS = ("rateLimitExceeded", "userRateLimitExceeded")
+
+
+@dataclass
+class BatchResult:
+    """Responses in the same order as the submitted items, plus failures and timings."""
+
+    results: List[Optional[Dict[str, Any]]]
+    errors: Dict[int, Exception] = field(default_factory=dict)
+    timings: List[Dict[str, Any]] = field(default_factory=list)
+
+    @property
+    def ok(self) -> List[Dict[str, Any]]:
+        return [r for r in self.results if r is not None]
+
+
+def status_of(exc: Exception) -> Optional[int]:
+    status = getattr(exc, "status_code", None)
+    if status is None:
+        status = getattr(getattr(exc, "resp", None), "status", None)
+    try:
+        return int(status) if status is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def is_retryable(exc: Exception) -> bool:
+    """True for throttling, server-side and transport errors."""
+    if isinstance(exc, (ConnectionError, TimeoutError, socket.timeout)):
+        return True
+    status = status_of(exc)
+    if status in RETRYABLE_STATUSES:
+        return True
+    return status == 403 and any(r in str(exc) for r in RETRYABLE_403_REASONS)
+
+
+def backoff_delay(
+    attempt: int,
+    base_delay: float = DEFAULT_BASE_DELAY,
+    max_delay: float = DEFAULT_MAX_DELAY,
+) -> float:
+    """Exponential backoff with jitter; attempt starts at 1."""
+    delay = min(max_delay, base_delay * 2 ** (attempt - 1))
+    return delay * (0.5 + random.random() / 2)
+
+
+def execute(request, name: str):
+    """Execute a single Gmail API request inside a "gmail.<name>" span."""
+    with telemetry.span(f"gmail.{name}"):
+        return request.execute()
+
+
+def execute_batched(
+    service,
+    items: List[Any],
+    make_request: Callable[[Any], Any],
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    max_retries: int = DEFAULT_MAX_RETRIES,
+    base_delay: float = DEFAULT_BASE_DELAY,
+    sleep: Callable[[float], None] = time.sleep,
+) -> BatchResult:
+    """
+    Execute one API request per item, grouped into Gmail batch HTTP requests.
+
+    Only the calls that failed with a retryable error are re-sent, with
+    exponential backoff. `service` only needs `new_batch_http_request(callback=)`
+    returning an object with `add(request, request_id=)` and `execute()`, so a
+    fake service is enough for tests.
+    """
+    out = BatchResult(results=[None] * len(items))
+
+    for batch_no, start in enumerate(range(0, len(items), batch_size)):
+        pending = list(range(start, min(start + batch_size, len(items))))
+        attempts = 0
+        retried = 0
+        started = time.perf_counter()
+
+        while pending:
+            failed: List[int] = []
+
+            def _callback(request_id, response, exception):
+                idx = int(request_id)
+                if exception is None:
+                    out.results[idx] = response
+                    out.errors.pop(idx, None)
+                    return
+                out.errors[idx] = exception
+                if is_retryable(exception):
+                    failed.append(idx)
+
+            batch = service.new_batch_http_request(callback=_callback)
+            for idx in pending:
+                batch.add(make_request(items[idx]), request_id=str(idx))
+
+            attempts += 1
+            try:
+                with telemetry.span(
+                    "gmail.batch", size=len(pending), attempt=attempts
+                ) as span:
+                    batch.execute()
+                    span.count(gmail_requests=len(pending))
+            except Exception as exc:
+                # The whole batch round trip failed; nothing was delivered.
+                if not is_retryable(exc):
+                    raise
+                for idx in pending:
+                    out.errors[idx] = exc
+                failed = list(pending)
+
+            if not failed or attempts > max_retries:
+                break
+            retried += len(failed)
+            sleep(backoff_delay(attempts, base_delay))
+            pending = sorted(set(failed))
+
+        out.timings.append(
+            {
+                "batch": batch_no,
+                "size": min(batch_size, len(items) - start),
+                "attempts": attempts,
+                "retried": retried,
+                "seconds": round(time.perf_counter() - started, 4),
+            }
+        )
+
+    return out
+
+
+def fetch_messages(
+    service,
+    message_ids: List[str],
+    fmt: str = "full",
+    fields: Optional[str] = None,
+    metadata_headers: Optional[List[str]] = None,
+    **kwargs,
+) -> BatchResult:
+    """
+    Fetch Gmail messages by id in batches; results keep the order of `message_ids`.
+    `fields` is a partial-response mask; `metadata_headers` limits the
+    headers returned by fmt="metadata".
+    """
+    params: Dict[str, Any] = {"userId": "me", "format": fmt}
+    if fields:
+        params["fields"] = fields
+    if metadata_headers and fmt == "metadata":
+        params["metadataHeaders"] = metadata_headers
+
+    def _make(mid):
+        return service.users().messages().get(id=mid, **params)
+
+    return execute_batched(service, message_ids, _make, **kwargs)
+
+
+def fetch_metadata(
+    service, message_ids: List[str], headers: List[str], **kwargs
+) -> BatchResult:
+    """List-view fields only: ids, internalDate and the named headers."""
+    return fetch_messages(
+        service,
+        message_ids,
+        fmt="metadata",
+        fields=METADATA_FIELDS,
+        metadata_headers=headers,
+        **kwargs,
+    )
+
+
+def fetch_full(service, message_ids: List[str], **kwargs) -> BatchResult:
+    """Full MIME trees, without snippet, sizes, labels or attachment ids."""
+    return fetch_messages(
+        service, message_ids, fmt="full", fields=FULL_FIELDS, **kwargs
+    )
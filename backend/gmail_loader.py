@@ -1,20 +1,29 @@
 import base64
 from email.message import EmailMessage
+import logging
 import time
-from urllib.parse import urlencode
 from google_auth_oauthlib.flow import Flow
-from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 import requests
 import streamlit as st
 from .mongo_db import get_db
+from .gmail_fetch import execute, fetch_full, fetch_metadata, status_of
+from .gmail_parse import LIST_HEADERS, body_update, parse_message
+from .storage import bulk_upsert, upsert_emails
+from .retrieval import forget_emails, reindex_emails
+from .credentials import (
+    TOKEN_URL,
+    client_config,
+    forget_gmail_service,
+    gmail_service,
+    save_credentials,
+)
+from .threads import forget_threads
+from . import telemetry
 
-# These should be stored securely; Streamlit secrets is recommended (st.secrets)
-CLIENT_ID = st.secrets["GOOGLE_CLIENT_ID"]
-CLIENT_SECRET = st.secrets["GOOGLE_CLIENT_SECRET"]
-REDIRECT_URI = st.secrets["REDIRECT_URI"]
+log = logging.getLogger(__name__)
 
 AUTH_URL = "https://accounts.google.com/o/oauth2/auth"
-TOKEN_URL = "https://oauth2.googleapis.com/token"
 USERINFO_URL = "https://www.googleapis.com/oauth2/v3/userinfo"
 
 SCOPES = [
@@ -26,23 +35,31 @@ SCOPES = [
     "https://www.googleapis.com/auth/gmail.readonly",
 ]
 
-flow = Flow.from_client_config(
-    client_config={
-        "web": {
-            "client_id": CLIENT_ID,
-            "client_secret": CLIENT_SECRET,
-            "redirect_uris": [REDIRECT_URI],
-            "auth_uri": AUTH_URL,
-            "token_uri": TOKEN_URL,
-        }
-    },
-    scopes=SCOPES,
-)
+# messages.list leaves these out by default, so the synced inbox does too
+HIDDEN_LABELS = {"SPAM", "TRASH"}
+
+
+def _new_flow():
+    """A Flow of its own for each sign-in, so no credentials are shared."""
+    config = client_config()
+    return Flow.from_client_config(
+        client_config={
+            "web": {
+                "client_id": config["client_id"],
+                "client_secret": config["client_secret"],
+                "redirect_uris": [config["redirect_uri"]],
+                "auth_uri": AUTH_URL,
+                "token_uri": TOKEN_URL,
+            }
+        },
+        scopes=SCOPES,
+        redirect_uri=config["redirect_uri"],
+    )
 
 
 def generate_oauth_url():
-    authorization_url, _ = flow.authorization_url()
-    authorization_url += "&" + urlencode({"redirect_uri": REDIRECT_URI})
+    # consent makes Google issue a refresh token even on a repeat sign-in
+    authorization_url, _ = _new_flow().authorization_url(prompt="consent")
     return authorization_url
 
 
@@ -53,21 +70,22 @@ def handle_oauth_callback(query_params):
     if not code:
         raise ValueError("No code in callback.")
 
-    flow.redirect_uri = REDIRECT_URI
-    flow.fetch_token(code=query_params["code"])
+    flow = _new_flow()
+    with telemetry.span("google.fetch_token"):
+        flow.fetch_token(code=query_params["code"])
     creds = flow.credentials
     access_token = str(creds.token)
 
     headers = {"Authorization": f"Bearer {access_token}"}
-    userinfo_resp = requests.get(USERINFO_URL, headers=headers)
+    with telemetry.span("google.userinfo"):
+        userinfo_resp = requests.get(USERINFO_URL, headers=headers)
     userinfo_resp.raise_for_status()
     userinfo = userinfo_resp.json()
     user_email = userinfo.get("email")
 
-    # Save tokens & basic profile in Mongo
+    # Save basic profile in Mongo, and the tokens encrypted
     db = get_db()
     users = db.users
-    # Upsert user tokens (note: storing refresh token for reuse; rotate/encrypt for production)
     users.update_one(
         {"email": user_email},
         {
@@ -75,120 +93,346 @@ def handle_oauth_callback(query_params):
                 "email": user_email,
                 "name": userinfo.get("name"),
                 "picture": userinfo.get("picture"),
-                "access_token": access_token,  # access_token, refresh_token, expires_in, scope, token_type
             }
         },
         upsert=True,
     )
+    save_credentials(user_email, creds, db)
+    if not creds.refresh_token:
+        log.warning("Google returned no refresh token for %s", user_email)
+    forget_gmail_service(user_email)
 
     try:
         st.session_state["oauth_token"] = access_token
         st.session_state["user_email"] = user_email
         st.session_state["oauth_state"] = "connected"
-    except:
-        print("something wrong in session state")
+    except Exception:
+        log.warning("Could not store the Gmail session for %s", user_email, exc_info=True)
     return
 
 
-def fetch_inbox_with_token(n=20):
+def _require_session():
     if "oauth_token" not in st.session_state or "user_email" not in st.session_state:
         raise RuntimeError("No oauth token. Please authenticate first.")
+    return st.session_state["user_email"]
+
+
+def user_gmail_service(user_email):
+    """
+    Gmail client from the credentials stored at sign-in, for code running
+    outside the user's Streamlit session (background job workers).
+    """
+    return gmail_service(user_email)
+
+
+def _store_emails(db, user_email, msgs, with_body=True):
+    emails = [parse_message(msg_data, user_email, with_body) for msg_data in msgs]
+    if emails:
+        upsert_emails(db, emails)
+    return emails
+
+
+def _body_states(db, user_email, email_ids):
+    """Stored ids among `email_ids`, mapped to whether their body is loaded."""
+    docs = db.inboxes.find(
+        {"user_email": user_email, "email_id": {"$in": list(email_ids)}},
+        {"_id": 0, "email_id": 1, "body_loaded": 1},
+    )
+    # documents from before lazy bodies always have theirs
+    return {d["email_id"]: d.get("body_loaded", True) for d in docs}
+
 
-    service = build("gmail", "v1", credentials=flow.credentials)
-    print("serivicing is done ")
-    results = service.users().messages().list(userId="me", maxResults=n).execute()
+def _store_new(service, db, user_email, email_ids, with_bodies):
+    """
+    Store the messages of `email_ids` that are not in the inbox yet: full
+    payloads when `with_bodies`, otherwise list metadata only. Stored
+    metadata-only messages get their bodies too when `with_bodies`.
+    Returns (emails, batch timings, ids that failed to download); messages
+    Gmail no longer has (404) are not among the failures.
+    """
+    known = _body_states(db, user_email, email_ids)
+    new_ids = [i for i in email_ids if i not in known]
+    if known:
+        _backfill_thread_ids(service, db, user_email, list(known))
+    if with_bodies:
+        fetched = fetch_full(service, new_ids)
+    else:
+        fetched = fetch_metadata(service, new_ids, LIST_HEADERS)
+    emails = _store_emails(db, user_email, fetched.ok, with_bodies)
+    failed = [
+        new_ids[index]
+        for index, error in fetched.errors.items()
+        if fetched.results[index] is None and status_of(error) != 404
+    ]
+    if failed:
+        log.warning("Could not fetch %d of %d new messages", len(failed), len(new_ids))
+    if with_bodies:
+        stubs = [i for i, loaded in known.items() if not loaded]
+        if stubs:
+            load_bodies(user_email, stubs, service=service, db=db)
+    return emails, fetched.timings, failed
+
+
+def _backfill_thread_ids(service, db, user_email, email_ids):
+    """Set thread_id on stored messages from before threads were tracked."""
+    missing = [
+        d["email_id"]
+        for d in db.inboxes.find(
+            {
+                "user_email": user_email,
+                "email_id": {"$in": email_ids},
+                "thread_id": {"$exists": False},
+            },
+            {"_id": 0, "email_id": 1},
+        )
+    ]
+    if not missing:
+        return
+    fetched = fetch_metadata(service, missing, [])
+    updates = [
+        {"user_email": user_email, "email_id": m["id"], "thread_id": m["threadId"]}
+        for m in fetched.ok
+        if m.get("threadId")
+    ]
+    if updates:
+        bulk_upsert(db.inboxes, updates, ("user_email", "email_id"))
+
+
+def load_bodies(user_email, email_ids, service=None, db=None):
+    """
+    Fetch and store the bodies of metadata-only messages. Returns
+    {email_id: body} for the ones Gmail returned.
+    """
+    if not email_ids:
+        return {}
+    service = service if service is not None else gmail_service(user_email)
+    db = db if db is not None else get_db()
+    fetched = fetch_full(service, list(email_ids))
+    updates = [u for u in (body_update(m, user_email) for m in fetched.ok) if u]
+    if updates:
+        bulk_upsert(db.inboxes, updates, ("user_email", "email_id"))
+        reindex_emails(user_email, [u["email_id"] for u in updates], db)
+    return {u["email_id"]: u["body"] for u in updates}
+
+
+def ensure_bodies(user_email, emails, service=None):
+    """Fill in, in place, the bodies of metadata-only documents in `emails`."""
+    missing = [e["email_id"] for e in emails if e.get("body_loaded") is False]
+    if missing:
+        bodies = load_bodies(user_email, missing, service=service)
+        for e in emails:
+            if e["email_id"] in bodies:
+                e["body"] = bodies[e["email_id"]]
+                e["body_loaded"] = True
+    return emails
+
+
+def _save_history_id(db, user_email, history_id, retry_ids=()):
+    """
+    Advance the sync cursor. `retry_ids` are messages from before it that
+    failed to download; the next sync fetches them again.
+    """
+    db.sync_state.update_one(
+        {"user_email": user_email},
+        {
+            "$set": {
+                "history_id": str(history_id),
+                "retry_ids": list(retry_ids),
+                "synced_at": time.time(),
+            }
+        },
+        upsert=True,
+    )
+
+
+def fetch_inbox_with_token(
+    n=20, service=None, with_bodies=True, user_email=None, timings=None
+):
+    """
+    Store the latest `n` messages that are not in the inbox yet. With
+    with_bodies=False only list metadata is fetched; bodies follow on
+    demand through ensure_bodies(). `user_email` (with `service`) runs
+    the fetch outside a Streamlit session. If given, the `timings` list
+    receives the per-batch fetch timings.
+    """
+    user_email = user_email or _require_session()
+
+    if service is None:
+        service = gmail_service(user_email)
+    # Snapshot the mailbox history position *before* listing so that nothing
+    # arriving during the fetch is missed by the next incremental sync.
+    history_id = execute(
+        service.users().getProfile(userId="me"), "get_profile"
+    ).get("historyId")
+    results = execute(
+        service.users().messages().list(userId="me", maxResults=n), "list"
+    )
     messages = results.get("messages", [])
 
     db = get_db()
-    inbox_coll = db.inboxes
-
-    emails = []
-    for msg in messages:
-        msg_data = (
-            service.users()
-            .messages()
-            .get(userId="me", id=msg["id"], format="full")
-            .execute()
-        )
-        headers = msg_data.get("payload", {}).get("headers", [])
-        subject = next((h["value"] for h in headers if h["name"] == "Subject"), "")
-        sender = next((h["value"] for h in headers if h["name"] == "From"), "")
-        timestamp = msg_data.get("internalDate", "")
-        body = ""
-        payload = msg_data.get("payload", {})
-        # handle simple parts
-        if "parts" in payload:
-            for part in payload["parts"]:
-                if part.get("mimeType") == "text/plain":
-                    data = part.get("body", {}).get("data")
-                    if data:
-                        body = base64.urlsafe_b64decode(data).decode(
-                            "utf-8", errors="ignore"
-                        )
-                        break
-        else:
-            data = payload.get("body", {}).get("data")
-            if data:
-                body = base64.urlsafe_b64decode(data).decode("utf-8", errors="ignore")
-
-        email_doc = {
-            "user_email": st.session_state["user_email"],
-            "email_id": msg["id"],
-            "sender": sender,
-            "subject": subject,
-            "timestamp": timestamp,
-            "body": body,
-            "fetched_at": time.time(),
-        }
-
-        inbox_coll.update_one(
-            {"user_email": st.session_state["user_email"], "email_id": msg["id"]},
-            {"$set": email_doc},
-            upsert=True,
-        )
-        emails.append(email_doc)
+    # batched, in inbox order; messages already stored are not fetched again
+    emails, batch_timings, failed = _store_new(
+        service, db, user_email, [m["id"] for m in messages], with_bodies
+    )
+    if timings is not None:
+        timings.extend(batch_timings)
+    if history_id:
+        _save_history_id(db, user_email, history_id, failed)
 
     return emails
 
 
-# ------- TO HANDLE DRAFTS ------------------------------
-def create_gmail_draft(subject: str, body: str, to_addr: str = None):
+def list_history_changes(service, start_history_id):
     """
-    Create a Gmail draft in the authenticated user's account and save metadata to Mongo.
-    Returns the created Gmail draft id and stored doc.
+    Page through `users.history.list` since `start_history_id`.
+    Returns (added_ids, removed_ids, latest_history_id). Mail moved to Trash
+    or Spam counts as removed, and mail taken out of them again as added,
+    matching what `messages.list` shows.
     """
-    service = (
-        build("gmail", "v1", credentials=flow.credentials),
-        st.session_state["user_email"],
+    added, removed = {}, set()
+    latest = start_history_id
+    params = {
+        "userId": "me",
+        "startHistoryId": start_history_id,
+        "historyTypes": [
+            "messageAdded",
+            "messageDeleted",
+            "labelAdded",
+            "labelRemoved",
+        ],
+    }
+    while True:
+        resp = execute(service.users().history().list(**params), "history")
+        for record in resp.get("history", []):
+            for item in record.get("messagesAdded", []):
+                msg = item["message"]
+                if HIDDEN_LABELS.intersection(msg.get("labelIds", [])):
+                    continue
+                added[msg["id"]] = True
+                removed.discard(msg["id"])
+            for item in record.get("messagesDeleted", []):
+                added.pop(item["message"]["id"], None)
+                removed.add(item["message"]["id"])
+            for item in record.get("labelsAdded", []):
+                if HIDDEN_LABELS.intersection(item.get("labelIds", [])):
+                    added.pop(item["message"]["id"], None)
+                    removed.add(item["message"]["id"])
+            for item in record.get("labelsRemoved", []):
+                msg = item["message"]
+                # untrashed or marked not spam, and not hidden otherwise
+                if HIDDEN_LABELS.intersection(
+                    item.get("labelIds", [])
+                ) and not HIDDEN_LABELS.intersection(msg.get("labelIds", [])):
+                    added[msg["id"]] = True
+                    removed.discard(msg["id"])
+        latest = resp.get("historyId", latest)
+        if not resp.get("nextPageToken"):
+            break
+        params["pageToken"] = resp["nextPageToken"]
+    return list(added), list(removed), latest
+
+
+def sync_inbox(n=20, service=None, with_bodies=True, user_email=None, timings=None):
+    """
+    Bring `db.inboxes` up to date for the signed-in user.
+
+    With a stored historyId only messages added or removed since the last
+    sync are touched; otherwise (first sync, or Gmail expired the history
+    id and answers 404) this falls back to a full fetch of the latest `n`.
+    Messages that failed to download are kept in the sync state and fetched
+    again by the next sync. The other arguments are as for
+    fetch_inbox_with_token.
+    """
+    user_email = user_email or _require_session()
+    if service is None:
+        service = gmail_service(user_email)
+
+    db = get_db()
+    state = db.sync_state.find_one({"user_email": user_email}) or {}
+    if state.get("history_id"):
+        try:
+            added_ids, removed_ids, latest = list_history_changes(
+                service, state["history_id"]
+            )
+        except HttpError as e:
+            if status_of(e) != 404:
+                raise
+        else:
+            retry = [i for i in state.get("retry_ids", []) if i not in removed_ids]
+            added_ids = list(dict.fromkeys(retry + added_ids))
+            emails, batch_timings, failed = _store_new(
+                service, db, user_email, added_ids, with_bodies
+            )
+            if timings is not None:
+                timings.extend(batch_timings)
+            if removed_ids:
+                removed = {"user_email": user_email, "email_id": {"$in": removed_ids}}
+                # their threads' rolling summaries are rebuilt on next view
+                thread_ids = {
+                    d.get("thread_id")
+                    for d in db.inboxes.find(removed, {"_id": 0, "thread_id": 1})
+                }
+                db.inboxes.delete_many(removed)
+                forget_emails(user_email, removed_ids)
+                forget_threads(user_email, [t for t in thread_ids if t], db)
+            _save_history_id(db, user_email, latest, failed)
+            return {"mode": "incremental", "added": emails, "removed": removed_ids}
+
+    emails = fetch_inbox_with_token(
+        n,
+        service=service,
+        with_bodies=with_bodies,
+        user_email=user_email,
+        timings=timings,
     )
-    user_email = st.session_state["user_email"]
+    return {"mode": "full", "added": emails, "removed": []}
 
-    # Build MIME message
+
+# ------- TO HANDLE DRAFTS ------------------------------
+def draft_payload(
+    from_addr, to_addr, subject, body, thread_id=None, in_reply_to=None
+):
+    """
+    drafts.create request body. A `thread_id` files the draft as a reply in
+    that thread; Gmail only keeps it there if the draft also cites the
+    Message-ID of the email it answers (`in_reply_to`).
+    """
     msg = EmailMessage()
-    from_header = user_email
-    to_header = to_addr or user_email  # for drafts you can use user_email or recipient
-    msg["From"] = from_header
-    msg["To"] = to_header
+    msg["From"] = from_addr
+    msg["To"] = to_addr or from_addr
     msg["Subject"] = subject
+    if in_reply_to:
+        msg["In-Reply-To"] = in_reply_to
+        msg["References"] = in_reply_to
     msg.set_content(body)
+    message = {"raw": base64.urlsafe_b64encode(msg.as_bytes()).decode("utf-8")}
+    if thread_id:
+        message["threadId"] = thread_id
+    return {"message": message}
 
-    raw_bytes = msg.as_bytes()
-    raw_b64 = base64.urlsafe_b64encode(raw_bytes).decode("utf-8")
 
-    body_payload = {"message": {"raw": raw_b64}}
-
-    draft = service.users().drafts().create(userId="me", body=body_payload).execute()
-    draft_id = draft.get("id")
-    # save to Mongo
-    db = get_db()
-    drafts_coll = db.drafts
-    doc = {
-        "user_email": user_email,
-        "gmail_draft_id": draft_id,
-        "subject": subject,
-        "body": body,
-        "created_at": int(__import__("time").time()),
-    }
-    res = drafts_coll.insert_one(doc)
-    doc["_id"] = str(res.inserted_id)
-    return {"gmail_draft_id": draft_id, "doc": doc}
+def create_gmail_draft(
+    subject: str,
+    body: str,
+    to_addr: str = None,
+    thread_id: str = None,
+    in_reply_to: str = None,
+):
+    """
+    Create a Gmail draft in the signed-in user's account. The Mongo side is
+    kept by drafts.save_draft_to_db. Returns the Gmail draft id and response.
+    """
+    user_email = _require_session()
+    service = gmail_service(user_email)
+    draft = execute(
+        service.users()
+        .drafts()
+        .create(
+            userId="me",
+            body=draft_payload(
+                user_email, to_addr, subject, body, thread_id, in_reply_to
+            ),
+        ),
+        "create_draft",
+    )
+    return {"gmail_draft_id": draft.get("id"), "draft": draft}
@@ -0,0 +1,139 @@
+import base64
+import html
+import re
+import time
+from typing import Any, Dict, Iterator, List, Optional
+
+# Headers kept for list views; also the metadataHeaders of metadata fetches.
+# Message-ID is what a reply draft cites to join the original's thread.
+LIST_HEADERS = ["From", "Subject", "Message-ID"]
+
+_CHARSET = re.compile(r"""charset\s*=\s*["']?([\w.:-]+)""", re.I)
+_HIDDEN_BLOCKS = re.compile(
+    r"<(script|style|head|title)\b[^>]*>.*?</\1\s*>|<!--.*?-->", re.I | re.S
+)
+_LINE_BREAK_TAGS = re.compile(
+    r"<\s*(?:br|/p|/div|/[uo]l|/tr|/h[1-6]|/blockquote|/table|hr)\b[^>]*>", re.I
+)
+_LIST_ITEM = re.compile(r"<\s*li\b[^>]*>", re.I)
+_TAG = re.compile(r"<[^>]+>")
+_INLINE_SPACE = re.compile(r"[ \t\f\v\u00a0]+")
+_BLANK_LINES = re.compile(r"\n\s*\n\s*(?:\n\s*)+")
+
+
+def header(headers: List[Dict[str, str]], name: str, default: str = "") -> str:
+    """First value of header `name` (case-insensitive)."""
+    name = name.lower()
+    return next(
+        (h.get("value", "") for h in headers if h.get("name", "").lower() == name),
+        default,
+    )
+
+
+def _charset(part: Dict[str, Any]) -> str:
+    content_type = header(part.get("headers", []), "Content-Type")
+    match = _CHARSET.search(content_type)
+    return match.group(1) if match else "utf-8"
+
+
+def decode_part(part: Dict[str, Any]) -> str:
+    """Text of a part's inline body, decoded with its declared charset."""
+    data = part.get("body", {}).get("data")
+    if not data:
+        return ""
+    raw = base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+    try:
+        return raw.decode(_charset(part), errors="replace")
+    except LookupError:  # unknown charset name
+        return raw.decode("utf-8", errors="replace")
+
+
+def _is_attachment(part: Dict[str, Any]) -> bool:
+    if part.get("filename"):
+        return True
+    disposition = header(part.get("headers", []), "Content-Disposition")
+    return disposition.lower().startswith("attachment")
+
+
+def walk_parts(payload: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+    """Leaf parts of a Gmail payload in document order, attachments skipped."""
+    stack = [payload]
+    while stack:
+        part = stack.pop()
+        children = part.get("parts")
+        if children:
+            stack.extend(reversed(children))
+        elif not _is_attachment(part):
+            yield part
+
+
+def html_to_text(markup: str) -> str:
+    """
+    Readable plain text from an HTML body: hidden blocks dropped, block
+    elements turned into line breaks, tags stripped, entities unescaped.
+    """
+    text = _HIDDEN_BLOCKS.sub("", markup)
+    text = _LINE_BREAK_TAGS.sub("\n", text)
+    text = _LIST_ITEM.sub("\n- ", text)
+    text = html.unescape(_TAG.sub("", text))
+    text = _INLINE_SPACE.sub(" ", text)
+    text = "\n".join(line.strip() for line in text.split("\n"))
+    return _BLANK_LINES.sub("\n\n", text).strip()
+
+
+def extract_body(payload: Dict[str, Any]) -> str:
+    """
+    The message text from anywhere in the MIME tree: the text/plain parts
+    if there are any, otherwise the text/html parts converted to text.
+    """
+    plain, rich = [], []
+    for part in walk_parts(payload):
+        mime = (part.get("mimeType") or "").lower()
+        if mime == "text/plain":
+            plain.append(decode_part(part))
+        elif mime == "text/html":
+            rich.append(decode_part(part))
+    if any(p.strip() for p in plain):
+        return "\n".join(p for p in plain if p.strip())
+    return "\n\n".join(html_to_text(h) for h in rich if h.strip())
+
+
+def parse_message(
+    msg_data: Dict[str, Any], user_email: str, with_body: bool = True
+) -> Dict[str, Any]:
+    """
+    Turn a Gmail `messages.get` response into an inbox document. Pass
+    with_body=False for metadata-format responses; the document is then
+    stored with body_loaded False until its body is fetched.
+    """
+    payload = msg_data.get("payload", {})
+    headers = payload.get("headers", [])
+    timestamp = msg_data.get("internalDate", "")
+    return {
+        "user_email": user_email,
+        "email_id": msg_data["id"],
+        "thread_id": msg_data.get("threadId") or msg_data["id"],
+        "sender": header(headers, "From"),
+        "subject": header(headers, "Subject"),
+        "message_id": header(headers, "Message-ID"),
+        "timestamp": timestamp,
+        # numeric copy of internalDate (ms since epoch) for range queries
+        "internal_date": int(timestamp or 0),
+        "body": extract_body(payload) if with_body else "",
+        "body_loaded": with_body,
+        "fetched_at": time.time(),
+    }
+
+
+def body_update(
+    msg_data: Dict[str, Any], user_email: str
+) -> Optional[Dict[str, Any]]:
+    """Fields to $set on a stored metadata-only document once its body arrives."""
+    if "payload" not in msg_data:
+        return None
+    return {
+        "user_email": user_email,
+        "email_id": msg_data["id"],
+        "body": extract_body(msg_data["payload"]),
+        "body_loaded": True,
+    }
@@ -0,0 +1,85 @@
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from .mongo_db import get_db
+
+DEFAULT_PAGE_SIZE = 50
+# What list views need; bodies are loaded per message with get_email().
+LIST_PROJECTION = {
+    "_id": 0,
+    "email_id": 1,
+    "sender": 1,
+    "subject": 1,
+    "timestamp": 1,
+    "fetched_at": 1,
+}
+# Newest first; email_id breaks ties so the order is total and stable.
+LIST_SORT = [("fetched_at", -1), ("email_id", -1)]
+
+Cursor = Tuple[float, str]
+
+
+def list_inbox_page(
+    user_email: str,
+    limit: int = DEFAULT_PAGE_SIZE,
+    cursor: Optional[Cursor] = None,
+    db=None,
+) -> Tuple[List[Dict[str, Any]], Optional[Cursor]]:
+    """
+    One page of the inbox, list fields only. `cursor` is the value returned
+    as next_cursor by the previous page (None for the first page); it is
+    None again when there are no more pages. Served by the
+    (user_email, fetched_at, email_id) index without skip/offset scans.
+    """
+    db = db if db is not None else get_db()
+    query: Dict[str, Any] = {"user_email": user_email}
+    if cursor is not None:
+        fetched_at, email_id = cursor
+        query["$or"] = [
+            {"fetched_at": {"$lt": fetched_at}},
+            {"fetched_at": fetched_at, "email_id": {"$lt": email_id}},
+        ]
+    items = list(
+        db.inboxes.find(query, LIST_PROJECTION).sort(LIST_SORT).limit(limit + 1)
+    )
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        last = items[-1]
+        next_cursor = (last.get("fetched_at"), last["email_id"])
+    return items, next_cursor
+
+
+def get_email(user_email: str, email_id: str, db=None) -> Optional[Dict[str, Any]]:
+    """The full stored message, body included."""
+    db = db if db is not None else get_db()
+    return db.inboxes.find_one(
+        {"user_email": user_email, "email_id": email_id}, {"_id": 0}
+    )
+
+
+def get_thread(
+    user_email: str,
+    thread_id: str,
+    projection: Optional[Dict[str, Any]] = None,
+    db=None,
+) -> List[Dict[str, Any]]:
+    """The stored messages of a Gmail thread, oldest first."""
+    db = db if db is not None else get_db()
+    cursor = db.inboxes.find(
+        {"user_email": user_email, "thread_id": thread_id},
+        projection or {"_id": 0},
+    )
+    return list(cursor.sort([("internal_date", 1), ("email_id", 1)]))
+
+
+def get_emails(
+    user_email: str, email_ids: Iterable[str], db=None
+) -> List[Dict[str, Any]]:
+    """Full messages for `email_ids`, in the order given."""
+    db = db if db is not None else get_db()
+    ids = list(email_ids)
+    docs = db.inboxes.find(
+        {"user_email": user_email, "email_id": {"$in": ids}}, {"_id": 0}
+    )
+    by_id = {d["email_id"]: d for d in docs}
+    return [by_id[i] for i in ids if i in by_id]
@@ -0,0 +1,501 @@
+"""
+Background jobs: a Mongo-backed queue and the workers that drain it.
+
+The Streamlit app enqueues work (inbox sync, ingestion, auto drafts) and
+polls the job document for status and progress; workers claim jobs
+atomically, so any number of them can run in the app process, in separate
+processes or on other machines:
+
+    python -m backend.jobs --processes 4 --threads 2
+"""
+
+import argparse
+import logging
+import multiprocessing
+import os
+import socket
+import threading
+import time
+import traceback
+import uuid
+from typing import Any, Callable, Dict, List, Optional
+
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING, ReturnDocument
+
+from . import telemetry
+from .mongo_db import get_db
+
+log = logging.getLogger(__name__)
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+ACTIVE = (QUEUED, RUNNING)
+FINISHED = (DONE, FAILED, CANCELLED)
+
+POLL_INTERVAL_SECONDS = 1.0
+# Progress writes are throttled to one per interval (plus the final one).
+PROGRESS_INTERVAL_SECONDS = 0.5
+# A running job whose worker has not reported for this long is requeued.
+STALE_AFTER_SECONDS = 300
+# Workers mark their running job alive this often, whatever the handler does.
+HEARTBEAT_INTERVAL_SECONDS = 30
+MAX_ATTEMPTS = 3
+# Workers started inside the Streamlit process; 0 leaves all jobs to
+# external `python -m backend.jobs` workers.
+INLINE_WORKERS = int(os.environ.get("JOB_WORKERS", 2))
+
+
+class JobCancelled(Exception):
+    """Raised inside a handler once cancellation of its job was requested."""
+
+
+_handlers: Dict[str, Callable[..., Any]] = {}
+
+
+def handler(kind: str):
+    """Register `fn(ctx, **params)` as the handler for jobs of `kind`."""
+
+    def _register(fn):
+        _handlers[kind] = fn
+        return fn
+
+    return _register
+
+
+def _oid(job_id) -> ObjectId:
+    return job_id if isinstance(job_id, ObjectId) else ObjectId(job_id)
+
+
+def _owned(job: Dict[str, Any]) -> Dict[str, Any]:
+    # matches the job only while this claim of it is current: once it was
+    # requeued and claimed again, a stale worker's writes match nothing
+    return {
+        "_id": job["_id"],
+        "status": RUNNING,
+        "worker": job["worker"],
+        "attempts": job["attempts"],
+    }
+
+
+def enqueue(kind: str, user_email: str, params: Dict[str, Any], db=None) -> str:
+    """Queue a job; returns its id."""
+    db = db if db is not None else get_db()
+    now = time.time()
+    res = db.jobs.insert_one(
+        {
+            "kind": kind,
+            "user_email": user_email,
+            "params": params,
+            "status": QUEUED,
+            "progress": {"done": 0, "total": 0, "message": ""},
+            "cancel_requested": False,
+            "attempts": 0,
+            "created_at": now,
+            "updated_at": now,
+        }
+    )
+    return str(res.inserted_id)
+
+
+def get_job(job_id, db=None) -> Optional[Dict[str, Any]]:
+    db = db if db is not None else get_db()
+    return db.jobs.find_one({"_id": _oid(job_id)}, {"params": 0})
+
+
+def list_jobs(user_email: str, limit: int = 20, db=None) -> List[Dict[str, Any]]:
+    """The user's most recent jobs, newest first."""
+    db = db if db is not None else get_db()
+    cursor = (
+        db.jobs.find({"user_email": user_email}, {"params": 0})
+        .sort("created_at", DESCENDING)
+        .limit(limit)
+    )
+    return list(cursor)
+
+
+def cancel_job(job_id, db=None) -> None:
+    """
+    Cancel a job: a queued one never starts, a running one stops the next
+    time its handler checks (see JobContext).
+    """
+    db = db if db is not None else get_db()
+    now = time.time()
+    db.jobs.update_one(
+        {"_id": _oid(job_id), "status": QUEUED},
+        {"$set": {"status": CANCELLED, "finished_at": now, "updated_at": now}},
+    )
+    db.jobs.update_one(
+        {"_id": _oid(job_id), "status": RUNNING},
+        {"$set": {"cancel_requested": True, "updated_at": now}},
+    )
+
+
+def claim_job(worker_id: str, db=None) -> Optional[Dict[str, Any]]:
+    """Atomically take the oldest queued job of a kind this process handles."""
+    db = db if db is not None else get_db()
+    now = time.time()
+    return db.jobs.find_one_and_update(
+        {"status": QUEUED, "kind": {"$in": list(_handlers)}},
+        {
+            "$set": {
+                "status": RUNNING,
+                "worker": worker_id,
+                "started_at": now,
+                "heartbeat_at": now,
+                "updated_at": now,
+            },
+            "$inc": {"attempts": 1},
+        },
+        sort=[("created_at", ASCENDING)],
+        return_document=ReturnDocument.AFTER,
+    )
+
+
+def requeue_stale(db=None, now: Optional[float] = None) -> int:
+    """
+    Put running jobs whose worker went silent back in the queue, or fail
+    them after MAX_ATTEMPTS. Returns the number of jobs touched.
+    """
+    db = db if db is not None else get_db()
+    now = now if now is not None else time.time()
+    stale = {"status": RUNNING, "heartbeat_at": {"$lt": now - STALE_AFTER_SECONDS}}
+    failed = db.jobs.update_many(
+        {**stale, "attempts": {"$gte": MAX_ATTEMPTS}},
+        {
+            "$set": {
+                "status": FAILED,
+                "error": "worker stopped responding",
+                "finished_at": now,
+                "updated_at": now,
+            }
+        },
+    )
+    requeued = db.jobs.update_many(
+        stale, {"$set": {"status": QUEUED, "updated_at": now}}
+    )
+    return failed.modified_count + requeued.modified_count
+
+
+class JobContext:
+    """
+    Handed to job handlers to report progress and observe cancellation.
+    progress() and heartbeat() also pick up cancel requests; handlers then
+    either call check() to abort, or test cancelled() to stop early and
+    keep partial results. A job that was requeued and claimed by another
+    worker counts as cancelled here.
+    """
+
+    def __init__(self, db, job: Dict[str, Any], clock=time.time):
+        self.db = db
+        self.job_id = job["_id"]
+        self.user_email = job["user_email"]
+        self._owned = _owned(job)
+        self._clock = clock
+        self._last_write = 0.0
+        self._cancelled = bool(job.get("cancel_requested"))
+
+    def progress(self, done: int, total: int, message: str = "") -> None:
+        """Record progress (throttled) and pick up cancellation requests."""
+        now = self._clock()
+        if done < total and now - self._last_write < PROGRESS_INTERVAL_SECONDS:
+            return
+        self._last_write = now
+        self._update(
+            {
+                "progress": {"done": done, "total": total, "message": message},
+                "heartbeat_at": now,
+                "updated_at": now,
+            }
+        )
+
+    def heartbeat(self) -> None:
+        """Mark the job alive and pick up cancellation requests."""
+        self._update({"heartbeat_at": self._clock()})
+
+    def _update(self, fields: Dict[str, Any]) -> None:
+        doc = self.db.jobs.find_one_and_update(
+            self._owned,
+            {"$set": fields},
+            projection={"cancel_requested": 1},
+            return_document=ReturnDocument.AFTER,
+        )
+        # no match: the job was cancelled while queued or taken over
+        self._cancelled = doc is None or bool(doc.get("cancel_requested"))
+
+    def cancelled(self) -> bool:
+        return self._cancelled
+
+    def check(self) -> None:
+        """Raise JobCancelled if cancellation was requested."""
+        if self._cancelled:
+            raise JobCancelled()
+
+
+def _finish(db, job: Dict[str, Any], status: str, **fields) -> None:
+    now = time.time()
+    db.jobs.update_one(
+        _owned(job),
+        {"$set": {"status": status, "finished_at": now, "updated_at": now, **fields}},
+    )
+
+
+def _keep_alive(ctx: JobContext, stop: threading.Event, interval: float) -> None:
+    while not stop.wait(interval):
+        try:
+            ctx.heartbeat()
+        except Exception:
+            log.exception("Heartbeat of job %s failed", ctx.job_id)
+
+
+def run_job(
+    job: Dict[str, Any], db=None, heartbeat_interval: float = HEARTBEAT_INTERVAL_SECONDS
+) -> str:
+    """
+    Run a claimed job to completion; returns its final status. A heartbeat
+    thread keeps the job from being requeued as stale while the handler
+    works, however rarely it reports progress.
+    """
+    db = db if db is not None else get_db()
+    ctx = JobContext(db, job)
+    # attribute the job's Gmail/Gemini/Mongo spans to its user
+    telemetry.bind(job["user_email"], f"job:{job['kind']}")
+    stop = threading.Event()
+    beat = threading.Thread(
+        target=_keep_alive,
+        args=(ctx, stop, heartbeat_interval),
+        name=f"job-heartbeat-{job['_id']}",
+        daemon=True,
+    )
+    beat.start()
+    try:
+        fn = _handlers[job["kind"]]
+        result = fn(ctx, **job.get("params", {}))
+    except JobCancelled:
+        _finish(db, job, CANCELLED)
+        return CANCELLED
+    except Exception as e:
+        _finish(db, job, FAILED, error=str(e), trace=traceback.format_exc())
+        return FAILED
+    finally:
+        stop.set()
+        beat.join()
+    if ctx.cancelled():
+        # the handler stopped early on its own and kept partial results
+        _finish(db, job, CANCELLED, result=result)
+        return CANCELLED
+    _finish(db, job, DONE, result=result)
+    return DONE
+
+
+class Worker:
+    """Claims and runs jobs one at a time until `stop` is set."""
+
+    def __init__(self, db=None, worker_id: Optional[str] = None):
+        self.db = db if db is not None else get_db()
+        self.worker_id = worker_id or (
+            f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        )
+
+    def run_once(self) -> bool:
+        """Run one job if one is queued; returns whether one ran."""
+        job = claim_job(self.worker_id, self.db)
+        if job is None:
+            return False
+        run_job(job, self.db)
+        return True
+
+    def run_forever(
+        self, stop: threading.Event, poll_interval: float = POLL_INTERVAL_SECONDS
+    ) -> None:
+        while not stop.is_set():
+            try:
+                requeue_stale(self.db)
+                if self.run_once():
+                    continue
+            except Exception:
+                # a lost Mongo connection should not kill the worker
+                log.exception("Job worker %s failed", self.worker_id)
+            stop.wait(poll_interval)
+
+
+class WorkerPool:
+    """`size` worker threads sharing one stop event."""
+
+    def __init__(self, size: int, db=None):
+        self.size = size
+        self.db = db
+        self.stop_event = threading.Event()
+        self.threads: List[threading.Thread] = []
+
+    def start(self) -> "WorkerPool":
+        for n in range(self.size):
+            worker = Worker(self.db)
+            t = threading.Thread(
+                target=worker.run_forever,
+                args=(self.stop_event,),
+                name=f"job-worker-{n}",
+                daemon=True,
+            )
+            t.start()
+            self.threads.append(t)
+        return self
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        self.stop_event.set()
+        for t in self.threads:
+            t.join(timeout)
+
+
+_inline_pool: Optional[WorkerPool] = None
+_inline_lock = threading.Lock()
+
+
+def start_inline_workers(size: int = INLINE_WORKERS) -> Optional[WorkerPool]:
+    """Start the in-process worker pool once per process (no-op for size 0)."""
+    global _inline_pool
+    if size <= 0:
+        return None
+    with _inline_lock:
+        if _inline_pool is None:
+            _inline_pool = WorkerPool(size).start()
+    return _inline_pool
+
+
+# ---------------- HANDLERS ----------------
+@handler("sync")
+def _sync_job(
+    ctx: JobContext, n: int = 20, incremental: bool = True, with_bodies: bool = True
+):
+    from .gmail_loader import fetch_inbox_with_token, sync_inbox, user_gmail_service
+
+    ctx.progress(0, 1, "Contacting Gmail")
+    ctx.check()
+    options = {
+        "service": user_gmail_service(ctx.user_email),
+        "with_bodies": with_bodies,
+        "user_email": ctx.user_email,
+        "timings": [],
+    }
+    if incremental:
+        result = sync_inbox(n, **options)
+    else:
+        emails = fetch_inbox_with_token(n, **options)
+        result = {"mode": "full", "added": emails, "removed": []}
+    ctx.progress(1, 1, "Synced")
+    return {
+        "mode": result["mode"],
+        "added": len(result["added"]),
+        "removed": len(result["removed"]),
+        "batches": len(options["timings"]),
+        "seconds": round(sum(t["seconds"] for t in options["timings"]), 3),
+    }
+
+
+@handler("ingest")
+def _ingest_job(
+    ctx: JobContext,
+    email_ids: List[str],
+    prompts: Dict[str, str],
+    use_llm: bool = False,
+    force: bool = False,
+    thresholds: Optional[Dict[str, float]] = None,
+):
+    from . import ingestion
+    from .gmail_loader import ensure_bodies, user_gmail_service
+    from .inbox import get_emails
+    from .rate_limit import LLMUsage
+
+    emails = get_emails(ctx.user_email, email_ids)
+    if any(e.get("body_loaded") is False for e in emails):
+        ctx.progress(0, len(emails), "Downloading message bodies")
+        ctx.check()
+        ensure_bodies(ctx.user_email, emails, user_gmail_service(ctx.user_email))
+
+    usage = LLMUsage()
+    results = ingestion.run_ingestion(
+        inbox=emails,
+        prompts=prompts,
+        use_llm=use_llm,
+        force=force,
+        user_email=ctx.user_email,
+        thresholds=thresholds,
+        usage=usage,
+        on_progress=lambda done, total, key, result: ctx.progress(
+            done, total, f"{done}/{total} processed"
+        ),
+        should_stop=ctx.cancelled,
+    )
+    reused = sum(1 for r in results.values() if r.get("cached"))
+    return {
+        "processed": len(results) - reused,
+        "reused": reused,
+        "errors": sum(1 for r in results.values() if "error" in r),
+        "usage": usage.as_dict() if use_llm else None,
+    }
+
+
+@handler("drafts")
+def _drafts_job(
+    ctx: JobContext,
+    prompts: Dict[str, str],
+    email_ids: Optional[List[str]] = None,
+    push: bool = True,
+):
+    from .drafts import auto_draft_todos
+    from .gmail_loader import user_gmail_service
+    from .rate_limit import LLMUsage
+
+    ctx.progress(0, 1, "Finding To-Do emails")
+    ctx.check()
+    usage = LLMUsage()
+    result = auto_draft_todos(
+        ctx.user_email,
+        prompts,
+        service=user_gmail_service(ctx.user_email),
+        email_ids=email_ids,
+        push=push,
+        usage=usage,
+        on_progress=ctx.progress,
+        should_stop=ctx.cancelled,
+    )
+    return {**result, "requests": usage.as_dict()["requests"]}
+
+
+def _serve(threads: int) -> None:
+    pool = WorkerPool(threads).start()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pool.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run background job workers.")
+    parser.add_argument("--processes", type=int, default=1)
+    parser.add_argument("--threads", type=int, default=2, help="per process")
+    args = parser.parse_args()
+
+    if args.processes <= 1:
+        _serve(args.threads)
+        return
+    procs = [
+        multiprocessing.Process(target=_serve, args=(args.threads,))
+        for _ in range(args.processes)
+    ]
+    for p in procs:
+        p.start()
+    try:
+        for p in procs:
+            p.join()
+    except KeyboardInterrupt:
+        for p in procs:
+            p.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+import hashlib
+import json
+import logging
+import threading
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Optional
+
+import streamlit as st
+from cachetools import LRUCache
+from pymongo.errors import PyMongoError
+
+from .mongo_db import get_db
+
+log = logging.getLogger(__name__)
+
+LRU_MAX_ENTRIES = 512
+DEFAULT_TTL_SECONDS = 7 * 24 * 3600
+
+_lru = LRUCache(maxsize=LRU_MAX_ENTRIES)
+_lru_lock = threading.Lock()
+
+_EMPTY_STATS = {"memory_hits": 0, "mongo_hits": 0, "misses": 0}
+_stats = defaultdict(lambda: dict(_EMPTY_STATS))
+_stats_lock = threading.Lock()
+
+
+def cache_key(model: str, prompt: str, config: Optional[Dict[str, Any]] = None) -> str:
+    """sha256 over (model, prompt text, generation config)."""
+    payload = json.dumps(
+        {"model": model, "prompt": prompt, "config": config or {}},
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _user(user_email: Optional[str]) -> str:
+    if user_email:
+        return user_email
+    try:
+        return st.session_state.get("user_email", "anonymous")
+    except Exception:
+        return "anonymous"
+
+
+def _count(user_email: Optional[str], field: str) -> None:
+    with _stats_lock:
+        _stats[_user(user_email)][field] += 1
+
+
+def _now():
+    return datetime.now(timezone.utc)
+
+
+def lookup(key: str, user_email: Optional[str] = None, db=None) -> Optional[str]:
+    """Return a cached response for `key`, checking memory first, then Mongo."""
+    now = _now()
+    with _lru_lock:
+        entry = _lru.get(key)
+    if entry is not None:
+        expires_at, text = entry
+        if expires_at > now:
+            _count(user_email, "memory_hits")
+            return text
+        with _lru_lock:
+            _lru.pop(key, None)
+
+    try:
+        db = db if db is not None else get_db()
+        doc = db.llm_cache.find_one(
+            {"_id": key, "expires_at": {"$gt": now}},
+            {"response": 1, "expires_at": 1},
+        )
+    except PyMongoError as e:
+        log.warning("LLM cache lookup failed: %s", e)
+        doc = None
+
+    if doc is None:
+        _count(user_email, "misses")
+        return None
+
+    expires_at = doc["expires_at"]
+    if expires_at.tzinfo is None:
+        expires_at = expires_at.replace(tzinfo=timezone.utc)
+    with _lru_lock:
+        _lru[key] = (expires_at, doc["response"])
+    _count(user_email, "mongo_hits")
+    return doc["response"]
+
+
+def store(
+    key: str,
+    text: str,
+    model: str,
+    ttl_seconds: int = DEFAULT_TTL_SECONDS,
+    db=None,
+) -> None:
+    """Write a response to both tiers. Mongo expiry is enforced by a TTL index."""
+    now = _now()
+    expires_at = now + timedelta(seconds=ttl_seconds)
+    with _lru_lock:
+        _lru[key] = (expires_at, text)
+    try:
+        db = db if db is not None else get_db()
+        db.llm_cache.update_one(
+            {"_id": key},
+            {
+                "$set": {
+                    "response": text,
+                    "model": model,
+                    "created_at": now,
+                    "expires_at": expires_at,
+                }
+            },
+            upsert=True,
+        )
+    except PyMongoError as e:
+        log.warning("LLM cache store failed: %s", e)
+
+
+def stats(user_email: Optional[str] = None) -> Dict[str, Any]:
+    """Hit/miss counters for one user, or for every user when none is given."""
+    with _stats_lock:
+        if user_email is not None:
+            return dict(_stats.get(user_email, _EMPTY_STATS))
+        return {u: dict(s) for u, s in _stats.items()}
+
+
+def clear_memory() -> None:
+    with _lru_lock:
+        _lru.clear()
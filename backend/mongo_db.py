@@ -1,18 +1,126 @@
 from pymongo import MongoClient
-import os
-from pathlib import Path
-import streamlit as st
+from pymongo import monitoring
+import threading
 
+from .services import services, setting
+from .telemetry import command_listener
 
-def get_mongo_client():
-    uri = None
-    if hasattr(st, "secrets") and st.secrets.get("MONGO_URI"):
-        uri = st.secrets["MONGO_URI"]
-    else:
-        uri = os.environ.get("MONGO_URI")
+# Pool tuning, overridable through Streamlit secrets or the environment.
+POOL_DEFAULTS = {
+    "MONGO_MAX_POOL_SIZE": 50,
+    "MONGO_MIN_POOL_SIZE": 0,
+    "MONGO_MAX_IDLE_TIME_MS": 300000,
+    "MONGO_WAIT_QUEUE_TIMEOUT_MS": 5000,
+    "MONGO_SERVER_SELECTION_TIMEOUT_MS": 5000,
+    "MONGO_CONNECT_TIMEOUT_MS": 5000,
+    "MONGO_SOCKET_TIMEOUT_MS": 20000,
+    "MONGO_READ_PREFERENCE": "primary",
+}
+
+
+class PoolStatsListener(monitoring.ConnectionPoolListener):
+    """Counts connection-pool events per server so the pool can be monitored."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def _bump(self, address, **deltas):
+        key = "%s:%s" % address if isinstance(address, tuple) else str(address)
+        with self._lock:
+            s = self._stats.setdefault(
+                key,
+                {
+                    "open": 0,
+                    "in_use": 0,
+                    "created": 0,
+                    "closed": 0,
+                    "checkouts": 0,
+                    "checkout_failures": 0,
+                    "pool_clears": 0,
+                },
+            )
+            for k, v in deltas.items():
+                s[k] += v
+
+    def snapshot(self):
+        with self._lock:
+            return {addr: dict(s) for addr, s in self._stats.items()}
+
+    def pool_created(self, event):
+        self._bump(event.address)
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self._bump(event.address, pool_clears=1)
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self._bump(event.address, open=1, created=1)
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._bump(event.address, open=-1, closed=1)
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        self._bump(event.address, checkout_failures=1)
+
+    def connection_checked_out(self, event):
+        self._bump(event.address, in_use=1, checkouts=1)
+
+    def connection_checked_in(self, event):
+        self._bump(event.address, in_use=-1)
+
+
+pool_listener = PoolStatsListener()
+
+
+def _create_client():
+    uri = setting("MONGO_URI")
     if not uri:
         raise RuntimeError("MONGO_URI not found in Streamlit secrets or environment.")
-    return MongoClient(uri)
+    opts = {k: setting(k, v) for k, v in POOL_DEFAULTS.items()}
+    return MongoClient(
+        uri,
+        maxPoolSize=int(opts["MONGO_MAX_POOL_SIZE"]),
+        minPoolSize=int(opts["MONGO_MIN_POOL_SIZE"]),
+        maxIdleTimeMS=int(opts["MONGO_MAX_IDLE_TIME_MS"]),
+        waitQueueTimeoutMS=int(opts["MONGO_WAIT_QUEUE_TIMEOUT_MS"]),
+        serverSelectionTimeoutMS=int(opts["MONGO_SERVER_SELECTION_TIMEOUT_MS"]),
+        connectTimeoutMS=int(opts["MONGO_CONNECT_TIMEOUT_MS"]),
+        socketTimeoutMS=int(opts["MONGO_SOCKET_TIMEOUT_MS"]),
+        readPreference=opts["MONGO_READ_PREFERENCE"],
+        event_listeners=[pool_listener, command_listener],
+        appname="email-agent",
+    )
+
+
+services.register("mongo", _create_client)
+
+
+def get_mongo_client():
+    """Return the process-wide MongoClient, creating it on first use."""
+    return services.get("mongo")
+
+
+def close_mongo_client():
+    client = services.reset("mongo")
+    if client is not None:
+        client.close()
+
+
+def pool_stats():
+    """Connection-pool counters per server address (open, in_use, checkouts, ...)."""
+    return pool_listener.snapshot()
 
 
 def get_db(db_name="email_agent"):
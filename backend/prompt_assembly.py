@@ -0,0 +1,144 @@
+import re
+from typing import Dict, Optional
+from urllib.parse import urlsplit
+
+from .rate_limit import estimate_tokens
+
+CHARS_PER_TOKEN = 4
+# Token budget for the email body in each task's prompt.
+TASK_BODY_BUDGETS = {
+    "categorize": 1000,
+    "actions": 2000,
+    "summary": 2000,
+    "draft": 1500,
+    "general": 2000,
+    # per message folded into a rolling thread summary
+    "thread": 800,
+}
+DEFAULT_BODY_BUDGET = 2000
+# Share of a truncated body kept from the start; the rest comes from the end.
+HEAD_SHARE = 0.8
+# URLs longer than this are replaced by their host.
+MAX_URL_CHARS = 40
+# A legal footer is only cut if it starts a paragraph within this many
+# non-blank lines of the end of the message. Footers after a signature
+# delimiter go with the signature.
+LEGAL_FOOTER_MAX_LINES = 8
+
+# Where quoted history starts: Gmail/Apple "On ... wrote:" (possibly wrapped
+# onto two lines), Outlook "Original Message" separators and header blocks.
+_QUOTE_MARKERS = re.compile(
+    r"^(?:On\b[^\n]{0,200}(?:\n[^\n]{0,200})?\bwrote:[ \t]*$"
+    r"|-{2,}[ \t]*Original Message[ \t]*-{2,}"
+    r"|_{10,}[ \t]*\n+From:[ \t]"
+    r"|From:[ \t][^\n]+\n(?:Sent|Date):[ \t])",
+    re.M | re.I,
+)
+# "-- " is the standard (RFC 3676) signature delimiter. A bare "--" is too
+# often a separator inside the message to cut at.
+_SIGNATURE = re.compile(r"^-- $", re.M)
+_MOBILE_FOOTER = re.compile(
+    r"^[ \t]*(?:Sent from my [^\n]+|Get Outlook for [^\n]+)[ \t]*$", re.M | re.I
+)
+_LEGAL_FOOTER = re.compile(
+    r"^[ \t]*(?:CONFIDENTIALITY NOTICE|DISCLAIMER"
+    r"|This (?:e-?mail|message)(?: and any (?:files|attachments)[^\n]*?)?"
+    r" (?:is|are|may contain|contains)"
+    r" (?:confidential|privileged|intended (?:only|solely) for))",
+    re.M | re.I,
+)
+_QUOTED_LINE = re.compile(r"^[ \t]*>[^\n]*\n?", re.M)
+_URL = re.compile(r"https?://[^\s<>()\"']+")
+_BLANK_LINES = re.compile(r"\n[ \t]*(?:\n[ \t]*){2,}")
+_TRAILING_SPACE = re.compile(r"[ \t]+$", re.M)
+
+
+def _cut_at(text: str, match: Optional[re.Match]) -> str:
+    # Never cut everything: a message that is all quote keeps its content.
+    if match and text[: match.start()].strip():
+        return text[: match.start()]
+    return text
+
+
+def _legal_footer(text: str) -> Optional[re.Match]:
+    # a footer is set apart at the end of the message, however short the
+    # message is; a matching sentence inside a paragraph is content
+    for match in _LEGAL_FOOTER.finditer(text):
+        head = text[: match.start()]
+        gap = head[len(head.rstrip()) :]
+        tail = text[match.start() :]
+        lines = sum(1 for line in tail.split("\n") if line.strip())
+        if gap.count("\n") >= 2 and lines <= LEGAL_FOOTER_MAX_LINES:
+            return match
+    return None
+
+
+def _shorten_url(match: re.Match) -> str:
+    url = match.group(0)
+    if len(url) <= MAX_URL_CHARS:
+        return url
+    host = urlsplit(url).hostname or "link"
+    return f"[link: {host}]"
+
+
+def clean_body(text: str) -> str:
+    """
+    The part of a message body worth sending to the model: quoted reply
+    history, signatures, mobile and legal footers removed, tracking links
+    reduced to their host and runs of blank lines collapsed.
+    """
+    text = (text or "").replace("\r\n", "\n")
+    text = _cut_at(text, _QUOTE_MARKERS.search(text))
+    text = _cut_at(text, _SIGNATURE.search(text))
+    text = _cut_at(text, _legal_footer(text))
+    text = _MOBILE_FOOTER.sub("", text)
+    stripped = _QUOTED_LINE.sub("", text)
+    text = stripped if stripped.strip() else text
+    text = _URL.sub(_shorten_url, text)
+    text = _TRAILING_SPACE.sub("", text)
+    return _BLANK_LINES.sub("\n\n", text).strip()
+
+
+def _boundary(text: str, pos: int, forward: bool) -> int:
+    """Nearest paragraph, sentence or word break to `pos` within 20% of it."""
+    window = max(1, pos // 5) if not forward else max(1, (len(text) - pos) // 5)
+    lo, hi = (pos, pos + window) if forward else (pos - window, pos)
+    for sep in ("\n\n", ". ", "\n", " "):
+        idx = text.find(sep, lo, hi) if forward else text.rfind(sep, lo, hi)
+        if idx != -1:
+            return idx + len(sep) if forward else idx + (1 if sep == ". " else 0)
+    return pos
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """
+    Fit `text` in roughly `max_tokens`, keeping the opening (where requests
+    usually are) and the closing lines, cut at natural breaks.
+    """
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    if len(text) <= max_chars:
+        return text
+    head_end = _boundary(text, int(max_chars * HEAD_SHARE), forward=False)
+    tail_start = _boundary(text, len(text) - (max_chars - head_end), forward=True)
+    omitted = tail_start - head_end
+    return (
+        text[:head_end].rstrip()
+        + f"\n[... {omitted} characters omitted ...]\n"
+        + text[tail_start:].lstrip()
+    )
+
+
+def prepare_body(text: str, task: str) -> str:
+    """Cleaned body, truncated to the budget for `task`."""
+    budget = TASK_BODY_BUDGETS.get(task, DEFAULT_BODY_BUDGET)
+    return truncate_to_tokens(clean_body(text), budget)
+
+
+def token_counts(prompt: str, raw_body: str, body: str) -> Dict[str, int]:
+    """
+    Estimated input tokens of `prompt` as sent and as it would have been
+    with the uncleaned body.
+    """
+    after = estimate_tokens(prompt)
+    before = after - estimate_tokens(body) + estimate_tokens(raw_body)
+    return {"before": before, "after": after}
@@ -1,6 +1,8 @@
 from pathlib import Path
+import difflib
 import streamlit as st
 import time
+from pymongo import DESCENDING, ReturnDocument
 from backend.mongo_db import get_db
 
 DATA_DIR = Path("data")
@@ -13,30 +15,125 @@ DEFAULT_PROMPTS = {
     "tone_instructions": "If user specifies a tone (friendly/professional/concise), adapt the reply accordingly.",
 }
 
-db = get_db()
+# How long a session trusts its cached prompts before re-checking the
+# version counter (picks up edits made from another session).
+PROMPT_CACHE_TTL_SECONDS = 30
+# Newest version first; legacy documents without a version sort last.
+LATEST_FIRST = [("version", DESCENDING), ("timestamp", DESCENDING)]
+
+
+def _next_version(user_email):
+    counter = get_db().prompt_counters.find_one_and_update(
+        {"_id": user_email},
+        {"$inc": {"version": 1}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+    )
+    return counter["version"]
+
+
+def latest_prompt_version(user_email=None):
+    """The user's newest prompt version number (0 if never versioned)."""
+    user_email = user_email or st.session_state["user_email"]
+    counter = get_db().prompt_counters.find_one({"_id": user_email})
+    return (counter or {}).get("version", 0)
+
+
+def _cache(user_email, version, prompts):
+    st.session_state["prompt_cache"] = {
+        "user_email": user_email,
+        "version": version,
+        "prompts": prompts,
+        "checked_at": time.time(),
+    }
 
 
 def save_prompts(new_prompts):
-    db.prompts.insert_one(
+    user_email = st.session_state["user_email"]
+    version = _next_version(user_email)
+    get_db().prompts.insert_one(
         {
-            "user_email": st.session_state["user_email"],
+            "user_email": user_email,
+            "version": version,
             "timestamp": int(time.time()),
             "prompt_brain": new_prompts,
         }
     )
+    _cache(user_email, version, dict(new_prompts))
+    return version
 
 
 def load_prompts():
-    prompt_data = db.prompts.find(
-        {"user_email": st.session_state["user_email"]}
-    ).to_list()
-    if prompt_data:
-        prompts = dict(prompt_data[0])["prompt_brain"]
+    """
+    The user's latest prompts. Served from the session cache while its
+    version matches the user's version counter; otherwise one indexed
+    find_one of the newest version.
+    """
+    user_email = st.session_state["user_email"]
+    cached = st.session_state.get("prompt_cache")
+    if cached and cached["user_email"] == user_email:
+        if time.time() - cached["checked_at"] < PROMPT_CACHE_TTL_SECONDS:
+            return cached["prompts"]
+        if latest_prompt_version(user_email) == cached["version"]:
+            cached["checked_at"] = time.time()
+            return cached["prompts"]
+
+    doc = get_db().prompts.find_one({"user_email": user_email}, sort=LATEST_FIRST)
+    if doc:
+        prompts = dict(doc["prompt_brain"])
+        _cache(user_email, doc.get("version", 0), prompts)
         return prompts
     else:
         reset_prompts()
         return DEFAULT_PROMPTS
 
 
+def get_prompt_version():
+    """Version number of the prompts load_prompts() returns."""
+    load_prompts()
+    return st.session_state["prompt_cache"]["version"]
+
+
+def list_prompt_versions(limit=20):
+    """Newest-first metadata of past versions: version, timestamp."""
+    cursor = (
+        get_db().prompts.find(
+            {"user_email": st.session_state["user_email"]},
+            {"_id": 0, "version": 1, "timestamp": 1},
+        )
+        .sort(LATEST_FIRST)
+        .limit(limit)
+    )
+    return list(cursor)
+
+
+def get_prompts_at(version):
+    doc = get_db().prompts.find_one(
+        {"user_email": st.session_state["user_email"], "version": version},
+        {"prompt_brain": 1},
+    )
+    return dict(doc["prompt_brain"]) if doc else None
+
+
+def diff_prompt_versions(old_version, new_version):
+    """Unified diff per prompt key that changed between two versions."""
+    old = get_prompts_at(old_version) or {}
+    new = get_prompts_at(new_version) or {}
+    diffs = {}
+    for key in sorted(set(old) | set(new)):
+        if old.get(key) == new.get(key):
+            continue
+        diffs[key] = "\n".join(
+            difflib.unified_diff(
+                (old.get(key) or "").splitlines(),
+                (new.get(key) or "").splitlines(),
+                fromfile=f"v{old_version}",
+                tofile=f"v{new_version}",
+                lineterm="",
+            )
+        )
+    return diffs
+
+
 def reset_prompts():
     save_prompts(DEFAULT_PROMPTS)
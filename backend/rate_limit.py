@@ -0,0 +1,123 @@
+import threading
+import time
+from typing import Callable, Optional
+
+from .services import setting
+
+# Default Gemini budget: the paid Tier 1 quota of gemini-2.5-flash (1,000
+# requests and 1,000,000 input tokens per minute). At that rate ingesting 200
+# emails (about 2 calls each) never waits on the limiter. On the free tier
+# (10 RPM, 250,000 TPM) set GEMINI_RPM=10 GEMINI_TPM=250000; 200 emails then
+# take about 40 minutes. Both are read (Streamlit secrets, then the
+# environment) when the shared limiter is first built.
+DEFAULT_RPM = 1000
+DEFAULT_TPM = 1000000
+
+
+def estimate_tokens(text: str) -> int:
+    """Cheap token estimate (~4 characters per token for English text)."""
+    return max(1, len(text or "") // 4)
+
+
+class RateLimiter:
+    """
+    Token-bucket limiter for a requests-per-minute and an optional
+    tokens-per-minute budget. `acquire()` blocks until both allow the call.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: int = DEFAULT_RPM,
+        tokens_per_minute: Optional[int] = DEFAULT_TPM,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], None] = time.sleep,
+    ):
+        self.rpm = float(requests_per_minute)
+        self.tpm = float(tokens_per_minute) if tokens_per_minute else None
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._requests = self.rpm
+        self._tokens = self.tpm or 0.0
+        self._last = clock()
+
+    def _refill(self, now: float) -> None:
+        elapsed = now - self._last
+        self._last = now
+        self._requests = min(self.rpm, self._requests + elapsed * self.rpm / 60.0)
+        if self.tpm:
+            self._tokens = min(self.tpm, self._tokens + elapsed * self.tpm / 60.0)
+
+    def acquire(self, tokens: int = 1) -> float:
+        """Take one request and `tokens` tokens from the budget; returns the wait."""
+        waited = 0.0
+        if self.tpm:
+            tokens = min(tokens, self.tpm)
+        while True:
+            with self._lock:
+                self._refill(self._clock())
+                need_req = 1.0 - self._requests
+                need_tok = (tokens - self._tokens) if self.tpm else 0.0
+                if need_req <= 0 and need_tok <= 0:
+                    self._requests -= 1.0
+                    if self.tpm:
+                        self._tokens -= tokens
+                    return waited
+                wait = max(
+                    need_req * 60.0 / self.rpm if need_req > 0 else 0.0,
+                    need_tok * 60.0 / self.tpm if need_tok > 0 else 0.0,
+                )
+            self._sleep(wait)
+            waited += wait
+
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def get_gemini_limiter() -> RateLimiter:
+    """Process-wide limiter, since the Gemini quota is per API key, not per session."""
+    global _shared
+    if _shared is None:
+        with _shared_lock:
+            if _shared is None:
+                _shared = RateLimiter(
+                    int(setting("GEMINI_RPM", DEFAULT_RPM)),
+                    int(setting("GEMINI_TPM", DEFAULT_TPM)),
+                )
+    return _shared
+
+
+class LLMUsage:
+    """
+    Thread-safe counters for one ingestion run: Gemini requests and prompt
+    tokens, plus how many emails each classification tier settled and the
+    requests/tokens the rule tier saved (estimated).
+    """
+
+    FIELDS = (
+        "requests",
+        "prompt_tokens",
+        "batched_requests",
+        "fallback_requests",
+        "rules_tier",
+        "llm_tier",
+        "saved_requests",
+        "saved_prompt_tokens",
+    )
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = {f: 0 for f in self.FIELDS}
+
+    def add(self, **deltas: int) -> None:
+        with self._lock:
+            for k, v in deltas.items():
+                self._counts[k] = self._counts.get(k, 0) + v
+
+    def record_request(self, prompt: str) -> None:
+        self.add(requests=1, prompt_tokens=estimate_tokens(prompt))
+
+    def as_dict(self):
+        with self._lock:
+            return dict(self._counts)
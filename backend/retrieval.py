@@ -0,0 +1,250 @@
+import re
+import threading
+import zlib
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+import numpy as np
+from cachetools import LRUCache
+
+from .mongo_db import get_db
+
+# 384 float32 dims = 1.5 KB per chunk, ~110 MB for a 50k-email mailbox
+EMBED_DIM = 384
+CHUNK_CHARS = 800
+CHUNK_OVERLAP = 120
+DEFAULT_TOP_K = 8
+# Users whose index is kept in memory; the least recently used is dropped
+# and rebuilt from Mongo when next asked for.
+INDEX_CACHE_SIZE = 4
+# Emails embedded between progress reports while an index is (re)built.
+INDEX_BATCH_SIZE = 500
+_WORD = re.compile(r"[a-z0-9]+")
+INDEX_PROJECTION = {
+    "_id": 0,
+    "email_id": 1,
+    "subject": 1,
+    "sender": 1,
+    "body": 1,
+    "fetched_at": 1,
+}
+
+
+def chunk_email(
+    email: Dict[str, Any], max_chars: int = CHUNK_CHARS, overlap: int = CHUNK_OVERLAP
+) -> List[str]:
+    """Split an email into overlapping body windows headed by subject and sender."""
+    header = f"Subject: {email.get('subject', '')}\nFrom: {email.get('sender', '')}\n"
+    body = " ".join((email.get("body") or "").split())
+    if len(body) <= max_chars:
+        return [header + body]
+    chunks, start = [], 0
+    step = max_chars - overlap
+    while start < len(body):
+        end = min(len(body), start + max_chars)
+        if end < len(body):
+            # prefer to cut at a word boundary
+            space = body.rfind(" ", start + step // 2, end)
+            end = space if space > start else end
+        chunks.append(header + body[start:end])
+        if end >= len(body):
+            break
+        start = max(end - overlap, start + 1)
+    return chunks
+
+
+class HashedNgramEmbedder:
+    """
+    Network-free text embedder: word unigrams and bigrams hashed (crc32,
+    signed) into `dim` buckets, log-scaled and L2-normalized. Deterministic
+    across processes, so vectors can be compared between runs.
+    """
+
+    def __init__(self, dim: int = EMBED_DIM):
+        self.dim = dim
+
+    def _features(self, text: str) -> List[str]:
+        words = _WORD.findall(text.lower())
+        return words + [a + " " + b for a, b in zip(words, words[1:])]
+
+    def embed(self, text: str) -> np.ndarray:
+        feats = self._features(text)
+        vec = np.zeros(self.dim, dtype=np.float32)
+        if not feats:
+            return vec
+        hashes = np.fromiter(
+            (zlib.crc32(f.encode("utf-8")) for f in feats),
+            dtype=np.uint32,
+            count=len(feats),
+        )
+        buckets = (hashes % self.dim).astype(np.intp)
+        signs = np.where(hashes & 0x80000000, -1.0, 1.0).astype(np.float32)
+        counts = np.bincount(buckets, weights=signs, minlength=self.dim)
+        vec = (np.sign(counts) * np.log1p(np.abs(counts))).astype(np.float32)
+        norm = np.linalg.norm(vec)
+        return vec / norm if norm else vec
+
+    def embed_many(self, texts: Iterable[str]) -> np.ndarray:
+        rows = [self.embed(t) for t in texts]
+        if not rows:
+            return np.zeros((0, self.dim), dtype=np.float32)
+        return np.vstack(rows)
+
+
+class EmbeddingIndex:
+    """
+    Chunk vectors in one contiguous float32 matrix. Rows of removed emails
+    are zeroed and reused; top-k search is a single matrix-vector product.
+    """
+
+    def __init__(self, embedder: Optional[HashedNgramEmbedder] = None):
+        self.embedder = embedder or HashedNgramEmbedder()
+        self.matrix = np.zeros((0, self.embedder.dim), dtype=np.float32)
+        self.size = 0
+        self.chunks: List[Optional[Dict[str, Any]]] = []
+        self.rows_by_email: Dict[str, List[int]] = {}
+        self._free: List[int] = []
+        self.watermark = 0.0  # newest fetched_at already indexed
+        self._lock = threading.RLock()
+
+    def __len__(self) -> int:
+        return len(self.rows_by_email)
+
+    def _reserve(self, n: int) -> List[int]:
+        rows = [self._free.pop() for _ in range(min(n, len(self._free)))]
+        needed = n - len(rows)
+        if needed:
+            if self.size + needed > len(self.matrix):
+                capacity = max(256, 2 * len(self.matrix), self.size + needed)
+                grown = np.zeros((capacity, self.embedder.dim), dtype=np.float32)
+                grown[: self.size] = self.matrix[: self.size]
+                self.matrix = grown
+                self.chunks.extend([None] * (capacity - len(self.chunks)))
+            rows.extend(range(self.size, self.size + needed))
+            self.size += needed
+        return rows
+
+    def add_emails(self, emails: Iterable[Dict[str, Any]]) -> int:
+        """(Re-)index emails; returns the number of chunks embedded."""
+        added = 0
+        with self._lock:
+            for email in emails:
+                email_id = email["email_id"]
+                self.remove_emails([email_id])
+                texts = chunk_email(email)
+                rows = self._reserve(len(texts))
+                self.matrix[rows] = self.embedder.embed_many(texts)
+                for chunk_no, (row, text) in enumerate(zip(rows, texts)):
+                    self.chunks[row] = {
+                        "email_id": email_id,
+                        "chunk_no": chunk_no,
+                        "subject": email.get("subject", ""),
+                        "sender": email.get("sender", ""),
+                        "text": text,
+                    }
+                self.rows_by_email[email_id] = rows
+                self.watermark = max(self.watermark, email.get("fetched_at") or 0)
+                added += len(texts)
+        return added
+
+    def remove_emails(self, email_ids: Iterable[str]) -> None:
+        with self._lock:
+            for email_id in email_ids:
+                rows = self.rows_by_email.pop(email_id, None)
+                if not rows:
+                    continue
+                self.matrix[rows] = 0.0
+                for row in rows:
+                    self.chunks[row] = None
+                self._free.extend(rows)
+
+    def query(self, text: str, k: int = DEFAULT_TOP_K) -> List[Dict[str, Any]]:
+        """Top-k chunks by cosine similarity (vectors are unit length)."""
+        q = self.embedder.embed(text)
+        with self._lock:
+            if not self.size or not q.any():
+                return []
+            scores = self.matrix[: self.size] @ q
+            # freed rows must not take top-k places from live chunks
+            scores[self._free] = -np.inf
+            k = min(k, self.size - len(self._free))
+            if k <= 0:
+                return []
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            return [
+                {**self.chunks[i], "score": float(scores[i])}
+                for i in top
+                if scores[i] > 0
+            ]
+
+
+_indexes: "LRUCache[str, EmbeddingIndex]" = LRUCache(maxsize=INDEX_CACHE_SIZE)
+_indexes_lock = threading.Lock()
+
+
+def get_user_index(
+    user_email: str,
+    db=None,
+    on_progress: Optional[Callable[[int, int], None]] = None,
+) -> EmbeddingIndex:
+    """
+    The process-wide index for a user, brought up to date with any inbox
+    documents fetched since it was last refreshed. The first call (or the
+    first after eviction) embeds the whole mailbox; `on_progress(done,
+    total)` is called as it goes.
+    """
+    with _indexes_lock:
+        index = _indexes.get(user_email)
+        if index is None:
+            index = _indexes[user_email] = EmbeddingIndex()
+    refresh_user_index(user_email, index, db, on_progress)
+    return index
+
+
+def refresh_user_index(
+    user_email: str,
+    index: EmbeddingIndex,
+    db=None,
+    on_progress: Optional[Callable[[int, int], None]] = None,
+) -> int:
+    db = db if db is not None else get_db()
+    query = {"user_email": user_email, "fetched_at": {"$gt": index.watermark}}
+    cursor = db.inboxes.find(query, INDEX_PROJECTION)
+    if on_progress is None:
+        return index.add_emails(cursor)
+    total = db.inboxes.count_documents(query)
+    added, done, batch = 0, 0, []
+    for email in cursor:
+        batch.append(email)
+        if len(batch) == INDEX_BATCH_SIZE:
+            added += index.add_emails(batch)
+            done += len(batch)
+            batch = []
+            on_progress(done, total)
+    if batch:
+        added += index.add_emails(batch)
+        on_progress(done + len(batch), total)
+    return added
+
+
+def reindex_emails(user_email: str, email_ids: Iterable[str], db=None) -> None:
+    """Re-embed stored emails whose content changed, if the user's index is loaded."""
+    with _indexes_lock:
+        index = _indexes.get(user_email)
+    if index is None:
+        return
+    db = db if db is not None else get_db()
+    index.add_emails(
+        db.inboxes.find(
+            {"user_email": user_email, "email_id": {"$in": list(email_ids)}},
+            INDEX_PROJECTION,
+        )
+    )
+
+
+def forget_emails(user_email: str, email_ids: Iterable[str]) -> None:
+    """Drop deleted mail from the user's index, if one is loaded."""
+    with _indexes_lock:
+        index = _indexes.get(user_email)
+    if index is not None:
+        index.remove_emails(email_ids)
@@ -0,0 +1,289 @@
+import heapq
+import math
+import re
+from collections import defaultdict
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from .mongo_db import get_db
+
+DEFAULT_PAGE_SIZE = 20
+# Relative importance of a hit in each field; mirrors the Mongo text index.
+FIELD_WEIGHTS = {"subject": 5.0, "sender": 3.0, "body": 1.0}
+RESULT_PROJECTION = {
+    "_id": 0,
+    "email_id": 1,
+    "sender": 1,
+    "subject": 1,
+    "timestamp": 1,
+    "internal_date": 1,
+}
+STOPWORDS = frozenset(
+    "a an and are as at be by for from has have i in is it me my of on or "
+    "re the this to was we with you your".split()
+)
+_TOKEN = re.compile(r"[a-z0-9]+")
+# Posting lists at least this long are sorted by weight when the index is
+# built rather than by the first query that needs them.
+PRESORT_MIN_POSTINGS = 1000
+
+
+def tokenize(text: str) -> List[str]:
+    return [t for t in _TOKEN.findall((text or "").lower()) if t not in STOPWORDS]
+
+
+def _category_ids(db, user_email: str, category: str) -> List[str]:
+    return [
+        d["email_id"]
+        for d in db.processed.find(
+            {"user_email": user_email, "category": category}, {"email_id": 1}
+        )
+    ]
+
+
+def search_inbox(
+    user_email: str,
+    query: str = "",
+    sender: Optional[str] = None,
+    subject: Optional[str] = None,
+    date_from: Optional[int] = None,
+    date_to: Optional[int] = None,
+    category: Optional[str] = None,
+    page: int = 0,
+    page_size: int = DEFAULT_PAGE_SIZE,
+    db=None,
+    index: Optional["InvertedIndex"] = None,
+) -> Dict[str, Any]:
+    """
+    Ranked search over sender, subject and body.
+
+    `query` uses the user-scoped Mongo text index (terms are OR-ed, quoted
+    phrases must match). `sender`/`subject` are case-insensitive substring
+    filters, `date_from`/`date_to` bound internalDate in epoch ms, and
+    `category` restricts to emails with that processed category. Pass an
+    InvertedIndex as `index` to search in memory instead of Mongo.
+    Returns {"results", "page", "has_more"}.
+    """
+    if index is not None:
+        categories = None
+        if category:
+            db = db if db is not None else get_db()
+            categories = set(_category_ids(db, user_email, category))
+        return index.search(
+            query,
+            sender=sender,
+            subject=subject,
+            date_from=date_from,
+            date_to=date_to,
+            email_ids=categories,
+            page=page,
+            page_size=page_size,
+        )
+
+    db = db if db is not None else get_db()
+    filt: Dict[str, Any] = {"user_email": user_email}
+    if query.strip():
+        filt["$text"] = {"$search": query}
+    if sender:
+        filt["sender"] = {"$regex": re.escape(sender), "$options": "i"}
+    if subject:
+        filt["subject"] = {"$regex": re.escape(subject), "$options": "i"}
+    if date_from is not None or date_to is not None:
+        filt["internal_date"] = {}
+        if date_from is not None:
+            filt["internal_date"]["$gte"] = date_from
+        if date_to is not None:
+            filt["internal_date"]["$lte"] = date_to
+    if category:
+        filt["email_id"] = {"$in": _category_ids(db, user_email, category)}
+
+    projection = dict(RESULT_PROJECTION)
+    if "$text" in filt:
+        projection["score"] = {"$meta": "textScore"}
+        sort = [("score", {"$meta": "textScore"})]
+    else:
+        sort = [("internal_date", -1), ("email_id", -1)]
+
+    cursor = (
+        db.inboxes.find(filt, projection)
+        .sort(sort)
+        .skip(page * page_size)
+        .limit(page_size + 1)
+    )
+    results = list(cursor)
+    return {
+        "results": results[:page_size],
+        "page": page,
+        "has_more": len(results) > page_size,
+    }
+
+
+class InvertedIndex:
+    """
+    In-memory field-weighted TF-IDF index over inbox documents, for tests
+    and offline use. Terms are OR-ed and ranked like the Mongo text index;
+    quoted phrases are treated as plain terms.
+
+    Each term's postings are also kept highest weight first, sorted on first
+    use after a change (or when the index is built, for long lists). A query
+    walks those lists side by side and stops once no email it has not seen
+    can rank on the page (Fagin's threshold algorithm), so common terms cost
+    the depth of the page rather than their whole posting list. Browsing
+    without terms walks emails newest first until the page is full.
+    """
+
+    def __init__(self, emails: Iterable[Dict[str, Any]] = ()):
+        self.postings: Dict[str, Dict[str, float]] = defaultdict(dict)
+        self.docs: Dict[str, Dict[str, Any]] = {}
+        self._terms: Dict[str, List[str]] = {}
+        self._ranked: Dict[str, List[Tuple[float, str]]] = {}
+        self._newest: Optional[List[str]] = None
+        for email in emails:
+            self.add(email)
+        for term, posting in self.postings.items():
+            if len(posting) >= PRESORT_MIN_POSTINGS:
+                self._ranked_postings(term)
+        self._newest_first()
+
+    def add(self, email: Dict[str, Any]) -> None:
+        email_id = email["email_id"]
+        if email_id in self.docs:
+            self.remove(email_id)
+        weights: Dict[str, float] = defaultdict(float)
+        for field, w in FIELD_WEIGHTS.items():
+            for term in tokenize(email.get(field, "")):
+                weights[term] += w
+        for term, w in weights.items():
+            self.postings[term][email_id] = w
+            self._ranked.pop(term, None)
+        self._terms[email_id] = list(weights)
+        self.docs[email_id] = {
+            k: email.get(k) for k in RESULT_PROJECTION if k != "_id"
+        }
+        self._newest = None
+
+    def remove(self, email_id: str) -> None:
+        for term in self._terms.pop(email_id, []):
+            self._ranked.pop(term, None)
+            posting = self.postings.get(term)
+            if posting is not None:
+                posting.pop(email_id, None)
+                if not posting:
+                    del self.postings[term]
+        self.docs.pop(email_id, None)
+        self._newest = None
+
+    def __len__(self) -> int:
+        return len(self.docs)
+
+    def _ranked_postings(self, term: str) -> List[Tuple[float, str]]:
+        ranked = self._ranked.get(term)
+        if ranked is None:
+            ranked = self._ranked[term] = sorted(
+                ((w, email_id) for email_id, w in self.postings[term].items()),
+                key=lambda p: (-p[0], p[1]),
+            )
+        return ranked
+
+    def _newest_first(self) -> List[str]:
+        if self._newest is None:
+            self._newest = sorted(
+                self.docs,
+                key=lambda i: (self.docs[i].get("internal_date") or 0, i),
+                reverse=True,
+            )
+        return self._newest
+
+    def _matches(self, doc, sender, subject, date_from, date_to) -> bool:
+        if sender and sender.lower() not in (doc.get("sender") or "").lower():
+            return False
+        if subject and subject.lower() not in (doc.get("subject") or "").lower():
+            return False
+        date = doc.get("internal_date") or 0
+        if date_from is not None and date < date_from:
+            return False
+        if date_to is not None and date > date_to:
+            return False
+        return True
+
+    def _top_scored(
+        self, terms: Iterable[str], want: int, accept: Callable[[str], bool]
+    ) -> Tuple[List[str], Dict[str, float]]:
+        """The `want` best accepted emails for `terms` and their scores."""
+        n = max(len(self.docs), 1)
+        terms = [t for t in terms if self.postings.get(t)]
+        lists = [
+            (math.log(1 + n / len(self.postings[t])), self.postings[t]) for t in terms
+        ]
+        ranked = [self._ranked_postings(t) for t in terms]
+        scores: Dict[str, float] = {}
+        seen = set()
+        kept: List[float] = []  # the `want` best scores so far, worst first
+        depth = 0
+        while True:
+            # no email past `depth` in every list can score above this
+            threshold = 0.0
+            for (idf, _), postings in zip(lists, ranked):
+                if depth >= len(postings):
+                    continue
+                w, email_id = postings[depth]
+                threshold += idf * w
+                if email_id in seen:
+                    continue
+                seen.add(email_id)
+                if not accept(email_id):
+                    continue
+                score = sum(i * p.get(email_id, 0.0) for i, p in lists)
+                scores[email_id] = score
+                if len(kept) < want:
+                    heapq.heappush(kept, score)
+                elif score > kept[0]:
+                    heapq.heapreplace(kept, score)
+            if not threshold or (len(kept) >= want and kept[0] > threshold):
+                break
+            depth += 1
+        top = heapq.nsmallest(want, scores, key=lambda i: (-scores[i], i))
+        return top, scores
+
+    def search(
+        self,
+        query: str = "",
+        sender: Optional[str] = None,
+        subject: Optional[str] = None,
+        date_from: Optional[int] = None,
+        date_to: Optional[int] = None,
+        email_ids: Optional[set] = None,
+        page: int = 0,
+        page_size: int = DEFAULT_PAGE_SIZE,
+    ) -> Dict[str, Any]:
+        def accept(email_id: str) -> bool:
+            if email_ids is not None and email_id not in email_ids:
+                return False
+            return self._matches(
+                self.docs[email_id], sender, subject, date_from, date_to
+            )
+
+        terms = set(tokenize(query))
+        start = page * page_size
+        # one more than the page says whether there is a next one
+        want = start + page_size + 1
+        if terms:
+            top, scores = self._top_scored(terms, want, accept)
+        else:
+            top, scores = [], {}
+            for email_id in self._newest_first():
+                if accept(email_id):
+                    top.append(email_id)
+                    if len(top) == want:
+                        break
+
+        results = []
+        for email_id in top[start : start + page_size]:
+            doc = dict(self.docs[email_id])
+            if terms:
+                doc["score"] = round(scores[email_id], 4)
+            results.append(doc)
+        return {
+            "results": results,
+            "page": page,
+            "has_more": len(top) > start + page_size,
+        }
@@ -0,0 +1,69 @@
+"""
+Lazily created, process-wide services.
+
+Importing the backend opens no connections and reads no secrets. Each
+service (the MongoDB client, the Gemini client, the token encryption key,
+the app's one-time start-up work) is registered here by the module that
+owns it and built by its factory on first get(), then cached for the
+life of the process. Tests and benchmarks swap in doubles with override()
+before or after first use:
+
+    services.override("mongo", FakeMongoClient())
+"""
+
+import os
+import threading
+from typing import Any, Callable, Dict, Optional
+
+
+def setting(name: str, default: Optional[str] = None) -> Optional[str]:
+    """A Streamlit secret if one is set, else the environment variable."""
+    try:
+        import streamlit as st
+
+        if st.secrets.get(name):
+            return st.secrets[name]
+    except Exception:  # no Streamlit or no secrets file
+        pass
+    return os.environ.get(name, default)
+
+
+class Services:
+    """Named factories and the instances they built."""
+
+    def __init__(self):
+        self._factories: Dict[str, Callable[[], Any]] = {}
+        self._instances: Dict[str, Any] = {}
+        # reentrant: a factory may get() the services it depends on
+        self._lock = threading.RLock()
+
+    def register(self, name: str, factory: Callable[[], Any]) -> None:
+        self._factories[name] = factory
+
+    def get(self, name: str) -> Any:
+        try:
+            return self._instances[name]
+        except KeyError:
+            pass
+        with self._lock:
+            if name not in self._instances:
+                if name not in self._factories:
+                    raise KeyError(f"No service registered as {name!r}.")
+                self._instances[name] = self._factories[name]()
+            return self._instances[name]
+
+    def created(self, name: str) -> bool:
+        return name in self._instances
+
+    def override(self, name: str, instance: Any) -> None:
+        """Use `instance` for `name` from now on, e.g. a test double."""
+        with self._lock:
+            self._instances[name] = instance
+
+    def reset(self, name: str) -> Any:
+        """Forget the instance of `name` (returned, if any); get() builds a new one."""
+        with self._lock:
+            return self._instances.pop(name, None)
+
+
+services = Services()
@@ -0,0 +1,185 @@
+import logging
+import threading
+from typing import Any, Dict, Iterable, List, Sequence
+
+from pymongo import ASCENDING, DESCENDING, TEXT, IndexModel, UpdateOne
+from pymongo.errors import OperationFailure
+
+log = logging.getLogger(__name__)
+
+# Mongo caps a single bulk_write message at 100k ops; keep batches small
+# enough that a retry after a network blip is cheap.
+DEFAULT_BULK_BATCH = 1000
+
+# Every index the app's access paths rely on, per collection. Index names are
+# fixed so create_indexes() is a no-op once they exist.
+INDEXES: Dict[str, List[IndexModel]] = {
+    "inboxes": [
+        IndexModel(
+            [("user_email", ASCENDING), ("email_id", ASCENDING)],
+            name="user_email_id",
+            unique=True,
+        ),
+        IndexModel(
+            [
+                ("user_email", ASCENDING),
+                ("fetched_at", DESCENDING),
+                ("email_id", DESCENDING),
+            ],
+            name="user_fetched_at_id",
+        ),
+        # a thread's messages in date order
+        IndexModel(
+            [
+                ("user_email", ASCENDING),
+                ("thread_id", ASCENDING),
+                ("internal_date", ASCENDING),
+            ],
+            name="user_thread_date",
+        ),
+        # one text index per collection; the user_email prefix scopes searches
+        IndexModel(
+            [
+                ("user_email", ASCENDING),
+                ("subject", TEXT),
+                ("sender", TEXT),
+                ("body", TEXT),
+            ],
+            name="user_text",
+            weights={"subject": 5, "sender": 3, "body": 1},
+        ),
+        IndexModel(
+            [("user_email", ASCENDING), ("internal_date", DESCENDING)],
+            name="user_internal_date",
+        ),
+    ],
+    "drafts": [
+        IndexModel(
+            [("user_email", ASCENDING), ("created_at", DESCENDING)],
+            name="user_created_at",
+        ),
+        # at most one auto draft per source email; manual drafts have none
+        IndexModel(
+            [("user_email", ASCENDING), ("source_email_id", ASCENDING)],
+            name="user_source_email",
+            unique=True,
+            partialFilterExpression={"source_email_id": {"$exists": True}},
+        ),
+    ],
+    "processed": [
+        IndexModel(
+            [("user_email", ASCENDING), ("email_id", ASCENDING)],
+            name="user_email_id",
+            unique=True,
+        ),
+        IndexModel(
+            [("user_email", ASCENDING), ("category", ASCENDING)],
+            name="user_category",
+        ),
+    ],
+    "prompts": [
+        IndexModel(
+            [
+                ("user_email", ASCENDING),
+                ("version", DESCENDING),
+                ("timestamp", DESCENDING),
+            ],
+            name="user_version_timestamp",
+        ),
+    ],
+    "categories": [
+        IndexModel([("user_email", ASCENDING)], name="user_email", unique=True),
+    ],
+    "users": [
+        IndexModel([("email", ASCENDING)], name="email", unique=True),
+    ],
+    "sync_state": [
+        IndexModel([("user_email", ASCENDING)], name="user_email", unique=True),
+    ],
+    "jobs": [
+        # claiming the oldest queued job; requeueing stale running ones
+        IndexModel(
+            [("status", ASCENDING), ("created_at", ASCENDING)],
+            name="status_created_at",
+        ),
+        IndexModel(
+            [("user_email", ASCENDING), ("created_at", DESCENDING)],
+            name="user_created_at",
+        ),
+    ],
+    # per-minute span rollups written by telemetry.MongoSink
+    "metrics": [
+        IndexModel(
+            [("user_email", ASCENDING), ("minute", DESCENDING)],
+            name="user_minute",
+        ),
+    ],
+    "llm_cache": [
+        IndexModel(
+            [("expires_at", ASCENDING)], name="expires_at_ttl", expireAfterSeconds=0
+        ),
+    ],
+    "thread_summaries": [
+        IndexModel(
+            [("user_email", ASCENDING), ("thread_id", ASCENDING)],
+            name="user_thread",
+            unique=True,
+        ),
+    ],
+}
+
+_indexes_ready = set()
+_indexes_lock = threading.Lock()
+
+
+def ensure_indexes(db, force: bool = False) -> None:
+    """Create the managed index set. Idempotent; runs once per process per db."""
+    key = db.name
+    if key in _indexes_ready and not force:
+        return
+    with _indexes_lock:
+        if key in _indexes_ready and not force:
+            return
+        for coll_name, models in INDEXES.items():
+            try:
+                db[coll_name].create_indexes(models)
+            except OperationFailure as e:
+                # e.g. duplicates block a unique index; the app still works unindexed
+                log.warning("Could not create indexes on %s: %s", coll_name, e)
+        _indexes_ready.add(key)
+
+
+def bulk_upsert(
+    coll,
+    docs: Iterable[Dict[str, Any]],
+    key_fields: Sequence[str],
+    batch_size: int = DEFAULT_BULK_BATCH,
+) -> Dict[str, int]:
+    """
+    `$set`-upsert docs matched on `key_fields` with unordered bulk_write,
+    one round trip per `batch_size` docs.
+    """
+    counts = {"matched": 0, "modified": 0, "upserted": 0}
+    ops = []
+
+    def _flush():
+        res = coll.bulk_write(ops, ordered=False)
+        counts["matched"] += res.matched_count
+        counts["modified"] += res.modified_count
+        counts["upserted"] += res.upserted_count
+        ops.clear()
+
+    for doc in docs:
+        ops.append(
+            UpdateOne({k: doc[k] for k in key_fields}, {"$set": doc}, upsert=True)
+        )
+        if len(ops) >= batch_size:
+            _flush()
+    if ops:
+        _flush()
+    return counts
+
+
+def upsert_emails(db, emails: List[Dict[str, Any]]) -> Dict[str, int]:
+    """Bulk-upsert parsed inbox documents keyed on (user_email, email_id)."""
+    return bulk_upsert(db.inboxes, emails, ("user_email", "email_id"))
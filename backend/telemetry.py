@@ -0,0 +1,511 @@
+"""
+Timing spans and metrics for Gmail, Gemini and Mongo calls.
+
+Every span is attributed to the current user and page (set with bind()),
+aggregated into per-(name, user, page) counters and latency histograms,
+and handed to the configured sinks:
+
+    log    one log line per span (logger "email_agent.telemetry")
+    mongo  per-minute rollups upserted into the `metrics` collection
+    otel   spans and a duration histogram through OpenTelemetry, if installed
+
+Sinks come from the TELEMETRY_SINKS setting (comma-separated, default
+"log"), or configure() / add_sink().
+"""
+
+import bisect
+import contextvars
+import functools
+import itertools
+import logging
+import threading
+import time
+from collections import defaultdict, deque
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+try:
+    from opentelemetry import metrics as otel_metrics
+    from opentelemetry import trace as otel_trace
+except ImportError:  # optional; only the otel sink needs it
+    otel_metrics = otel_trace = None
+
+from .services import setting
+
+log = logging.getLogger("email_agent.telemetry")
+
+# Latency histogram bucket upper bounds, in ms (a final +inf bucket follows).
+BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000)
+# Recent durations kept per key for percentile estimates.
+RESERVOIR_SIZE = 512
+MONGO_FLUSH_SECONDS = 10.0
+
+_user: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar(
+    "telemetry_user", default=None
+)
+_page: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar(
+    "telemetry_page", default=None
+)
+_render: contextvars.ContextVar[Optional[int]] = contextvars.ContextVar(
+    "telemetry_render", default=None
+)
+# Set while sinks export, so their own Mongo writes are not traced.
+_muted: contextvars.ContextVar[bool] = contextvars.ContextVar(
+    "telemetry_muted", default=False
+)
+_render_ids = itertools.count(1)
+
+Key = Tuple[str, str, str]  # (span name, user, page)
+
+
+def bind(user_email: Optional[str] = None, page: Optional[str] = None) -> None:
+    """Attribute spans recorded from here on (in this context) to a user/page."""
+    _user.set(user_email)
+    _page.set(page)
+
+
+def propagate(fn: Callable) -> Callable:
+    """
+    Wrap `fn` to run in a copy of the caller's context, so spans recorded
+    in worker threads keep the caller's user and page.
+    """
+    ctx = contextvars.copy_context()
+
+    @functools.wraps(fn)
+    def _run(*args, **kwargs):
+        return ctx.copy().run(fn, *args, **kwargs)
+
+    return _run
+
+
+class _Series:
+    __slots__ = ("count", "errors", "total_ms", "max_ms", "buckets", "recent")
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.buckets = [0] * (len(BUCKETS_MS) + 1)
+        self.recent: Deque[float] = deque(maxlen=RESERVOIR_SIZE)
+
+    def observe(self, ms: float, error: bool) -> None:
+        self.count += 1
+        self.errors += error
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+        self.buckets[bisect.bisect_left(BUCKETS_MS, ms)] += 1
+        self.recent.append(ms)
+
+    def percentile(self, pct: float) -> float:
+        values = sorted(self.recent)
+        if not values:
+            return 0.0
+        return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+class Metrics:
+    """Thread-safe per-(name, user, page) latency series and counters."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._series: Dict[Key, _Series] = defaultdict(_Series)
+        self._counters: Dict[Key, float] = defaultdict(float)
+        # spans of the most recent render of each (user, page)
+        self._renders: Dict[Tuple[str, str], Tuple[int, List[Dict[str, Any]]]] = {}
+
+    def observe(self, span: Dict[str, Any]) -> None:
+        key = (span["name"], span["user"], span["page"])
+        with self._lock:
+            self._series[key].observe(span["duration_ms"], span["error"])
+            for name, value in span.get("counters", {}).items():
+                self._counters[(name, span["user"], span["page"])] += value
+            render_id = span.get("render")
+            if render_id is not None:
+                slot = (span["user"], span["page"])
+                current = self._renders.get(slot)
+                if current is None or current[0] < render_id:
+                    self._renders[slot] = current = (render_id, [])
+                if current[0] == render_id:
+                    current[1].append(span)
+
+    def snapshot(
+        self, user_email: Optional[str] = None, page: Optional[str] = None
+    ) -> List[Dict[str, Any]]:
+        """Per-key summaries, optionally for one user and/or page."""
+        with self._lock:
+            rows = []
+            for (name, user, pg), s in self._series.items():
+                if user_email is not None and user != user_email:
+                    continue
+                if page is not None and pg != page:
+                    continue
+                rows.append(
+                    {
+                        "name": name,
+                        "user": user,
+                        "page": pg,
+                        "count": s.count,
+                        "errors": s.errors,
+                        "total_ms": round(s.total_ms, 3),
+                        "p50_ms": round(s.percentile(50), 3),
+                        "p99_ms": round(s.percentile(99), 3),
+                        "max_ms": round(s.max_ms, 3),
+                        "buckets": list(s.buckets),
+                    }
+                )
+            return sorted(rows, key=lambda r: -r["total_ms"])
+
+    def counters(self, user_email: Optional[str] = None) -> Dict[str, float]:
+        """Counter totals across pages, for one user or everyone."""
+        totals: Dict[str, float] = defaultdict(float)
+        with self._lock:
+            for (name, user, _), value in self._counters.items():
+                if user_email is None or user == user_email:
+                    totals[name] += value
+        return dict(totals)
+
+    def last_render(self, user_email: str, page: str) -> List[Dict[str, Any]]:
+        with self._lock:
+            _, spans = self._renders.get((user_email or "-", page or "-"), (0, []))
+            return list(spans)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._series.clear()
+            self._counters.clear()
+            self._renders.clear()
+
+
+metrics = Metrics()
+
+
+# ---------------- SINKS ----------------
+class Sink:
+    """Receives every finished span; flush() is called on shutdown."""
+
+    def on_span(self, span: Dict[str, Any]) -> None:
+        raise NotImplementedError
+
+    def flush(self) -> None:
+        pass
+
+
+class LogSink(Sink):
+    def __init__(self, logger: logging.Logger = log, level: int = logging.DEBUG):
+        self.logger = logger
+        self.level = level
+
+    def on_span(self, span: Dict[str, Any]) -> None:
+        if not self.logger.isEnabledFor(self.level):
+            return
+        extra = " ".join(f"{k}={v}" for k, v in span.get("attrs", {}).items())
+        counters = " ".join(f"{k}={v}" for k, v in span.get("counters", {}).items())
+        self.logger.log(
+            self.level,
+            "%s %.1fms user=%s page=%s%s %s %s",
+            span["name"],
+            span["duration_ms"],
+            span["user"],
+            span["page"],
+            " error" if span["error"] else "",
+            extra,
+            counters,
+        )
+
+
+class MongoSink(Sink):
+    """
+    Rolls spans up per minute and (name, user, page) and $inc-upserts the
+    rollups into `collection` at most every `flush_seconds`.
+    """
+
+    def __init__(
+        self,
+        db=None,
+        collection: str = "metrics",
+        flush_seconds: float = MONGO_FLUSH_SECONDS,
+        clock: Callable[[], float] = time.time,
+    ):
+        self._db = db
+        self.collection = collection
+        self.flush_seconds = flush_seconds
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._pending: Dict[Tuple[int, str, str, str], Dict[str, Any]] = {}
+        self._last_flush = clock()
+
+    def on_span(self, span: Dict[str, Any]) -> None:
+        minute = int(span["start"] // 60) * 60
+        key = (minute, span["name"], span["user"], span["page"])
+        with self._lock:
+            inc = self._pending.setdefault(key, defaultdict(float))
+            inc["count"] += 1
+            inc["errors"] += span["error"]
+            inc["total_ms"] += span["duration_ms"]
+            bucket = bisect.bisect_left(BUCKETS_MS, span["duration_ms"])
+            inc[f"buckets.{bucket}"] += 1
+            for name, value in span.get("counters", {}).items():
+                inc[f"counters.{name}"] += value
+            due = self._clock() - self._last_flush >= self.flush_seconds
+        if due:
+            self.flush()
+
+    def flush(self) -> None:
+        from pymongo import UpdateOne
+        from pymongo.errors import PyMongoError
+
+        from .mongo_db import get_db
+
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._last_flush = self._clock()
+        if not pending:
+            return
+        ops = [
+            UpdateOne(
+                {"_id": f"{minute}|{name}|{user}|{page}"},
+                {
+                    "$inc": dict(inc),
+                    "$setOnInsert": {
+                        "minute": minute,
+                        "name": name,
+                        "user_email": user,
+                        "page": page,
+                    },
+                },
+                upsert=True,
+            )
+            for (minute, name, user, page), inc in pending.items()
+        ]
+        token = _muted.set(True)
+        try:
+            db = self._db if self._db is not None else get_db()
+            db[self.collection].bulk_write(ops, ordered=False)
+        except PyMongoError as e:
+            log.warning("Could not write metrics: %s", e)
+        finally:
+            _muted.reset(token)
+
+
+class OTelSink(Sink):
+    """Re-emits spans and a duration histogram through OpenTelemetry."""
+
+    def __init__(self, tracer=None, meter=None):
+        if tracer is None or meter is None:
+            if otel_trace is None:
+                raise RuntimeError(
+                    "The otel telemetry sink needs the opentelemetry-api package."
+                )
+            tracer = tracer or otel_trace.get_tracer("email_agent")
+            meter = meter or otel_metrics.get_meter("email_agent")
+        self.tracer = tracer
+        self.duration = meter.create_histogram(
+            "email_agent.span.duration", unit="ms", description="Span latency"
+        )
+
+    def on_span(self, span: Dict[str, Any]) -> None:
+        attrs = {
+            "user": span["user"],
+            "page": span["page"],
+            "error": span["error"],
+            **{k: v for k, v in span.get("attrs", {}).items() if v is not None},
+            **span.get("counters", {}),
+        }
+        start_ns = int(span["start"] * 1e9)
+        otel_span = self.tracer.start_span(
+            span["name"], start_time=start_ns, attributes=attrs
+        )
+        otel_span.end(end_time=start_ns + int(span["duration_ms"] * 1e6))
+        self.duration.record(
+            span["duration_ms"],
+            {"name": span["name"], "user": span["user"], "page": span["page"]},
+        )
+
+
+SINK_FACTORIES: Dict[str, Callable[[], Sink]] = {
+    "log": LogSink,
+    "mongo": MongoSink,
+    "otel": OTelSink,
+}
+
+_sinks: Optional[List[Sink]] = None
+# reentrant: _get_sinks() and add_sink() configure() while holding it
+_sinks_lock = threading.RLock()
+
+
+def configure(sinks: Optional[List[Sink]] = None) -> List[Sink]:
+    """Replace the sinks; None reads them from TELEMETRY_SINKS."""
+    global _sinks
+    if sinks is None:
+        names = setting("TELEMETRY_SINKS", "log")
+        sinks = [SINK_FACTORIES[n.strip()]() for n in names.split(",") if n.strip()]
+    with _sinks_lock:
+        old, _sinks = _sinks, list(sinks)
+    for sink in old or []:
+        sink.flush()
+    return _sinks
+
+
+def add_sink(sink: Sink) -> None:
+    with _sinks_lock:
+        if _sinks is None:
+            configure()
+        _sinks.append(sink)
+
+
+def _get_sinks() -> List[Sink]:
+    if _sinks is None:
+        with _sinks_lock:
+            if _sinks is None:
+                configure()
+    return _sinks
+
+
+def flush() -> None:
+    for sink in _get_sinks():
+        sink.flush()
+
+
+def record(
+    name: str,
+    start: float,
+    duration_ms: float,
+    error: bool = False,
+    attrs: Optional[Dict[str, Any]] = None,
+    counters: Optional[Dict[str, float]] = None,
+) -> None:
+    """Record a finished span (used directly for externally timed events)."""
+    if _muted.get():
+        return
+    span = {
+        "name": name,
+        "start": start,
+        "duration_ms": duration_ms,
+        "error": error,
+        "user": _user.get() or "-",
+        "page": _page.get() or "-",
+        "render": _render.get(),
+        "attrs": attrs or {},
+        "counters": counters or {},
+    }
+    metrics.observe(span)
+    for sink in _get_sinks():
+        try:
+            sink.on_span(span)
+        except Exception:
+            log.exception("Telemetry sink %r failed", sink)
+
+
+def incr(name: str, value: float = 1, **attrs) -> None:
+    """Count an event: a zero-length span `name` carrying counter `name`."""
+    record(name, time.time(), 0.0, attrs=attrs, counters={name: value})
+
+
+class Span:
+    """
+    Times a block: `with span("gemini.generate", model=...) as s:`. Set
+    attributes with s.set(...) and counters with s.count(...).
+    """
+
+    def __init__(self, name: str, **attrs):
+        self.name = name
+        self.attrs = attrs
+        self.counters: Dict[str, float] = {}
+        self._start = 0.0
+        self._t0 = 0.0
+        self._token = None
+        self._ended = False
+
+    def set(self, **attrs) -> "Span":
+        self.attrs.update(attrs)
+        return self
+
+    def count(self, **counters: float) -> "Span":
+        for k, v in counters.items():
+            self.counters[k] = self.counters.get(k, 0) + (v or 0)
+        return self
+
+    def start(self) -> "Span":
+        self._start = time.time()
+        self._t0 = time.perf_counter()
+        return self
+
+    def end(self, error: bool = False) -> None:
+        if self._ended:
+            return
+        self._ended = True
+        record(
+            self.name,
+            self._start,
+            (time.perf_counter() - self._t0) * 1000,
+            error,
+            self.attrs,
+            self.counters,
+        )
+
+    def __enter__(self) -> "Span":
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        # a generator closed early (GeneratorExit) is not a failed call
+        self.end(error=exc_type is not None and not issubclass(exc_type, GeneratorExit))
+
+
+span = Span
+
+
+def begin_render(page: str, user_email: Optional[str] = None) -> Span:
+    """
+    Bind the user/page for one Streamlit run and start its "page.render"
+    span; spans until end() are grouped as that render.
+    """
+    bind(user_email, page)
+    _render.set(next(_render_ids))
+    return Span("page.render").start()
+
+
+# ---------------- MONGO COMMANDS ----------------
+try:
+    from pymongo import monitoring
+
+    class MongoCommandListener(monitoring.CommandListener):
+        """Records a "mongo.<command>" span per command, from the driver's timings."""
+
+        def __init__(self):
+            self._lock = threading.Lock()
+            self._collections: Dict[Tuple[Any, int], str] = {}
+
+        def started(self, event):
+            if _muted.get():
+                return
+            target = event.command.get(event.command_name)
+            with self._lock:
+                self._collections[(event.connection_id, event.request_id)] = (
+                    target if isinstance(target, str) else ""
+                )
+
+        def _finish(self, event, error: bool):
+            with self._lock:
+                collection = self._collections.pop(
+                    (event.connection_id, event.request_id), None
+                )
+            if collection is None:  # muted, or started before we registered
+                return
+            duration_ms = event.duration_micros / 1000
+            record(
+                f"mongo.{event.command_name}",
+                time.time() - duration_ms / 1000,
+                duration_ms,
+                error,
+                {"collection": collection, "db": event.database_name},
+            )
+
+        def succeeded(self, event):
+            self._finish(event, False)
+
+        def failed(self, event):
+            self._finish(event, True)
+
+    command_listener = MongoCommandListener()
+except ImportError:  # pragma: no cover - pymongo is a hard dependency
+    command_listener = None
@@ -0,0 +1,193 @@
+"""
+Rolling per-thread summaries.
+
+Each Gmail thread's summary is stored in `thread_summaries` together with
+the ids of the messages it covers. When the thread grows, only the new
+messages (quoted history stripped) and the previous summary go to Gemini,
+so keeping a long thread summarized costs one small call per update
+instead of a re-read of the whole thread.
+"""
+
+import hashlib
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from . import agent, telemetry
+from .generation import THREAD_SUMMARY, TaskConfig
+from .inbox import get_thread
+from .mongo_db import get_db
+from .prompt_assembly import prepare_body
+from .rate_limit import estimate_tokens
+
+FOLD_INSTRUCTIONS = (
+    "You maintain a running summary of an email thread. Update the summary "
+    "below with the new messages: keep decisions, open questions, requests "
+    "and deadlines with who owns them, drop anything superseded, and stay "
+    "under 200 words. Respond with the updated summary only."
+)
+# Stored summaries made with other instructions are rebuilt from scratch.
+PROMPT_VERSION = hashlib.sha256(FOLD_INSTRUCTIONS.encode("utf-8")).hexdigest()[:12]
+# Prompt tokens of new messages folded in per call; a thread summarized for
+# the first time is folded in chunks of this size.
+FOLD_TOKEN_BUDGET = 6000
+# Messages shown by the offline (no Gemini) summary.
+OFFLINE_MESSAGES = 5
+
+
+def message_block(email: Dict[str, Any]) -> str:
+    """One message as it is fed to the summarizer, quotes and footers removed."""
+    return (
+        f"From: {email.get('sender', '')}\n"
+        f"Date: {email.get('timestamp', '')}\n"
+        f"Subject: {email.get('subject', '')}\n\n"
+        f"{prepare_body(email.get('body', ''), 'thread')}"
+    )
+
+
+def build_fold_prompt(previous: str, emails: List[Dict[str, Any]]) -> str:
+    blocks = "\n\n---\n\n".join(message_block(e) for e in emails)
+    return (
+        f"{FOLD_INSTRUCTIONS}\n\n"
+        f"Summary so far:\n{previous or '(none yet)'}\n\n"
+        f"New messages, oldest first:\n\n{blocks}"
+    )
+
+
+def plan_folds(
+    emails: List[Dict[str, Any]], token_budget: int = FOLD_TOKEN_BUDGET
+) -> List[List[Dict[str, Any]]]:
+    """Split `emails` into consecutive chunks of about `token_budget` tokens."""
+    folds, current, used = [], [], 0
+    for email in emails:
+        cost = estimate_tokens(message_block(email))
+        if current and used + cost > token_budget:
+            folds.append(current)
+            current, used = [], 0
+        current.append(email)
+        used += cost
+    if current:
+        folds.append(current)
+    return folds
+
+
+def get_summary(user_email: str, thread_id: str, db=None) -> Optional[Dict[str, Any]]:
+    """The stored summary document of a thread, if any."""
+    db = db if db is not None else get_db()
+    return db.thread_summaries.find_one(
+        {"user_email": user_email, "thread_id": thread_id}, {"_id": 0}
+    )
+
+
+def offline_summary(emails: List[Dict[str, Any]]) -> str:
+    """What can be said about a thread without Gemini: its latest messages."""
+    lines = []
+    for email in emails[-OFFLINE_MESSAGES:]:
+        words = prepare_body(email.get("body", ""), "thread").split()[:30]
+        lines.append(f"- {email.get('sender', '')}: {' '.join(words)}...")
+    return "\n".join(lines)
+
+
+def summarize_thread(
+    user_email: str,
+    thread_id: str,
+    llm: Optional[Callable[[str, TaskConfig], str]] = None,
+    db=None,
+) -> Dict[str, Any]:
+    """
+    Bring the thread's rolling summary up to date and return it.
+
+    Only messages the stored summary does not cover yet are sent, folded
+    into the previous summary. A fold whose reply is empty or cut off at the
+    output cap is dropped: the summary so far is kept and that fold's
+    messages (and the later ones) stay uncovered for the next update.
+    Returns {"summary", "messages", "covered", "new_messages", "calls"}:
+    covered is how many messages the summary covers, new_messages how many
+    this call folded in, and calls is 0 when the stored summary was already
+    current. `llm` defaults to Gemini, like in ingestion.
+    """
+    from .gmail_loader import ensure_bodies
+
+    db = db if db is not None else get_db()
+    messages = get_thread(user_email, thread_id, db=db)
+    stored = get_summary(user_email, thread_id, db)
+    if stored and stored.get("version") != PROMPT_VERSION:
+        stored = None
+    covered = set(stored["message_ids"]) if stored else set()
+    new = [m for m in messages if m["email_id"] not in covered]
+    result = {
+        "summary": stored["summary"] if stored else "",
+        "messages": len(messages),
+        "covered": len(messages) - len(new),
+        "new_messages": len(new),
+        "calls": 0,
+    }
+    if not new:
+        return result
+
+    ensure_bodies(user_email, new)
+    if llm is None:
+        if not agent.GEMINI_API_KEY:
+            result["summary"] = offline_summary(messages)
+            result["covered"] = len(messages)
+            return result
+
+        def llm(prompt, config):
+            return agent.call_gemini(
+                prompt, config, user_email=user_email, allow_truncated=False
+            )
+
+    summary = result["summary"]
+    new_ids: List[str] = []
+    for fold in plan_folds(new):
+        prompt = build_fold_prompt(summary, fold)
+        try:
+            reply = (llm(prompt, THREAD_SUMMARY) or "").strip()
+        except agent.TruncatedReply:
+            reply = ""
+        result["calls"] += 1
+        if not reply:
+            # a later fold would build on a summary missing these messages
+            telemetry.incr("threads.failed_folds")
+            break
+        summary = reply
+        new_ids.extend(m["email_id"] for m in fold)
+    telemetry.incr("threads.fold_calls", result["calls"])
+    result["new_messages"] = len(new_ids)
+    if not new_ids:
+        return result
+    covered.update(new_ids)
+
+    now = time.time()
+    update = {
+        "$set": {
+            "summary": summary,
+            "version": PROMPT_VERSION,
+            "message_count": len(covered),
+            "last_internal_date": max(
+                m.get("internal_date", 0)
+                for m in messages
+                if m["email_id"] in covered
+            ),
+            "updated_at": now,
+        },
+    }
+    if stored:
+        update["$addToSet"] = {"message_ids": {"$each": new_ids}}
+    else:
+        update["$set"]["message_ids"] = new_ids
+    db.thread_summaries.update_one(
+        {"user_email": user_email, "thread_id": thread_id}, update, upsert=True
+    )
+    result["summary"] = summary
+    result["covered"] = len(covered)
+    return result
+
+
+def forget_threads(user_email: str, thread_ids: List[str], db=None) -> None:
+    """Drop stored summaries, e.g. after messages of the threads were removed."""
+    if not thread_ids:
+        return
+    db = db if db is not None else get_db()
+    db.thread_summaries.delete_many(
+        {"user_email": user_email, "thread_id": {"$in": list(thread_ids)}}
+    )
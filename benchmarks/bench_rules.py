@@ -0,0 +1,197 @@
+"""
+Throughput of the offline categorizer / action extractor.
+
+    python benchmarks/bench_rules.py [--emails 20000] [--rounds 10] [--min-rate 20000]
+
+Compares the compiled rule engine against the original substring-chain
+heuristics on a synthetic mailbox. For a like-for-like comparison the engine
+runs the heuristics' own keywords (LEGACY_CATEGORY_RULES); the built-in rule
+set, which checks more signals, is reported separately, alone and with
+extra custom categories. Each rate is the median of --rounds runs.
+
+The engine matches whole words where the heuristics matched substrings, so
+the two disagree on words like "overdue" or "freebie"; the synthetic mailbox
+has none, and WHOLE_WORD_CASES pins the difference. Exits non-zero if the
+engine and the heuristics disagree on the mailbox, if a WHOLE_WORD_CASES
+result changes, or if the built-in rules classify fewer than --min-rate
+emails per second.
+
+The legacy rate is for reference only. It checks nine keywords and stops at
+the first hit, while the engine scores every category in one regex pass,
+which CPython's re does at a fixed cost per word. The engine therefore runs
+below the legacy rate on this rule set, but its cost stays nearly flat as
+custom categories add keywords (see custom_rules_emails_per_s).
+"""
+
+import argparse
+import json
+import random
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from backend.rules import (  # noqa: E402
+    DEFAULT_ACTION_PREFIXES,
+    CompiledRules,
+    get_rules,
+)
+
+WORDS = (
+    "meeting report quarter budget team update project status lunch call "
+    "invoice travel schedule notes agenda offer design review launch"
+).split()
+SNIPPETS = [
+    "Click here to unsubscribe from this list.",
+    "Huge sale this weekend, everything free shipping!",
+    "Please send me the slides before Friday.",
+    "Could you review the attached draft?",
+    "Kindly confirm the deadline for the report.",
+    "Update the tracker when the payment is due.",
+]
+
+
+def synthetic_mailbox(n, seed=7):
+    rng = random.Random(seed)
+    emails = []
+    for i in range(n):
+        lines = []
+        for _ in range(rng.randint(5, 40)):
+            if rng.random() < 0.1:
+                lines.append(rng.choice(SNIPPETS))
+            else:
+                lines.append(" ".join(rng.choices(WORDS, k=rng.randint(4, 14))))
+        subject = " ".join(rng.choices(WORDS, k=4))
+        if rng.random() < 0.1:
+            subject = "Weekly newsletter: " + subject
+        emails.append({"email_id": str(i), "subject": subject, "body": "\n".join(lines)})
+    return emails
+
+
+# The pre-rule-engine heuristics, kept verbatim as the baseline.
+def legacy_categorize(email):
+    subj = (email.get("subject") or "").lower()
+    body = (email.get("body") or "").lower()
+    if "unsubscribe" in body or "newsletter" in subj:
+        return "Newsletter"
+    if "sale" in body or "free" in body:
+        return "Spam"
+    if any(w in body for w in ["please", "could you", "kindly", "deadline", "due"]):
+        return "To-Do"
+    return "Important"
+
+
+# The same heuristics as engine rules.
+LEGACY_CATEGORY_RULES = [
+    {
+        "category": "Newsletter",
+        "field": "body",
+        "keywords": ["unsubscribe"],
+        "priority": 10,
+    },
+    {
+        "category": "Newsletter",
+        "field": "subject",
+        "keywords": ["newsletter"],
+        "priority": 10,
+    },
+    {"category": "Spam", "field": "body", "keywords": ["sale", "free"], "priority": 20},
+    {
+        "category": "To-Do",
+        "field": "body",
+        "keywords": ["please", "could you", "kindly", "deadline", "due"],
+        "priority": 30,
+    },
+]
+
+
+# body, legacy category, engine category
+WHOLE_WORD_CASES = [
+    ("The report is overdue.", "To-Do", "Important"),
+    ("Grab a freebie at the booth.", "Spam", "Important"),
+    ("Wholesale prices attached.", "Spam", "Important"),
+    ("Is this free? Reply by Friday.", "Spam", "Spam"),
+]
+CUSTOM_CATEGORIES = [
+    {"name": f"Custom {i}", "keywords": [f"{word}{i}" for word in WORDS[:5]]}
+    for i in range(20)
+]
+
+
+def legacy_extract_actions(email):
+    tasks = []
+    for line in email.get("body", "").splitlines():
+        l = line.strip().lower()
+        if l.startswith(("please", "could you", "kindly", "review", "update", "send")):
+            tasks.append({"task": line.strip(), "deadline": "", "assignee": ""})
+    return tasks
+
+
+def timed(contenders, emails, rounds):
+    """
+    Outputs of each function over `emails` and its median time of `rounds`
+    runs, taking turns so that a noisy moment doesn't favour one of them.
+    """
+    outputs = {}
+    times = {name: [] for name in contenders}
+    for _ in range(rounds):
+        for name, fn in contenders.items():
+            start = time.perf_counter()
+            outputs[name] = [fn(e) for e in emails]
+            times[name].append(time.perf_counter() - start)
+    return outputs, {name: statistics.median(t) for name, t in times.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--emails", type=int, default=20000)
+    parser.add_argument("--rounds", type=int, default=10)
+    parser.add_argument("--min-rate", type=float, default=20000.0)
+    args = parser.parse_args()
+
+    emails = synthetic_mailbox(args.emails)
+    same = CompiledRules(LEGACY_CATEGORY_RULES, DEFAULT_ACTION_PREFIXES)
+    rules = get_rules()
+    custom = get_rules(CUSTOM_CATEGORIES)
+
+    def engine(compiled):
+        return lambda e: (
+            compiled.categorize(e)["category"],
+            compiled.extract_actions(e),
+        )
+
+    outputs, seconds = timed(
+        {
+            "legacy": lambda e: (legacy_categorize(e), legacy_extract_actions(e)),
+            "compiled": engine(same),
+            "default_rules": engine(rules),
+            "custom_rules": engine(custom),
+        },
+        emails,
+        args.rounds,
+    )
+
+    mismatches = sum(a != b for a, b in zip(outputs["legacy"], outputs["compiled"]))
+    whole_word_changes = [
+        body
+        for body, legacy, compiled in WHOLE_WORD_CASES
+        if legacy_categorize({"body": body}) != legacy
+        or same.categorize({"body": body})["category"] != compiled
+    ]
+    rates = {name: args.emails / s for name, s in seconds.items()}
+    report = {
+        "emails": args.emails,
+        **{f"{name}_emails_per_s": round(rate) for name, rate in rates.items()},
+        "compiled_vs_legacy": round(rates["compiled"] / rates["legacy"], 2),
+        "mismatches": mismatches,
+        "whole_word_changes": whole_word_changes,
+    }
+    print(json.dumps(report, indent=2))
+    if mismatches or whole_word_changes or rates["default_rules"] < args.min_rate:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+Query latency of inbox search.
+
+    python benchmarks/bench_search.py [--emails 50000] [--max-p99-ms 100]
+                                      [--mongo-uri mongodb://localhost:27017]
+
+Builds an InvertedIndex over a synthetic mailbox, runs a mix of term,
+filtered and browse queries, and exits non-zero if p99 latency exceeds
+--max-p99-ms. With --mongo-uri the same queries also go through
+search_inbox() against that MongoDB ($text with the app's indexes, in a
+scratch database that is dropped afterwards) and are held to the same
+limit; without it the Mongo path is reported as skipped.
+"""
+
+import argparse
+import json
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from backend.search import InvertedIndex, search_inbox  # noqa: E402
+from backend.storage import ensure_indexes  # noqa: E402
+from bench_rules import synthetic_mailbox  # noqa: E402
+
+QUERIES = [
+    {"query": "budget report"},
+    {"query": "invoice", "sender": "alice"},
+    {"query": "unsubscribe newsletter"},
+    {"query": "deadline", "date_from": 1_700_000_000_000},
+    {"query": "launch design review", "page": 2},
+    {"query": "", "subject": "weekly"},
+]
+BENCH_USER = "bench@example.com"
+MONGO_BENCH_DB = "email_agent_bench_search"
+
+
+def latencies(search, rounds):
+    """{"p50_ms", "p99_ms"} of `search(**query)` over `rounds` of QUERIES."""
+    times = []
+    for _ in range(rounds):
+        for q in QUERIES:
+            t = time.perf_counter()
+            search(**q)
+            times.append((time.perf_counter() - t) * 1000)
+    times.sort()
+    return {
+        "queries": len(times),
+        "p50_ms": round(statistics.median(times), 2),
+        "p99_ms": round(times[int(len(times) * 0.99) - 1], 2),
+    }
+
+
+def bench_mongo(uri, emails, rounds):
+    from pymongo import MongoClient
+
+    client = MongoClient(uri)
+    db = client[MONGO_BENCH_DB]
+    try:
+        db.inboxes.drop()
+        ensure_indexes(db, force=True)
+        db.inboxes.insert_many([{**e, "user_email": BENCH_USER} for e in emails])
+        return latencies(
+            lambda **q: search_inbox(BENCH_USER, db=db, **q), rounds
+        )
+    finally:
+        client.drop_database(MONGO_BENCH_DB)
+        client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--emails", type=int, default=50000)
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--max-p99-ms", type=float, default=100.0)
+    parser.add_argument("--mongo-uri", help="also time the Mongo $text path")
+    args = parser.parse_args()
+
+    emails = synthetic_mailbox(args.emails)
+    senders = ["alice@example.com", "bob@example.com", "news@example.com"]
+    for i, e in enumerate(emails):
+        e["sender"] = senders[i % len(senders)]
+        e["internal_date"] = 1_690_000_000_000 + i * 600_000
+
+    start = time.perf_counter()
+    index = InvertedIndex(emails)
+    build_s = time.perf_counter() - start
+
+    report = {
+        "emails": args.emails,
+        "build_s": round(build_s, 2),
+        **latencies(index.search, args.rounds),
+        "mongo": (
+            bench_mongo(args.mongo_uri, emails, args.rounds)
+            if args.mongo_uri
+            else "skipped (no --mongo-uri)"
+        ),
+    }
+    print(json.dumps(report, indent=2))
+    p99s = [report["p99_ms"]]
+    if args.mongo_uri:
+        p99s.append(report["mongo"]["p99_ms"])
+    if max(p99s) > args.max_p99_ms:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
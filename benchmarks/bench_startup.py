@@ -0,0 +1,159 @@
+"""
+Cold-import time of the backend modules and the cost of a Streamlit rerun.
+
+    python benchmarks/bench_startup.py [--rounds 5] [--reruns 20] [--out startup.json]
+
+imports   each module imported in a fresh interpreter with no secrets, no
+          MONGO_URI and a dummy GEMINI_API_KEY; a module that needs live
+          services to import reports the error instead of a time
+app       app.py run with Streamlit's AppTest against the in-process MongoDB
+          stand-in from fakes.py: the first run (imports and start-up work
+          included) and the median of the following reruns, signed out and
+          signed in
+
+Prints one JSON document with the git commit, so runs can be compared
+across commits.
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+MODULES = [
+    "backend.prompts",
+    "backend.agent",
+    "backend.gmail_loader",
+    "backend.jobs",
+    "backend.drafts",
+]
+SECRETS = {
+    "GOOGLE_CLIENT_ID": "bench-client",
+    "GOOGLE_CLIENT_SECRET": "bench-secret",
+    "REDIRECT_URI": "http://localhost:8501/",
+}
+USER = "bench@example.com"
+IMPORT_SNIPPET = """
+import importlib, json, sys, time
+start = time.perf_counter()
+try:
+    importlib.import_module(sys.argv[1])
+    print(json.dumps({"seconds": time.perf_counter() - start}))
+except Exception as e:
+    print(json.dumps({"error": f"{type(e).__name__}: {e}"[:200]}))
+"""
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def bench_imports(rounds: int):
+    env = {
+        k: v
+        for k, v in os.environ.items()
+        if k not in SECRETS and k not in ("MONGO_URI", "GEMINI_API_KEY")
+    }
+    env.update(PYTHONPATH=str(ROOT), GEMINI_API_KEY="bench-dummy", JOB_WORKERS="0")
+    results = {}
+    # an empty working directory, so no .streamlit/secrets.toml is found
+    with tempfile.TemporaryDirectory() as cwd:
+        for module in MODULES:
+            times = []
+            for _ in range(rounds):
+                out = subprocess.run(
+                    [sys.executable, "-c", IMPORT_SNIPPET, module],
+                    cwd=cwd,
+                    env=env,
+                    capture_output=True,
+                    text=True,
+                )
+                lines = out.stdout.strip().splitlines()
+                result = (
+                    json.loads(lines[-1]) if lines else {"error": out.stderr[-200:]}
+                )
+                if "error" in result:
+                    results[module] = result
+                    break
+                times.append(result["seconds"] * 1000)
+            else:
+                results[module] = {"median_ms": round(statistics.median(times), 1)}
+    return results
+
+
+def bench_app(reruns: int):
+    from streamlit.testing.v1 import AppTest
+
+    from fakes import install_fake_mongo
+
+    os.environ["JOB_WORKERS"] = "0"
+    install_fake_mongo()
+    results = {}
+    for label, session in (
+        ("signed_out", {}),
+        ("signed_in", {"user_email": USER, "oauth_token": "bench-token"}),
+    ):
+        app = AppTest.from_file(str(ROOT / "app.py"), default_timeout=60)
+        app.secrets.update(SECRETS)
+        for key, value in session.items():
+            app.session_state[key] = value
+        start = time.perf_counter()
+        app.run()
+        first = (time.perf_counter() - start) * 1000
+        times = []
+        for _ in range(reruns):
+            start = time.perf_counter()
+            app.run()
+            times.append((time.perf_counter() - start) * 1000)
+        errors = [e.value for e in app.exception]
+        results[label] = {
+            "first_run_ms": round(first, 1),
+            "rerun_median_ms": round(statistics.median(times), 1),
+            "errors": errors[:3],
+        }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--reruns", type=int, default=20)
+    parser.add_argument("--out", help="also write the JSON report here")
+    args = parser.parse_args()
+
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "timestamp": int(time.time()),
+        "config": vars(args),
+        "results": {
+            "imports": bench_imports(args.rounds),
+            "app": bench_app(args.reruns),
+        },
+    }
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.out:
+        Path(args.out).write_text(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
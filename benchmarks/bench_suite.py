@@ -0,0 +1,299 @@
+"""
+End-to-end benchmarks of the backend hot paths, fully offline.
+
+    python benchmarks/bench_suite.py [--emails 2000] [--gmail-latency-ms 40]
+        [--gemini-latency-ms 300] [--out results.json]
+
+Gmail, Gemini and MongoDB are replaced by the stand-ins in fakes.py (with
+the configured latencies) and the mailbox comes from synthetic_mail.py. Covers:
+
+    inbox_fetch    sync_inbox: first sync (list, batched fetch, parse, upsert)
+                   and a sync with no changes
+    ingestion      run_ingestion with keyword rules and tiered rules + (fake) Gemini
+    rule_precision the rule tier's verdicts checked against (fake) Gemini labels
+    agent          run_agent_on_email for each task type
+    page_data      inbox pages, page bodies and processed results
+
+Prints one JSON document with throughput and p50/p99 latencies (ms) per
+benchmark, plus the git commit, so runs can be compared across commits.
+"""
+
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Callable, Dict, List
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from fakes import (  # noqa: E402
+    FakeGenAIClient,
+    FakeGmailService,
+    install_fake_mongo,
+)
+from synthetic_mail import synthetic_gmail_mailbox  # noqa: E402
+
+install_fake_mongo()
+
+from backend import agent, ingestion  # noqa: E402
+from backend.gmail_loader import sync_inbox  # noqa: E402
+from backend.gmail_parse import parse_message  # noqa: E402
+from backend.inbox import get_emails, list_inbox_page  # noqa: E402
+from backend.mongo_db import get_db  # noqa: E402
+from backend.prompts import DEFAULT_PROMPTS  # noqa: E402
+from backend.rate_limit import LLMUsage, RateLimiter  # noqa: E402
+from backend.services import services  # noqa: E402
+from backend.storage import ensure_indexes, upsert_emails  # noqa: E402
+
+USER = "bench@example.com"
+AGENT_QUERIES = [
+    "Summarize this email",
+    "What tasks do I need to do?",
+    "Draft a reply tone: friendly",
+    "Who is asking for what?",
+]
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    """Nearest-rank percentile of an ascending list."""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, round(pct / 100 * len(sorted_values)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def summarize(latencies_s: List[float], items: int, wall_s: float) -> Dict:
+    ms = sorted(x * 1000 for x in latencies_s)
+    return {
+        "items": items,
+        "wall_s": round(wall_s, 4),
+        "throughput_per_s": round(items / wall_s, 2) if wall_s else None,
+        "p50_ms": round(percentile(ms, 50), 3),
+        "p99_ms": round(percentile(ms, 99), 3),
+        "max_ms": round(ms[-1], 3) if ms else 0.0,
+    }
+
+
+def timed_calls(fn: Callable[[], object], rounds: int) -> List[float]:
+    latencies = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def bench_inbox_fetch(service: FakeGmailService, n: int, rounds: int) -> Dict:
+    """
+    gmail_loader.sync_inbox for the latest `n` messages, as the sync job runs
+    it: each round a new user's first sync (profile, list, batched full
+    fetch, parse, bulk upsert), then a second sync that finds no changes.
+    """
+    users = [f"fetch{r}@example.com" for r in range(rounds)]
+
+    def _sync(user):
+        t = time.perf_counter()
+        sync_inbox(n, service=service, user_email=user)
+        return time.perf_counter() - t
+
+    service.reset_stats()
+    start = time.perf_counter()
+    latencies = [_sync(u) for u in users]
+    report = summarize(latencies, n * rounds, time.perf_counter() - start)
+    report["bytes_per_message"] = round(service.stats["bytes"] / (n * rounds))
+    report["round_trips_per_fetch"] = service.stats["round_trips"] / rounds
+
+    latencies = [_sync(u) for u in users]
+    report["unchanged_sync"] = summarize(latencies, rounds, sum(latencies))
+
+    service.reset_stats()
+    meta = service.users().messages()
+    for m in list(service._by_id)[: min(n, 200)]:
+        meta.get(userId="me", id=m, format="metadata").execute()
+    report["metadata_bytes_per_message"] = round(
+        service.stats["bytes"] / max(service.stats["responses"], 1)
+    )
+    return report
+
+
+def bench_ingestion(emails: List[Dict], use_llm: bool, rounds: int) -> Dict:
+    """run_ingestion over `emails`, forced so every round does the work."""
+    limiter = RateLimiter(requests_per_minute=10**9, tokens_per_minute=None)
+    usage = LLMUsage()
+    per_email: List[float] = []
+
+    def _run():
+        last = [time.perf_counter()]
+
+        def _on_progress(done, total, key, result):
+            now = time.perf_counter()
+            per_email.append(now - last[0])
+            last[0] = now
+
+        options = {"limiter": limiter, "usage": usage} if use_llm else {}
+        return ingestion.run_ingestion(
+            inbox=emails,
+            prompts=DEFAULT_PROMPTS,
+            use_llm=use_llm,
+            force=True,
+            user_email=USER,
+            on_progress=_on_progress,
+            **options,
+        )
+
+    start = time.perf_counter()
+    runs = timed_calls(_run, rounds)
+    report = summarize(per_email, len(emails) * rounds, time.perf_counter() - start)
+    report["run_p50_ms"] = round(percentile(sorted(runs), 50) * 1000, 3)
+
+    # a second pass over unchanged mail is served from stored results
+    start = time.perf_counter()
+    ingestion.run_ingestion(
+        inbox=emails,
+        prompts=DEFAULT_PROMPTS,
+        use_llm=use_llm,
+        user_email=USER,
+        **({"limiter": limiter} if use_llm else {}),
+    )
+    report["unchanged_rerun_ms"] = round((time.perf_counter() - start) * 1000, 3)
+    if use_llm:
+        counts = usage.as_dict()
+        report["gemini_requests"] = counts["requests"]
+        # per-tier split of the (forced) rounds and what the rule tier saved
+        for field in ("rules_tier", "llm_tier", "saved_requests"):
+            report[field] = counts[field]
+    return report
+
+
+def bench_rule_precision(emails: List[Dict]) -> Dict:
+    """
+    Every email labelled by (fake) Gemini, then ingestion.rule_precision()
+    for the default thresholds: how often a rule-tier verdict would agree.
+    """
+    limiter = RateLimiter(requests_per_minute=10**9, tokens_per_minute=None)
+    ingestion.run_ingestion(
+        inbox=emails,
+        prompts=DEFAULT_PROMPTS,
+        use_llm=True,
+        force=True,
+        user_email=USER,
+        audit_rate=1.0,
+        limiter=limiter,
+    )
+    return ingestion.rule_precision(USER)
+
+
+def bench_agent(emails: List[Dict], calls: int) -> Dict:
+    """run_agent_on_email on distinct emails, cycling through the task types."""
+    latencies = []
+    start = time.perf_counter()
+    for i in range(calls):
+        email = emails[i % len(emails)]
+        query = AGENT_QUERIES[i % len(AGENT_QUERIES)]
+        t = time.perf_counter()
+        agent.run_agent_on_email(email, query, DEFAULT_PROMPTS, USER)
+        latencies.append(time.perf_counter() - t)
+    return summarize(latencies, calls, time.perf_counter() - start)
+
+
+def bench_page_data(page_size: int, pages: int) -> Dict:
+    """Walk inbox pages; load each page's bodies and processed results."""
+    list_ms, bodies_ms, processed_ms = [], [], []
+    cursor = None
+    walked = 0
+    for _ in range(pages):
+        t = time.perf_counter()
+        items, cursor = list_inbox_page(USER, page_size, cursor)
+        list_ms.append(time.perf_counter() - t)
+        ids = [e["email_id"] for e in items]
+        t = time.perf_counter()
+        get_emails(USER, ids)
+        bodies_ms.append(time.perf_counter() - t)
+        t = time.perf_counter()
+        ingestion.get_processed(ids, USER, {"_id": 0, "email_id": 1, "category": 1})
+        processed_ms.append(time.perf_counter() - t)
+        walked += 1
+        if cursor is None:
+            break
+    # each step's throughput is over its own time, not the whole walk
+    return {
+        "list_page": summarize(list_ms, walked, sum(list_ms)),
+        "page_bodies": summarize(bodies_ms, walked, sum(bodies_ms)),
+        "page_processed": summarize(processed_ms, walked, sum(processed_ms)),
+    }
+
+
+def git_commit() -> str:
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        return out.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--emails", type=int, default=2000)
+    parser.add_argument("--fetch", type=int, default=100, help="messages per fetch")
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--agent-calls", type=int, default=40)
+    parser.add_argument("--page-size", type=int, default=50)
+    parser.add_argument("--gmail-latency-ms", type=float, default=40.0)
+    parser.add_argument("--gemini-latency-ms", type=float, default=300.0)
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--out", help="also write the JSON report here")
+    args = parser.parse_args()
+
+    messages = synthetic_gmail_mailbox(args.emails, seed=args.seed)
+    service = FakeGmailService(messages, latency_s=args.gmail_latency_ms / 1000)
+    agent.GEMINI_API_KEY = "offline-benchmark"
+    services.override(
+        "gemini",
+        FakeGenAIClient(
+            first_token_s=args.gemini_latency_ms / 1000 * 0.6,
+            per_chunk_s=args.gemini_latency_ms / 1000 * 0.1,
+        ),
+    )
+    db = get_db()
+    ensure_indexes(db)
+
+    results = {"inbox_fetch": bench_inbox_fetch(service, args.fetch, args.rounds)}
+
+    # the whole mailbox in Mongo for the remaining benchmarks
+    upsert_emails(db, [parse_message(m, USER) for m in messages])
+    emails = get_emails(USER, [m["id"] for m in messages])
+    sample = emails[: min(len(emails), 200)]
+
+    results["ingestion_rules"] = bench_ingestion(emails, False, args.rounds)
+    results["ingestion_llm"] = bench_ingestion(sample, True, 1)
+    results["rule_precision"] = bench_rule_precision(sample)
+    results["agent"] = bench_agent(emails, args.agent_calls)
+    results["page_data"] = bench_page_data(
+        args.page_size, max(1, args.emails // args.page_size)
+    )
+
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "timestamp": int(time.time()),
+        "config": vars(args),
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.out:
+        Path(args.out).write_text(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
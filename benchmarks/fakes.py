@@ -0,0 +1,641 @@
+"""
+In-process stand-ins for Gmail, Gemini and MongoDB used by the benchmark
+suite. Each implements just the API surface the backend calls, with
+configurable latency, so hot paths can be timed without network access.
+"""
+
+import copy
+import json
+import re
+import threading
+import time
+from itertools import count
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+# ---------------- GMAIL ----------------
+
+
+class FakeRequest:
+    """An HttpRequest look-alike; execute() pays one round trip."""
+
+    def __init__(self, service: "FakeGmailService", fn):
+        self._service = service
+        self._fn = fn
+
+    def execute(self):
+        self._service._round_trip()
+        return self._service._account(self._fn())
+
+
+class FakeBatch:
+    def __init__(self, service: "FakeGmailService", callback):
+        self._service = service
+        self._callback = callback
+        self._requests = []
+
+    def add(self, request: FakeRequest, request_id: str):
+        self._requests.append((request_id, request))
+
+    def execute(self):
+        self._service._round_trip()
+        self._service.stats["batches"] += 1
+        for request_id, request in self._requests:
+            self._callback(request_id, self._service._account(request._fn()), None)
+
+
+class _Resource:
+    def __init__(self, **methods):
+        self.__dict__.update(methods)
+
+
+class FakeGmailService:
+    """
+    Serves `messages` (format=full resources, oldest first) through the
+    users().getProfile / messages().list/get / drafts().create/list / history()
+    calls and batch requests. `latency_s` is charged per HTTP round trip.
+    drafts().list ignores `q` and lists every draft created so far.
+    """
+
+    def __init__(self, messages: List[Dict[str, Any]], latency_s: float = 0.0):
+        self.latency_s = latency_s
+        self._by_id = {m["id"]: m for m in messages}
+        self._newest_first = [m["id"] for m in reversed(messages)]
+        self._draft_ids = count(1)
+        self.drafts: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+        self.stats = {"round_trips": 0, "batches": 0, "responses": 0, "bytes": 0}
+
+    def _round_trip(self):
+        with self._lock:
+            self.stats["round_trips"] += 1
+        if self.latency_s:
+            time.sleep(self.latency_s)
+
+    def _account(self, response):
+        size = len(json.dumps(response))
+        with self._lock:
+            self.stats["responses"] += 1
+            self.stats["bytes"] += size
+        return response
+
+    def reset_stats(self):
+        for k in self.stats:
+            self.stats[k] = 0
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatch(self, callback)
+
+    def users(self):
+        return _Resource(
+            getProfile=self._get_profile,
+            messages=lambda: _Resource(list=self._list, get=self._get),
+            drafts=lambda: _Resource(
+                create=self._create_draft, list=self._list_drafts
+            ),
+            history=lambda: _Resource(list=self._history),
+        )
+
+    def _get_profile(self, userId="me"):
+        return FakeRequest(
+            self,
+            lambda: {"emailAddress": "me@example.com", "historyId": "1000"},
+        )
+
+    def _list(self, userId="me", maxResults=100, pageToken=None, **_):
+        start = int(pageToken or 0)
+        ids = self._newest_first[start : start + maxResults]
+
+        def _fn():
+            resp = {
+                "messages": [
+                    {"id": i, "threadId": self._by_id[i]["threadId"]} for i in ids
+                ],
+                "resultSizeEstimate": len(ids),
+            }
+            if start + maxResults < len(self._newest_first):
+                resp["nextPageToken"] = str(start + maxResults)
+            return resp
+
+        return FakeRequest(self, _fn)
+
+    def _get(self, userId="me", id=None, format="full", metadataHeaders=None, **_):
+        def _fn():
+            msg = self._by_id[id]
+            if format != "metadata":
+                return msg
+            wanted = {h.lower() for h in metadataHeaders or []}
+            headers = [
+                h
+                for h in msg["payload"].get("headers", [])
+                if not wanted or h["name"].lower() in wanted
+            ]
+            meta = {k: v for k, v in msg.items() if k != "payload"}
+            meta["payload"] = {
+                "mimeType": msg["payload"]["mimeType"],
+                "headers": headers,
+            }
+            return meta
+
+        return FakeRequest(self, _fn)
+
+    def _create_draft(self, userId="me", body=None):
+        draft_id = f"r{next(self._draft_ids)}"
+        thread_id = (body or {}).get("message", {}).get("threadId")
+        draft = {"id": draft_id, "message": {"id": f"m-{draft_id}"}}
+        if thread_id:
+            draft["message"]["threadId"] = thread_id
+
+        def _fn():
+            with self._lock:
+                self.drafts.append(draft)
+            return draft
+
+        return FakeRequest(self, _fn)
+
+    def _list_drafts(self, userId="me", q=None, **_):
+        return FakeRequest(self, lambda: {"drafts": list(self.drafts)})
+
+    def _history(self, userId="me", startHistoryId=None, **_):
+        return FakeRequest(self, lambda: {"history": [], "historyId": startHistoryId})
+
+
+# ---------------- GEMINI ----------------
+
+_BATCH_ID = re.compile(r"^=== id: (E\d+) ===$", re.M)
+
+
+class _Usage:
+    def __init__(self, prompt_tokens: int, output_tokens: int):
+        self.prompt_token_count = prompt_tokens
+        self.candidates_token_count = output_tokens
+        self.total_token_count = prompt_tokens + output_tokens
+
+
+class _Candidate:
+    def __init__(self, finish_reason: Optional[str]):
+        self.finish_reason = finish_reason
+
+
+class _Response:
+    def __init__(self, text: str, prompt: str, finish_reason: Optional[str] = "STOP"):
+        self.text = text
+        self.usage_metadata = _Usage(len(prompt) // 4, len(text) // 4)
+        self.candidates = [_Candidate(finish_reason)]
+
+
+def _capped(text: str, config) -> Tuple[str, str]:
+    """`text` cut to the config's output cap (4 chars a token) and its finish reason."""
+    limit = getattr(config, "max_output_tokens", None)
+    if limit and len(text) > limit * 4:
+        return text[: limit * 4], "MAX_TOKENS"
+    return text, "STOP"
+
+
+def _fake_category(block: str) -> str:
+    # bulk mail is told apart by its footer, everything else needs a reply
+    return "Newsletter" if "unsubscribe" in block.lower() else "To-Do"
+
+
+def fake_reply(prompt: str) -> str:
+    """A well-formed answer to any prompt the backend builds."""
+    ids = _BATCH_ID.findall(prompt)
+    if ids and '"category"' in prompt:
+        blocks = _BATCH_ID.split(prompt)[2::2]
+        return json.dumps(
+            [{"id": i, "category": _fake_category(b)} for i, b in zip(ids, blocks)]
+        )
+    if ids:
+        return json.dumps([{"id": i, "actions": []} for i in ids])
+    if "Respond with the category name only" in prompt:
+        return "Important"
+    if "Respond with JSON only" in prompt or "JSON: [" in prompt:
+        return json.dumps(
+            [{"task": "Send the slides", "deadline": "Friday", "assignee": "me"}]
+        )
+    if "{'subject'" in prompt or '"subject"' in prompt:
+        return json.dumps(
+            {"subject": "Re: your email", "body": "Thanks, will do.", "followups": []}
+        )
+    return "This email asks for an update on the project status by Friday. " * 3
+
+
+class _Models:
+    def __init__(self, client: "FakeGenAIClient"):
+        self._client = client
+
+    def generate_content(self, model=None, contents="", config=None):
+        self._client._count()
+        client = self._client
+        time.sleep(client.first_token_s + client.per_chunk_s * client.chunks)
+        text, reason = _capped(fake_reply(contents), config)
+        return _Response(text, contents, reason)
+
+    def generate_content_stream(
+        self, model=None, contents="", config=None
+    ) -> Iterator[_Response]:
+        self._client._count()
+        text, reason = _capped(fake_reply(contents), config)
+        time.sleep(self._client.first_token_s)
+        size = max(1, len(text) // self._client.chunks)
+        for start in range(0, len(text), size):
+            last = start + size >= len(text)
+            yield _Response(
+                text[start : start + size], contents, reason if last else None
+            )
+            time.sleep(self._client.per_chunk_s)
+
+
+class FakeGenAIClient:
+    """
+    `google.genai.Client` stand-in: `models.generate_content(_stream)` sleep
+    `first_token_s` before the first chunk and `per_chunk_s` per chunk.
+    """
+
+    def __init__(
+        self, first_token_s: float = 0.0, per_chunk_s: float = 0.0, chunks: int = 4
+    ):
+        self.first_token_s = first_token_s
+        self.per_chunk_s = per_chunk_s
+        self.chunks = chunks
+        self.calls = 0
+        self._lock = threading.Lock()
+        self.models = _Models(self)
+
+    def _count(self):
+        with self._lock:
+            self.calls += 1
+
+
+# ---------------- MONGO ----------------
+
+_MISSING = object()
+
+
+def _get(doc: Dict[str, Any], path: str):
+    for part in path.split("."):
+        if not isinstance(doc, dict) or part not in doc:
+            return _MISSING
+        doc = doc[part]
+    return doc
+
+
+def _compare(value, op: str, arg) -> bool:
+    if op == "$exists":
+        return (value is not _MISSING) == bool(arg)
+    if op == "$in":
+        return value in arg
+    if op == "$nin":
+        return value not in arg
+    if op == "$ne":
+        return value != arg
+    if op == "$eq":
+        return value == arg
+    if value is _MISSING or value is None:
+        return False
+    if op == "$lt":
+        return value < arg
+    if op == "$lte":
+        return value <= arg
+    if op == "$gt":
+        return value > arg
+    if op == "$gte":
+        return value >= arg
+    raise NotImplementedError(f"query operator {op}")
+
+
+def matches(doc: Dict[str, Any], query: Dict[str, Any]) -> bool:
+    for key, cond in query.items():
+        if key == "$or":
+            if not any(matches(doc, q) for q in cond):
+                return False
+            continue
+        if key == "$and":
+            if not all(matches(doc, q) for q in cond):
+                return False
+            continue
+        if key == "$text":
+            raise NotImplementedError("$text queries need a real MongoDB")
+        value = _get(doc, key)
+        if isinstance(cond, dict) and cond and next(iter(cond)).startswith("$"):
+            if "$regex" in cond:
+                flags = re.I if "i" in cond.get("$options", "") else 0
+                if not isinstance(value, str) or not re.search(
+                    cond["$regex"], value, flags
+                ):
+                    return False
+                cond = {k: v for k, v in cond.items() if k not in ("$regex", "$options")}
+            if not all(_compare(value, op, arg) for op, arg in cond.items()):
+                return False
+        elif value is _MISSING:
+            if cond is not None:
+                return False
+        elif isinstance(value, list) and not isinstance(cond, list):
+            if cond not in value:
+                return False
+        elif value != cond:
+            return False
+    return True
+
+
+def _project(doc: Dict[str, Any], projection) -> Dict[str, Any]:
+    if not projection:
+        return copy.deepcopy(doc)
+    if isinstance(projection, (list, tuple)):
+        projection = {k: 1 for k in projection}
+    fields = {k: v for k, v in projection.items() if k != "_id"}
+    include = any(v and not isinstance(v, dict) for v in fields.values())
+    if include:
+        out = {k: copy.deepcopy(doc[k]) for k in fields if k in doc and fields[k]}
+    else:
+        out = {k: copy.deepcopy(v) for k, v in doc.items() if k not in fields}
+    if projection.get("_id", 1) and "_id" in doc:
+        out["_id"] = doc["_id"]
+    else:
+        out.pop("_id", None)
+    return out
+
+
+def _parent(doc: Dict[str, Any], path: str, create: bool):
+    """The document holding a dotted path's last field, and that field's name."""
+    *parents, last = path.split(".")
+    for part in parents:
+        if create:
+            doc = doc.setdefault(part, {})
+        else:
+            doc = doc.get(part) if isinstance(doc, dict) else None
+    return doc if isinstance(doc, dict) else None, last
+
+
+def _apply_update(doc: Dict[str, Any], update: Dict[str, Any], inserting: bool):
+    for op, fields in update.items():
+        for path, value in fields.items():
+            target, key = _parent(doc, path, create=op != "$unset")
+            if target is None:
+                continue
+            if op == "$set":
+                target[key] = copy.deepcopy(value)
+            elif op == "$setOnInsert":
+                if inserting:
+                    target[key] = copy.deepcopy(value)
+            elif op == "$inc":
+                target[key] = target.get(key, 0) + value
+            elif op == "$unset":
+                target.pop(key, None)
+            elif op == "$push":
+                target.setdefault(key, []).append(copy.deepcopy(value))
+            elif op == "$addToSet":
+                items = value["$each"] if isinstance(value, dict) else [value]
+                current = target.setdefault(key, [])
+                current.extend(v for v in items if v not in current)
+            else:
+                raise NotImplementedError(f"update operator {op}")
+
+
+class _Result:
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+
+class FakeCursor:
+    def __init__(self, docs: List[Dict[str, Any]], projection=None):
+        self._docs = docs
+        self._projection = projection
+        self._skip = 0
+        self._limit = 0
+
+    def sort(self, key_or_list, direction=None):
+        keys = (
+            key_or_list
+            if isinstance(key_or_list, list)
+            else [(key_or_list, direction or 1)]
+        )
+        for key, direction in reversed(keys):
+            if isinstance(direction, dict):  # {"$meta": "textScore"}
+                continue
+            present = [d for d in self._docs if _get(d, key) not in (_MISSING, None)]
+            absent = [d for d in self._docs if _get(d, key) in (_MISSING, None)]
+            present.sort(key=lambda d: _get(d, key), reverse=direction < 0)
+            # Mongo orders missing/null before any value
+            self._docs = absent + present if direction > 0 else present + absent
+        return self
+
+    def skip(self, n: int):
+        self._skip = n
+        return self
+
+    def limit(self, n: int):
+        self._limit = n
+        return self
+
+    def __iter__(self):
+        docs = self._docs[self._skip :]
+        if self._limit:
+            docs = docs[: self._limit]
+        return (_project(d, self._projection) for d in docs)
+
+
+class FakeCollection:
+    """A list of documents behind the pymongo Collection methods we use."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._docs: List[Dict[str, Any]] = []
+        self._ids = count(1)
+        self._lock = threading.RLock()
+
+    def _insert(self, doc: Dict[str, Any]) -> Any:
+        doc = copy.deepcopy(doc)
+        doc.setdefault("_id", f"{self.name}-{next(self._ids)}")
+        self._docs.append(doc)
+        return doc["_id"]
+
+    def _upsert_seed(self, query: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            k: v
+            for k, v in query.items()
+            if not k.startswith("$") and not isinstance(v, dict)
+        }
+
+    def create_indexes(self, models):
+        return [getattr(m, "document", {}).get("name", "") for m in models]
+
+    def create_index(self, *args, **kwargs):
+        return kwargs.get("name", "")
+
+    def find(self, query=None, projection=None, sort=None, limit=0, skip=0):
+        with self._lock:
+            docs = [d for d in self._docs if matches(d, query or {})]
+        cursor = FakeCursor(docs, projection)
+        if sort:
+            cursor.sort(sort)
+        return cursor.skip(skip).limit(limit)
+
+    def find_one(self, query=None, projection=None, sort=None):
+        return next(iter(self.find(query, projection, sort=sort, limit=1)), None)
+
+    def count_documents(self, query):
+        with self._lock:
+            return sum(1 for d in self._docs if matches(d, query))
+
+    def insert_one(self, doc):
+        with self._lock:
+            return _Result(inserted_id=self._insert(doc))
+
+    def insert_many(self, docs, ordered=True):
+        with self._lock:
+            return _Result(inserted_ids=[self._insert(d) for d in docs])
+
+    def _update(self, query, update, upsert, many):
+        with self._lock:
+            hits = [d for d in self._docs if matches(d, query)]
+            if not many:
+                hits = hits[:1]
+            for d in hits:
+                _apply_update(d, update, inserting=False)
+            upserted_id = None
+            if not hits and upsert:
+                doc = self._upsert_seed(query)
+                _apply_update(doc, update, inserting=True)
+                upserted_id = self._insert(doc)
+            return _Result(
+                matched_count=len(hits),
+                modified_count=len(hits),
+                upserted_id=upserted_id,
+            )
+
+    def update_one(self, query, update, upsert=False):
+        return self._update(query, update, upsert, many=False)
+
+    def update_many(self, query, update, upsert=False):
+        return self._update(query, update, upsert, many=True)
+
+    def replace_one(self, query, doc, upsert=False):
+        with self._lock:
+            for i, d in enumerate(self._docs):
+                if matches(d, query):
+                    self._docs[i] = {**copy.deepcopy(doc), "_id": d["_id"]}
+                    return _Result(matched_count=1, modified_count=1, upserted_id=None)
+            if upsert:
+                return _Result(
+                    matched_count=0, modified_count=0, upserted_id=self._insert(doc)
+                )
+            return _Result(matched_count=0, modified_count=0, upserted_id=None)
+
+    def find_one_and_update(
+        self,
+        query,
+        update,
+        projection=None,
+        sort=None,
+        upsert=False,
+        return_document=False,
+    ):
+        with self._lock:
+            hits = [d for d in self._docs if matches(d, query)]
+            if sort:
+                hits = FakeCursor(hits).sort(sort)._docs
+            if hits:
+                target = hits[0]
+                before = copy.deepcopy(target)
+                _apply_update(target, update, inserting=False)
+            elif upsert:
+                target = self._upsert_seed(query)
+                _apply_update(target, update, inserting=True)
+                self._insert(target)
+                target = self._docs[-1]
+                before = None
+            else:
+                return None
+            doc = target if return_document else before
+            return _project(doc, projection) if doc is not None else None
+
+    def delete_one(self, query):
+        with self._lock:
+            for i, d in enumerate(self._docs):
+                if matches(d, query):
+                    del self._docs[i]
+                    return _Result(deleted_count=1)
+            return _Result(deleted_count=0)
+
+    def delete_many(self, query):
+        with self._lock:
+            keep = [d for d in self._docs if not matches(d, query)]
+            deleted = len(self._docs) - len(keep)
+            self._docs = keep
+            return _Result(deleted_count=deleted)
+
+    def bulk_write(self, requests, ordered=True):
+        """UpdateOne/InsertOne/DeleteMany operations, via pymongo's attributes."""
+        matched = modified = upserted = inserted = deleted = 0
+        for op in requests:
+            kind = type(op).__name__
+            if kind == "InsertOne":
+                self.insert_one(op._doc)
+                inserted += 1
+            elif kind in ("UpdateOne", "UpdateMany"):
+                res = self._update(
+                    op._filter, op._doc, bool(op._upsert), many=kind == "UpdateMany"
+                )
+                matched += res.matched_count
+                modified += res.modified_count
+                upserted += res.upserted_id is not None
+            elif kind == "DeleteMany":
+                deleted += self.delete_many(op._filter).deleted_count
+            else:
+                raise NotImplementedError(f"bulk operation {kind}")
+        return _Result(
+            matched_count=matched,
+            modified_count=modified,
+            upserted_count=upserted,
+            inserted_count=inserted,
+            deleted_count=deleted,
+        )
+
+
+class FakeDatabase:
+    def __init__(self, name: str):
+        self.name = name
+        self._collections: Dict[str, FakeCollection] = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, name: str) -> FakeCollection:
+        with self._lock:
+            if name not in self._collections:
+                self._collections[name] = FakeCollection(name)
+            return self._collections[name]
+
+    def __getattr__(self, name: str) -> FakeCollection:
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
+
+    def drop_collection(self, name: str) -> None:
+        with self._lock:
+            self._collections.pop(name, None)
+
+
+class FakeMongoClient:
+    """Dict of FakeDatabases; stands in for the process-wide MongoClient."""
+
+    def __init__(self):
+        self._dbs: Dict[str, FakeDatabase] = {}
+
+    def __getitem__(self, name: str) -> FakeDatabase:
+        if name not in self._dbs:
+            self._dbs[name] = FakeDatabase(name)
+        return self._dbs[name]
+
+    def get_database(self, name: str) -> FakeDatabase:
+        return self[name]
+
+    def close(self) -> None:
+        pass
+
+
+def install_fake_mongo(client: Optional[FakeMongoClient] = None) -> FakeMongoClient:
+    """Make backend.mongo_db hand out `client` instead of connecting."""
+    from backend.services import services
+
+    client = client or FakeMongoClient()
+    services.override("mongo", client)
+    return client
@@ -0,0 +1,173 @@
+"""
+Synthetic Gmail mailboxes for the benchmark suite.
+
+Messages are Gmail API `messages.get` resources (format=full) with a mix
+of MIME shapes, reply threads that quote their parent, and bodies sized
+by paragraph count, so parsing, cleaning and storage see realistic input.
+"""
+
+import base64
+import random
+from typing import Any, Dict, List
+
+WORDS = (
+    "meeting report quarter budget team update project status lunch call "
+    "invoice travel schedule notes agenda offer design review launch client "
+    "contract hiring roadmap metrics release customer feedback"
+).split()
+REQUESTS = [
+    "Please send me the slides before Friday.",
+    "Could you review the attached draft?",
+    "Kindly confirm the deadline for the report.",
+    "Update the tracker when the payment is due.",
+]
+NEWSLETTER = "You are receiving this newsletter. Click here to unsubscribe."
+SIGNATURE = "\n-- \nAlex Doe | Operations\nhttps://example.com/track?u=123456789abcdef"
+SENDERS = [f"{name}@example.com" for name in ("alice", "bob", "carol", "dan", "news")]
+
+# MIME layouts and how often each occurs
+MIME_SHAPES = {
+    "plain": 0.35,
+    "alternative": 0.35,
+    "html": 0.1,
+    "mixed_attachment": 0.15,
+    "nested": 0.05,
+}
+BASE_TIME_MS = 1_700_000_000_000
+
+
+def _b64(text: str) -> str:
+    return base64.urlsafe_b64encode(text.encode("utf-8")).decode("ascii")
+
+
+def _leaf(mime: str, text: str) -> Dict[str, Any]:
+    return {
+        "mimeType": mime,
+        "headers": [{"name": "Content-Type", "value": f"{mime}; charset=utf-8"}],
+        "body": {"size": len(text), "data": _b64(text)},
+    }
+
+
+def _attachment(rng: random.Random) -> Dict[str, Any]:
+    return {
+        "mimeType": "application/pdf",
+        "filename": f"report-{rng.randint(1, 999)}.pdf",
+        "headers": [{"name": "Content-Disposition", "value": "attachment"}],
+        "body": {"size": rng.randint(20_000, 900_000), "attachmentId": "att"},
+    }
+
+
+def _html(text: str) -> str:
+    paragraphs = "".join(f"<p>{p}</p>" for p in text.split("\n\n"))
+    return (
+        "<html><head><style>p{margin:0}</style></head>"
+        f"<body><div>{paragraphs}</div></body></html>"
+    )
+
+
+def _payload(shape: str, text: str, rng: random.Random) -> Dict[str, Any]:
+    if shape == "plain":
+        return _leaf("text/plain", text)
+    if shape == "html":
+        return _leaf("text/html", _html(text))
+    alternative = {
+        "mimeType": "multipart/alternative",
+        "parts": [_leaf("text/plain", text), _leaf("text/html", _html(text))],
+    }
+    if shape == "alternative":
+        return alternative
+    if shape == "mixed_attachment":
+        return {
+            "mimeType": "multipart/mixed",
+            "parts": [alternative, _attachment(rng)],
+        }
+    # nested: mixed > related > alternative, plus attachments
+    return {
+        "mimeType": "multipart/mixed",
+        "parts": [
+            {"mimeType": "multipart/related", "parts": [alternative]},
+            _attachment(rng),
+            _attachment(rng),
+        ],
+    }
+
+
+def _paragraphs(rng: random.Random, n: int) -> str:
+    paras = []
+    for _ in range(n):
+        sentence = " ".join(rng.choices(WORDS, k=rng.randint(8, 30))).capitalize()
+        if rng.random() < 0.2:
+            sentence += " " + rng.choice(REQUESTS)
+        paras.append(sentence + ".")
+    return "\n\n".join(paras)
+
+
+def _quote(text: str, sender: str) -> str:
+    quoted = "\n".join("> " + line for line in text.splitlines())
+    return f"\n\nOn Mon, Jan 6, 2025 at 10:00 AM {sender} wrote:\n{quoted}"
+
+
+def synthetic_gmail_mailbox(
+    n: int,
+    seed: int = 7,
+    paragraphs: tuple = (1, 8),
+    max_thread_depth: int = 5,
+) -> List[Dict[str, Any]]:
+    """
+    `n` message resources, newest last. Roughly a third of messages reply
+    to an earlier one in the same thread (up to `max_thread_depth` deep)
+    and quote its full text.
+    """
+    rng = random.Random(seed)
+    shapes, weights = zip(*MIME_SHAPES.items())
+    messages: List[Dict[str, Any]] = []
+    threads: List[Dict[str, Any]] = []
+    for i in range(n):
+        sender = rng.choice(SENDERS)
+        text = _paragraphs(rng, rng.randint(*paragraphs))
+        if sender.startswith("news"):
+            text += "\n\n" + NEWSLETTER
+        parent = None
+        if threads and rng.random() < 0.35:
+            parent = rng.choice(threads)
+            if parent["depth"] >= max_thread_depth:
+                parent = None
+        if parent:
+            thread_id, depth = parent["thread_id"], parent["depth"] + 1
+            subject = "Re: " + parent["subject"]
+            text += _quote(parent["text"], parent["sender"])
+        else:
+            thread_id, depth = f"t{i:07d}", 1
+            subject = " ".join(rng.choices(WORDS, k=4)).capitalize()
+        text += SIGNATURE
+        threads.append(
+            {
+                "thread_id": thread_id,
+                "depth": depth,
+                "subject": subject.removeprefix("Re: "),
+                "text": text,
+                "sender": sender,
+            }
+        )
+
+        payload = _payload(rng.choices(shapes, weights)[0], text, rng)
+        payload["headers"] = payload.get("headers", []) + [
+            {"name": "From", "value": sender},
+            {"name": "To", "value": "me@example.com"},
+            {"name": "Subject", "value": subject},
+            {"name": "Date", "value": "Mon, 6 Jan 2025 10:00:00 +0000"},
+            {"name": "Message-ID", "value": f"<m{i:07d}@example.com>"},
+        ]
+        messages.append(
+            {
+                "id": f"m{i:07d}",
+                "threadId": thread_id,
+                "labelIds": ["INBOX"],
+                "snippet": text[:100],
+                "historyId": str(1000 + i),
+                "internalDate": str(BASE_TIME_MS + i * 60_000),
+                "sizeEstimate": len(text) * 2,
+                "payload": payload,
+            }
+        )
+    return messages